@@ -0,0 +1,111 @@
+#
+#
+#  Action Receiver
+#
+#  Gen1 devices call an HTTP "action URL" when an output switches and when their
+#  input is switched or pushed.  The receiver is a route on a LocalHttpServer that
+#  takes those calls, so a wall switch shows up within the request time rather than
+#  on the next poll, and button pushes (which polling never sees) become DON / DOF /
+#  DFON controls on the node.  The URLs are
+#
+#      http://<nodeserver>:<ActionPort>/shelly/action/<node address>/<channel>/<event>
+#
+#  and can be written onto the devices (settings/actions) by provision().  URLs the
+#  user set for other things are kept, the device calls all of them.
+#
+
+import socket
+from typing import Any, Dict, List
+
+from aiohttp import web
+
+from Node_Shared import *
+from ShellyDevice_Reachability import split_host
+
+ACTION_PATH   = '/shelly/action/'
+ACTION_EVENTS = tuple(ACTION_OUTPUT) + tuple(ACTION_CONTROL)
+
+
+def local_address(device_host: str) -> str:
+    """The address of this machine on the way to the device, the one the device can call back"""
+    address, _ = split_host(device_host)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect((address, 9))  # picks the route, nothing is sent
+        return sock.getsockname()[0]
+    finally:
+        sock.close()
+
+
+class ActionReceiver:
+    """Hands action URL calls to the device nodes, by node address"""
+
+    def __init__(self, port: int):
+        self.port = port
+        self._nodes: Dict[str, Any] = {}
+        self.calls = 0
+        self.dropped = 0
+
+    def register(self, node: Any) -> None:
+        self._nodes[node.address] = node
+
+    def unregister(self, node: Any) -> None:
+        self._nodes.pop(node.address, None)
+
+    def url(self, host: str, node_address: str, channel: int, event: str) -> str:
+        return 'http://' + host + ':' + str(self.port) + ACTION_PATH + node_address + '/' + str(channel) + '/' + event
+
+    async def on_action(self, request: web.Request) -> web.StreamResponse:
+        """The route handler, for ACTION_PATH + '{address}/{channel}/{event}'"""
+        node = self._nodes.get(request.match_info['address'])
+        event = request.match_info['event']
+        channel = request.match_info['channel']
+        if node is None or event not in ACTION_EVENTS or not channel.isdigit():
+            self.dropped += 1
+            raise web.HTTPNotFound()
+        self.calls += 1
+        LOGGER.debug('ActionReceiver: %s channel %s %s', node.name, channel, event)
+        if event in ACTION_OUTPUT:
+            node.push.subscribed = True  # the device reports its output changes, it only needs the slow liveness poll
+        node.actionReceived(event, int(channel))
+        return web.Response(text='ok')
+
+    async def provision(self, node: Any) -> bool:
+        """
+        Make sure the device calls us on its output and input actions, writing only the
+        actions that are not set up yet.  Returns True if the device reports its output changes.
+        """
+        device = node.shelly_device
+        actions = await device.async_get_actions()
+        if not actions:
+            return False
+        host = local_address(device.host)
+        written = 0
+        for name, entries in actions.items():
+            event = name[:-len('_url')]
+            if not name.endswith('_url') or event not in ACTION_EVENTS:
+                continue
+            for entry in entries:
+                channel = entry.get('index', 0)
+                url = self.url(host, node.address, channel, event)
+                urls = self._merge(entry.get('urls') or [], url, node.address)
+                if entry.get('enabled') and urls == entry.get('urls'):
+                    continue
+                await device.async_set_action_urls(name, urls, channel)
+                written += 1
+        if written:
+            LOGGER.info('ActionReceiver: set %d action URLs on %s', written, node.name)
+        node.push.subscribed = any(name[:-len('_url')] in ACTION_OUTPUT for name in actions)
+        return node.push.subscribed
+
+    #
+    # Private functions
+    #
+    @staticmethod
+    def _merge(urls: List[str], url: str, node_address: str) -> List[str]:
+        """The user's URLs and ours, an old one of ours (another address or port) is replaced"""
+        mine = ACTION_PATH + node_address + '/'
+        merged = [existing for existing in urls if mine not in existing or existing == url]
+        if url not in merged:
+            merged.append(url)
+        return merged
@@ -0,0 +1,198 @@
+#
+#
+#  CoIoT Listener
+#
+#  Gen1 Shelly devices send their state as CoIoT (CoAP over UDP) to the multicast
+#  group 224.0.1.187:5683 whenever it changes, and periodically after that.  This
+#  listens for those packets and pushes the state to the matching node, so changes
+#  made at the wall switch show up without waiting for the next poll.
+#
+#  Only the CoIoT v2 sensor ids (firmware 1.8 and later) are decoded.
+#
+
+import asyncio
+import json
+import socket
+import struct
+from typing import Any, Dict, Optional
+
+from Node_Shared import *
+
+COIOT_MULTICAST_GROUP = '224.0.1.187'
+COIOT_PORT            = 5683
+
+COAP_CODE_STATUS      = 30      # Shelly non standard code for a status publish
+COAP_PAYLOAD_MARKER   = 0xFF
+COIOT_OPTION_GLOBAL_DEVID = 3332  # "<type>#<id>#<coiot version>"
+COIOT_OPTION_STATUS_VALIDITY = 3412
+COIOT_OPTION_STATUS_SERIAL   = 3420
+
+DEFAULT_VALIDITY = 38.0  # seconds, Shelly default when a packet does not say
+
+# CoIoT v2 sensor ids to the state names used by the nodes
+_SENSOR_IDS = {
+    1101 : 'ison',
+    4101 : 'power',   # W
+    4103 : 'energy',  # Wmin, the meter's counter
+    5102 : 'gain',
+    5105 : 'red',
+    5106 : 'green',
+    5107 : 'blue',
+    5108 : 'white',
+    }
+
+
+class CoIoTMessage:
+    """A decoded CoIoT status packet"""
+    def __init__(self, device_type: str, device_id: str, serial: int, validity: float, state: Dict[str, Any]):
+        self.device_type = device_type
+        self.device_id   = device_id
+        self.serial      = serial
+        self.validity    = validity
+        self.state       = state
+
+    def __str__(self):
+        return "CoIoT: type=" + str(self.device_type) + ",  id=" + str(self.device_id) + ",  serial=" + str(self.serial) + ",  validity=" + str(self.validity) + ",  state=" + str(self.state)
+
+
+def parse_coiot_packet(data: bytes) -> Optional[CoIoTMessage]:
+    """Decode a CoIoT status datagram.  Returns None for anything that is not a status publish."""
+    if len(data) < 4 or (data[0] >> 6) != 1:
+        return None
+    token_len = data[0] & 0x0F
+    if data[1] != COAP_CODE_STATUS:
+        return None
+
+    pos = 4 + token_len
+    option = 0
+    options = {}
+    while pos < len(data) and data[pos] != COAP_PAYLOAD_MARKER:
+        delta  = data[pos] >> 4
+        length = data[pos] & 0x0F
+        pos += 1
+        delta, pos  = _read_option_nibble(data, delta, pos)
+        length, pos = _read_option_nibble(data, length, pos)
+        option += delta
+        options[option] = data[pos:pos + length]
+        pos += length
+    if pos >= len(data):
+        return None
+    payload = json.loads(data[pos + 1:].decode('utf-8', errors='replace'))
+
+    device_type, device_id = None, None
+    devid = options.get(COIOT_OPTION_GLOBAL_DEVID)
+    if devid is not None:
+        parts = devid.decode('ascii', errors='replace').split('#')
+        device_type = parts[0]
+        if len(parts) > 1:
+            device_id = parts[1].upper()
+
+    serial = int.from_bytes(options.get(COIOT_OPTION_STATUS_SERIAL, b''), 'big')
+
+    validity = DEFAULT_VALIDITY
+    raw_validity = options.get(COIOT_OPTION_STATUS_VALIDITY)
+    if raw_validity:
+        value = int.from_bytes(raw_validity, 'big')
+        validity = value / 10.0 if (value & 1) == 0 else value * 4.0
+
+    state = {}
+    for channel, sensor_id, value in payload.get('G', []):
+        name = _SENSOR_IDS.get(sensor_id)
+        if name is None:
+            continue
+        if name == 'ison':
+            value = bool(value)
+        elif name == 'energy':
+            value = value / 60.0  # Wh, like the other sources
+        state[name] = value
+
+    return CoIoTMessage(device_type, device_id, serial, validity, state)
+
+
+def _read_option_nibble(data: bytes, value: int, pos: int):
+    if value == 13:
+        return data[pos] + 13, pos + 1
+    if value == 14:
+        return int.from_bytes(data[pos:pos + 2], 'big') + 269, pos + 2
+    return value, pos
+
+
+class CoIoTListener(asyncio.DatagramProtocol):
+    """Receives CoIoT datagrams and pushes the decoded state to the registered nodes"""
+
+    def __init__(self):
+        self._transport = None
+        self._starting = False
+        self._nodes_by_id = {}
+        self._nodes_by_host = {}
+        self.packets_received = 0
+        self.packets_dropped = 0
+
+    def register(self, node: Any, host: str, device_id: str = None) -> None:
+        """Send pushes from the device at host (or with the CoIoT device_id) to node"""
+        self._nodes_by_host[host] = node
+        if device_id:
+            self._nodes_by_id[device_id.upper()] = node
+
+    def unregister(self, node: Any) -> None:
+        for table in (self._nodes_by_host, self._nodes_by_id):
+            for key in [k for k, v in table.items() if v is node]:
+                del table[key]
+
+    async def start(self, loop: asyncio.AbstractEventLoop, bind_addr: str = '', port: int = COIOT_PORT, multicast: bool = True) -> None:
+        """Open the UDP socket on the given loop and start listening.  Does nothing if already listening."""
+        if self._transport is not None or self._starting:
+            return
+        self._starting = True
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.bind((bind_addr, port))
+                if multicast:
+                    membership = struct.pack('4s4s', socket.inet_aton(COIOT_MULTICAST_GROUP), socket.inet_aton('0.0.0.0'))
+                    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+                sock.setblocking(False)
+                await loop.create_datagram_endpoint(lambda: self, sock=sock)
+            except:
+                sock.close()
+                raise
+            LOGGER.info('CoIoT: listening on port %d', sock.getsockname()[1])
+        finally:
+            self._starting = False
+
+    def stop(self) -> None:
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+    @property
+    def port(self) -> Optional[int]:
+        if self._transport is None:
+            return None
+        return self._transport.get_extra_info('sockname')[1]
+
+    #
+    # DatagramProtocol
+    #
+    def connection_made(self, transport) -> None:
+        self._transport = transport
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        try:
+            message = parse_coiot_packet(data)
+        except Exception as ex:
+            LOGGER.debug('CoIoT: bad packet from %s: %s', addr[0], str(ex))
+            self.packets_dropped += 1
+            return
+        if message is None:
+            self.packets_dropped += 1
+            return
+
+        node = self._nodes_by_id.get(message.device_id) or self._nodes_by_host.get(addr[0])
+        if node is None:
+            self.packets_dropped += 1
+            return
+        self.packets_received += 1
+        LOGGER.debug('CoIoT: %s from %s', str(message), addr[0])
+        node.pushReceived(message.state, message.validity)
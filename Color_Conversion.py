@@ -0,0 +1,130 @@
+#
+#
+#  Color Conversion
+#
+#  Hue/saturation and color temperature for the RGBW2 in color mode, as the red, green,
+#  blue and white channel values the device takes, and the channel values the device
+#  reports back as hue, saturation and color temperature for the drivers.
+#
+#  The mixing model takes the white LED to be a neutral white: the part of a color that
+#  red, green and blue would all have to give is given by the white channel instead, so
+#  a pastel is mostly white with a little color, and a white is the white LED alone with
+#  the color channels adding the tint.  The mixing is done in linear light, the channel
+#  values are PWM levels, and brightness stays the device's gain.
+#
+#  The tables are built once at import, a command is a lookup in them:
+#    GAMMA_TABLE    perceived level 0-255 to linear light 0-1 (GAMMA)
+#    INVERSE_GAMMA  linear light in INVERSE_STEPS steps back to a perceived level 0-1
+#    HUE_TABLE      the fully saturated color of each degree of hue, perceived 0-1
+#    CCT_TABLE      the RGBW channel values of each CCT_STEP Kelvin from CCT_MIN to CCT_MAX,
+#                   from the black body colors of Tanner Helland's approximation
+#  and for going back, the b/r and g/r linear ratios of each CCT_TABLE entry.  b/r goes up
+#  with the temperature wherever there is blue in the color, except just above 6600 K where
+#  red and blue are both full and only g/r falls, and below about 1900 K there is no blue
+#  and g/r goes up instead, so between them they make one ordered key to bisect.
+#
+
+import colorsys
+import math
+from array import array
+from bisect import bisect_left
+from typing import List, Tuple
+
+GAMMA         = 2.2
+INVERSE_STEPS = 4096
+CCT_MIN       = 1000   # Kelvin
+CCT_MAX       = 10000
+CCT_STEP      = 10
+CCT_TOLERANCE = 0.03   # how far off (in b/r and g/r linear ratio) the black body color a color can be and still have a temperature
+
+
+def _black_body(kelvin: float) -> Tuple[float, float, float]:
+    """Perceived RGB 0-1 of a black body at kelvin, Tanner Helland's fit to the CIE 1964 colors"""
+    t = kelvin / 100.0
+    if t <= 66:
+        red   = 255.0
+        green = 99.4708025861 * math.log(t) - 161.1195681661
+    else:
+        red   = 329.698727446 * (t - 60) ** -0.1332047592
+        green = 288.1221695283 * (t - 60) ** -0.0755148492
+    if t >= 66:
+        blue = 255.0
+    elif t <= 19:
+        blue = 0.0
+    else:
+        blue = 138.5177312231 * math.log(t - 10) - 305.0447927307
+    return tuple(min(max(value, 0.0), 255.0) / 255.0 for value in (red, green, blue))
+
+
+def _cct_key(blue_ratio: float, green_ratio: float) -> float:
+    """b/r, plus a little for the green missing once blue is full, and without blue g/r moved under 0 so those sort first"""
+    if blue_ratio >= 1.0:
+        return blue_ratio + 0.1 * (1.0 - green_ratio)
+    return blue_ratio if blue_ratio > 0 else green_ratio - 1.0
+
+
+def _mix(levels) -> Tuple[int, int, int, int]:
+    """Linear light red, green, blue 0-1 as RGBW channel values, the part all three share on white"""
+    white = min(levels)
+    return tuple(int(round((level - white) * 255)) for level in levels) + (int(round(white * 255)),)
+
+
+GAMMA_TABLE   = array('f', ((level / 255.0) ** GAMMA for level in range(256)))
+INVERSE_GAMMA = array('f', ((step / (INVERSE_STEPS - 1)) ** (1 / GAMMA) for step in range(INVERSE_STEPS)))
+HUE_TABLE: List[Tuple[float, float, float]] = [colorsys.hsv_to_rgb(degree / 360.0, 1.0, 1.0) for degree in range(360)]
+
+CCT_TABLE: List[Tuple[int, int, int, int]] = []
+_CCT_KEYS  = array('f')   # what the temperature is looked up by, see _cct_key
+_CCT_BLUE  = array('f')   # b/r linear
+_CCT_GREEN = array('f')   # g/r linear
+for _kelvin in range(CCT_MIN, CCT_MAX + 1, CCT_STEP):
+    _red, _green, _blue = (level ** GAMMA for level in _black_body(_kelvin))
+    CCT_TABLE.append(_mix((_red, _green, _blue)))
+    _CCT_BLUE.append(_blue / _red)
+    _CCT_GREEN.append(_green / _red)
+    _CCT_KEYS.append(_cct_key(_blue / _red, _green / _red))
+
+
+def hsv_to_rgbw(hue: float, saturation: float) -> Tuple[int, int, int, int]:
+    """Red, green, blue and white 0-255 for hue in degrees and saturation in percent"""
+    saturation = min(max(saturation, 0), 100) / 100.0
+    pure = HUE_TABLE[int(round(hue)) % 360]
+    return _mix([GAMMA_TABLE[int(round((1.0 - saturation + saturation * level) * 255))] for level in pure])
+
+
+def kelvin_to_rgbw(kelvin: float) -> Tuple[int, int, int, int]:
+    """Red, green, blue and white 0-255 for a color temperature, clamped to CCT_MIN..CCT_MAX"""
+    kelvin = min(max(kelvin, CCT_MIN), CCT_MAX)
+    return CCT_TABLE[int(round((kelvin - CCT_MIN) / CCT_STEP))]
+
+
+def rgbw_to_hsv(red: int, green: int, blue: int, white: int) -> Tuple[int, int]:
+    """Hue in degrees and saturation in percent of the channel values, (0, 0) for black"""
+    levels = _linear(red, green, blue, white)
+    if levels is None:
+        return 0, 0
+    hue, saturation, _ = colorsys.rgb_to_hsv(*(INVERSE_GAMMA[int(round(level * (INVERSE_STEPS - 1)))] for level in levels))
+    return int(round(hue * 360)) % 360, int(round(saturation * 100))
+
+
+def rgbw_to_kelvin(red: int, green: int, blue: int, white: int) -> int:
+    """Color temperature of the channel values, 0 if they are not close enough to a black body color"""
+    levels = _linear(red, green, blue, white)
+    if levels is None or levels[0] <= 0:
+        return 0
+    blue_ratio, green_ratio = levels[2] / levels[0], levels[1] / levels[0]
+    key = _cct_key(blue_ratio, green_ratio)
+    index = bisect_left(_CCT_KEYS, key)
+    if index == len(_CCT_KEYS) or (index > 0 and key - _CCT_KEYS[index - 1] < _CCT_KEYS[index] - key):
+        index -= 1
+    if abs(blue_ratio - _CCT_BLUE[index]) > CCT_TOLERANCE or abs(green_ratio - _CCT_GREEN[index]) > CCT_TOLERANCE:
+        return 0
+    return CCT_MIN + index * CCT_STEP
+
+
+def _linear(red: int, green: int, blue: int, white: int):
+    """The linear light of each color with the white added back, the brightest 1.  None for black."""
+    top = max(red, green, blue) + white
+    if top <= 0:
+        return None
+    return ((red + white) / top, (green + white) / top, (blue + white) / top)
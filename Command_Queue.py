@@ -0,0 +1,147 @@
+#
+#
+#  Command Queue
+#
+#  Every command for one RGBW2 goes through its queue and reaches the device in the
+#  order it arrived, so a color with the light off followed by an on ends with the
+#  light on.  Bursts of color/brightness commands (sliders, ramping ISY programs) that
+#  arrive within a short window are merged into a single color/0 request, newer values
+#  replacing older ones, and only one request per device is in flight at a time.
+#  On/off comes from the scene dispatcher, which holds its place in the queue when it
+#  arrives, and waits only the scene window, so an RGBW2 in an ISY scene switches and
+#  reports its drivers with the other devices of the scene.
+#
+
+import asyncio
+from typing import Any, Awaitable, Callable, List, Optional, Union
+
+from Node_Shared import *
+from ShellyDevice_Constants import POWER_STATE
+from ShellyDevice_Loop import ShellyDevice_Loop
+from ShellyDevice_RGBW2 import ShellyDevice_RGBW2, LED_COLOR
+from Scene_Dispatcher import SCENE_WINDOW
+
+COALESCE_WINDOW = 0.15  # seconds to wait for more commands before sending
+
+# an LED_COLOR, a POWER_STATE, or a function returning the request for anything else (settings)
+QueueTarget = Union[LED_COLOR, POWER_STATE, Callable[[], Awaitable[Any]]]
+
+
+class _QueuedCommand:
+    """One request to send, and who wants its result"""
+    __slots__ = ('target', 'waiters', 'notify')
+
+    def __init__(self, target: QueueTarget):
+        self.target = target
+        self.waiters = []    # futures of send() callers
+        self.notify = False  # submitted, the result goes to on_result/on_error
+
+
+class ColorCommandQueue:
+    """Sends the commands for one RGBW2 in order, with the color changes merged into as few requests as possible"""
+
+    def __init__(self, device: ShellyDevice_RGBW2, device_loop: ShellyDevice_Loop, on_result: Callable[[Any], None], on_error: Callable[[Exception], None],
+                 window: float = COALESCE_WINDOW, switch_window: float = SCENE_WINDOW):
+        self._device = device
+        self._device_loop = device_loop
+        self._on_result = on_result
+        self._on_error = on_error
+        self._window = window
+        self._switch_window = switch_window
+        self._pending: List[_QueuedCommand] = []
+        self._timer = None
+        self._sending = False
+        self.submitted = 0
+        self.sent = 0
+
+    @property
+    def merged(self) -> int:
+        """Number of commands that were folded into another one instead of being sent"""
+        return self.submitted - self.sent
+
+    def submit(self, target: QueueTarget) -> None:
+        """Queue a command.  Safe to call from any thread, returns straight away, the device's answer goes to on_result."""
+        self._device_loop.loop.call_soon_threadsafe(self._queue, target, None, None)
+
+    def hold(self, target: QueueTarget) -> asyncio.Future:
+        """Queue a command behind the ones waiting and send it when the scene window ends.  Runs on the device loop, the future gives the device's answer."""
+        future = self._device_loop.loop.create_future()
+        self._queue(target, future, self._switch_window)
+        return future
+
+    async def send(self, target: QueueTarget) -> Any:
+        """Queue a command behind the ones waiting and send it without waiting for more.  Runs on the device loop, returns the device's answer."""
+        future = self._device_loop.loop.create_future()
+        self._queue(target, future, 0)
+        return await future
+
+    #
+    # Private functions, these all run on the device loop
+    #
+    def _queue(self, target: QueueTarget, future: Optional[asyncio.Future], window: Optional[float]) -> None:
+        self.submitted += 1
+        if isinstance(target, POWER_STATE) and target != POWER_STATE.Toggle:
+            target = LED_COLOR(on=(target == POWER_STATE.On))
+        last = self._pending[-1] if self._pending else None
+        if last is not None and isinstance(last.target, LED_COLOR) and isinstance(target, LED_COLOR):
+            last.target = last.target.merge(target)
+        else:
+            last = _QueuedCommand(target)
+            self._pending.append(last)
+        if future is None:
+            last.notify = True
+        else:
+            last.waiters.append(future)
+        self._flush_after(self._window_for(target) if window is None else window)
+
+    def _window_for(self, target: QueueTarget) -> float:
+        """Colors wait for more of a burst, on/off, toggle and settings only for the rest of a scene"""
+        if isinstance(target, LED_COLOR) and any(getattr(target, name) is not None for name in ('red', 'green', 'blue', 'white', 'brightness', 'timer')):
+            return self._window
+        return self._switch_window
+
+    def _flush_after(self, window: float) -> None:
+        loop = self._device_loop.loop
+        due = loop.time() + window
+        if self._timer is not None:
+            if self._timer.when() <= due:
+                return
+            self._timer.cancel()
+        self._timer = loop.call_at(due, self._flush)
+
+    def _flush(self) -> None:
+        self._timer = None
+        if self._sending or not self._pending:
+            return  # a send in progress picks up the pending commands when it finishes
+        self._sending = True
+        self._device_loop.spawn(self._drain())
+
+    async def _drain(self) -> None:
+        try:
+            while self._pending:
+                command = self._pending.pop(0)
+                self.sent += 1
+                LOGGER.debug('ColorCommandQueue: sending %s to %s', str(command.target), self._device.host)
+                try:
+                    result = await self._request(command.target)
+                except Exception as ex:
+                    for waiter in command.waiters:
+                        if not waiter.done():
+                            waiter.set_exception(ex)
+                    if command.notify:
+                        self._on_error(ex)
+                    continue
+                for waiter in command.waiters:
+                    if not waiter.done():
+                        waiter.set_result(result)
+                if command.notify:
+                    self._on_result(result)
+        finally:
+            self._sending = False
+
+    async def _request(self, target: QueueTarget) -> Any:
+        if isinstance(target, LED_COLOR):
+            return await self._device.async_device_set_color(target)
+        if isinstance(target, POWER_STATE):
+            return await self._device.async_device_set_on_state(target)
+        return await target()
@@ -0,0 +1,46 @@
+#
+#
+#  Device Credentials
+#
+#  The user and password for the devices that have a login set, from the custom
+#  params: DeviceUser / DevicePassword for all the devices, and AUTH_<DeviceID> with
+#  a value of user:password for a device with a login of its own.
+#
+
+from typing import Dict, Optional, Tuple
+
+AUTH_PARAM_PREFIX = 'AUTH_'
+
+Credential = Tuple[str, str]
+
+
+class DeviceCredentials:
+    """User and password for each device, by device ID"""
+
+    def __init__(self):
+        self.default_user: Optional[str] = None
+        self.default_password: Optional[str] = None
+        self._devices: Dict[str, Credential] = {}
+
+    def clear(self) -> None:
+        """Forget all the logins, before the custom params are read again"""
+        self.default_user = None
+        self.default_password = None
+        self._devices = {}
+
+    def set_device(self, device_id: str, value: str) -> bool:
+        """Set the login of one device from a user:password value.  Returns False if the value is not in that form."""
+        user, sep, password = value.strip().partition(':')
+        if not sep or not user:
+            return False
+        self._devices[device_id.upper()] = (user, password)
+        return True
+
+    def get(self, device_id: str) -> Optional[Credential]:
+        """The login for the device, its own or the default one, None if there is neither"""
+        credential = self._devices.get(device_id.upper())
+        if credential is not None:
+            return credential
+        if self.default_user and self.default_password is not None:
+            return (self.default_user, self.default_password)
+        return None
@@ -0,0 +1,60 @@
+#
+#
+#  Local HTTP Server
+#
+#  A small aiohttp server run on the shared device loop, for the endpoints the
+#  nodeserver offers on the local network (stats, device callbacks).  Routes are
+#  added before start().
+#
+
+from typing import Awaitable, Callable, Optional
+
+from aiohttp import web
+
+from Node_Shared import *
+from ShellyDevice_Loop import ShellyDevice_Loop
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+
+class LocalHttpServer:
+    """aiohttp server on the device loop, listening on one port"""
+
+    def __init__(self, device_loop: ShellyDevice_Loop, port: int, bind_addr: str = ''):
+        self._device_loop = device_loop
+        self._port = port
+        self._bind_addr = bind_addr
+        self._app = web.Application()
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def port(self) -> int:
+        return self._port
+
+    @property
+    def running(self) -> bool:
+        return self._runner is not None
+
+    def add_route(self, method: str, path: str, handler: Handler) -> None:
+        """Add a route, only before the server is started"""
+        self._app.router.add_route(method, path, handler)
+
+    async def start(self) -> None:
+        """Start listening, on the device loop"""
+        if self._runner is not None:
+            return
+        runner = web.AppRunner(self._app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self._bind_addr or None, self._port).start()
+        except Exception:
+            await runner.cleanup()
+            raise
+        self._runner = runner
+        LOGGER.info('LocalHttpServer: listening on port %d', self._port)
+
+    async def stop(self) -> None:
+        if self._runner is None:
+            return
+        runner, self._runner = self._runner, None
+        await runner.cleanup()
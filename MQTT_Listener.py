@@ -0,0 +1,206 @@
+#
+#
+#  MQTT Listener
+#
+#  Gen1 devices with MQTT turned on publish their state to a broker under
+#  shellies/<model>-<device id>/ whenever it changes, and every update period (30 s
+#  by default) after that.  One wildcard subscription brings in the topics of every
+#  device; they are decoded here and handed to the node of the device on the device
+#  loop, like the CoIoT pushes.
+#
+#  While a device keeps publishing it is not polled, and its commands go out on its
+#  /command and /set topics.  Once it stops publishing, its online topic says it is
+#  gone or the broker connection drops, it is polled and commanded over HTTP again.
+#
+
+import asyncio
+import json
+import time
+from typing import Any, Dict, Optional
+
+import paho.mqtt.client as mqtt
+
+from Node_Shared import *
+
+MQTT_TOPIC_ROOT   = 'shellies/'
+MQTT_SUBSCRIPTION = MQTT_TOPIC_ROOT + '#'
+MQTT_DEFAULT_PORT = 1883
+MQTT_KEEPALIVE    = 60   # seconds
+MQTT_VALID_FOR    = 75   # seconds a device counts as publishing after its last message, it publishes every 30 s at least
+MQTT_CLIENT_ID    = 'udi-shelly-nodeserver'
+
+# status values the nodes use, from the color/N/status and white/N/status JSON
+_STATUS_KEYS = ('ison', 'red', 'green', 'blue', 'white', 'gain', 'brightness', 'effect', 'transition', 'power')
+
+_OUTPUT_TOPICS = ('relay', 'color', 'white')
+
+
+class MqttMessage:
+    """A decoded shellies/ message"""
+    def __init__(self, topic_id: str, device_id: str, channel: int, state: Dict[str, Any]):
+        self.topic_id  = topic_id   # <model>-<device id>, as the device names itself in its topics
+        self.device_id = device_id
+        self.channel   = channel
+        self.state     = state
+
+    def __str__(self):
+        return "MQTT: topic_id=" + str(self.topic_id) + ",  channel=" + str(self.channel) + ",  state=" + str(self.state)
+
+
+def parse_mqtt_message(topic: str, payload: bytes) -> Optional[MqttMessage]:
+    """Decode a message on a shellies/ topic.  Returns None for the topics the nodes don't use."""
+    parts = topic.split('/')
+    if len(parts) < 3 or parts[0] + '/' != MQTT_TOPIC_ROOT:
+        return None
+    topic_id = parts[1]
+    device_id = topic_id[topic_id.rfind('-') + 1:].upper()
+    rest = parts[2:]
+    text = payload.decode('utf-8', errors='replace')
+
+    if rest == ['online']:
+        return MqttMessage(topic_id, device_id, 0, {'online': text == 'true'})
+    if len(rest) < 2 or not rest[1].isdigit():
+        return None
+    channel = int(rest[1])
+    if rest[0] == 'relay' and len(rest) == 2:
+        if text not in ('on', 'off'):
+            return None  # overpower etc.
+        return MqttMessage(topic_id, device_id, channel, {'ison': text == 'on'})
+    if rest[0] in ('color', 'white') and rest[2:] == ['status']:
+        status = json.loads(text)
+        return MqttMessage(topic_id, device_id, channel, {key: status[key] for key in _STATUS_KEYS if key in status})
+    if rest[0] in _OUTPUT_TOPICS and rest[2:] == ['power']:
+        return MqttMessage(topic_id, device_id, channel, {'power': float(text)})
+    if rest[0] in _OUTPUT_TOPICS and rest[2:] == ['energy']:
+        return MqttMessage(topic_id, device_id, channel, {'energy': float(text) / 60.0})  # Wmin to Wh
+    return None
+
+
+class MqttLink:
+    """The MQTT side of one device, its commands go over it while it is publishing"""
+
+    def __init__(self, listener: 'MqttListener'):
+        self._listener = listener
+        self.topic_id: Optional[str] = None  # from the first message of the device
+        self.last_seen = 0.0
+        self.messages = 0
+        self.commands = 0
+
+    @property
+    def live(self) -> bool:
+        """The device is publishing, so there is no need to poll it"""
+        return (self.topic_id is not None and self._listener.connected
+                and time.monotonic() - self.last_seen < MQTT_VALID_FOR)
+
+    def seen(self, topic_id: str) -> None:
+        self.topic_id = topic_id
+        self.last_seen = time.monotonic()
+        self.messages += 1
+
+    def lost(self) -> None:
+        """The device went away (its online topic), poll it again"""
+        self.last_seen = 0.0
+
+    def publish(self, subtopic: str, payload: str) -> None:
+        """Send to a topic of the device, e.g. relay/0/command"""
+        self.commands += 1
+        self._listener.publish(MQTT_TOPIC_ROOT + self.topic_id + '/' + subtopic, payload)
+
+
+class MqttListener:
+    """Subscribes to the shellies/ topics on a broker and pushes the decoded state to the registered nodes"""
+
+    def __init__(self):
+        self._client = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._nodes_by_id = {}
+        self.connected = False
+        self.messages_received = 0
+        self.messages_dropped = 0
+
+    def register(self, node: Any, device_id: str) -> None:
+        """Send the messages of the device with device_id to node, and let its device send commands over MQTT"""
+        self._nodes_by_id[device_id.upper()] = node
+        if getattr(node.shelly_device, 'mqtt', None) is None:
+            node.shelly_device.mqtt = MqttLink(self)
+
+    def unregister(self, node: Any) -> None:
+        for key in [k for k, v in self._nodes_by_id.items() if v is node]:
+            del self._nodes_by_id[key]
+        node.shelly_device.mqtt = None
+
+    def start(self, loop: asyncio.AbstractEventLoop, host: str, port: int = MQTT_DEFAULT_PORT, user: str = None, password: str = None) -> None:
+        """Connect to the broker in the background, reconnecting whenever the connection drops"""
+        self.stop()
+        self._loop = loop
+        try:
+            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=MQTT_CLIENT_ID)
+        except AttributeError:
+            client = mqtt.Client(client_id=MQTT_CLIENT_ID)  # paho-mqtt 1.x
+        if user:
+            client.username_pw_set(user, password)
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_message = self._on_message
+        client.connect_async(host, port, MQTT_KEEPALIVE)
+        client.loop_start()
+        self._client = client
+        LOGGER.info('MQTT: connecting to %s:%d', host, port)
+
+    def stop(self) -> None:
+        if self._client is None:
+            return
+        client, self._client = self._client, None
+        self.connected = False
+        client.disconnect()
+        client.loop_stop()
+
+    def publish(self, topic: str, payload: str) -> None:
+        if self._client is not None:
+            self._client.publish(topic, payload)
+
+    #
+    # paho callbacks, on the paho network thread
+    #
+    def _on_connect(self, client, userdata, flags, reason, *args) -> None:
+        failed = reason.is_failure if hasattr(reason, 'is_failure') else reason != 0
+        if failed:
+            LOGGER.error('MQTT: broker refused the connection: %s', str(reason))
+            return
+        self.connected = True
+        client.subscribe(MQTT_SUBSCRIPTION)
+        LOGGER.info('MQTT: connected, subscribed to %s', MQTT_SUBSCRIPTION)
+
+    def _on_disconnect(self, client, userdata, *args) -> None:
+        if self.connected:
+            LOGGER.warning('MQTT: disconnected from the broker, polling the devices until it is back')
+        self.connected = False
+
+    def _on_message(self, client, userdata, message) -> None:
+        self._loop.call_soon_threadsafe(self._received, message.topic, message.payload)
+
+    #
+    # Private functions, on the device loop
+    #
+    def _received(self, topic: str, payload: bytes) -> None:
+        try:
+            message = parse_mqtt_message(topic, payload)
+        except Exception as ex:
+            LOGGER.debug('MQTT: bad message on %s: %s', topic, str(ex))
+            self.messages_dropped += 1
+            return
+        if message is None:
+            return  # a topic the nodes don't use, e.g. a command or announce
+        node = self._nodes_by_id.get(message.device_id)
+        if node is None:
+            self.messages_dropped += 1
+            return
+        self.messages_received += 1
+        LOGGER.debug('MQTT: %s', str(message))
+        link = node.shelly_device.mqtt
+        if 'online' in message.state:
+            if not message.state['online']:
+                link.lost()
+            return
+        link.seen(message.topic_id)
+        node.pushReceived(message.state, MQTT_VALID_FOR, message.channel)
@@ -0,0 +1,288 @@
+#
+#
+#  Multi Channel Node Classes
+#
+#  A device with several outputs (Shelly 2.5, 4Pro, RGBW2 in white mode) is one
+#  MultiChannel_Node, polled like any other device node, and one channel node per
+#  output under it.  A poll reads /status once and hands each channel node its
+#  part, so a device costs the same requests however many channels it has.
+#
+
+import time
+import udi_interface
+from ShellyDevice_RGBW2 import LED_COLOR
+from ShellyDevice_Base import DeviceConnectorError
+from ShellyDevice_Constants import POWER_STATE
+from ShellyDevice_Stats import LatencyHistogram
+from Power_Meter import PowerMeter
+
+from  Node_Shared import *
+
+
+def channel_address(isy_address: str, channel: int) -> str:
+    """ISY address of a channel node, device addresses start with 's' so these can't clash with them"""
+    return 'c' + str(channel) + isy_address[1:]
+
+
+class RelayChannel_Node(udi_interface.Node):
+    """One relay of a multi channel device, commands go to the device of its MultiChannel_Node"""
+    def __init__(self, polyglot, device_node, channel):
+        super(RelayChannel_Node, self).__init__(polyglot, device_node.address, channel_address(device_node.address, channel),
+                                                device_node.name + ' ' + str(channel + 1))
+        self.device_node = device_node
+        self.channel = channel
+        self.driver_cache = DriverCache(self, device_node.driver_cache)
+        self.meter = PowerMeter()  # the device has a meter per output
+
+    @property
+    def shelly_device(self):
+        return self.device_node.shelly_device
+
+    def channelReceived(self, state):
+        """This channel's part of the device status"""
+        self.driver_cache.set('ST',    1 if state.on else 0)
+        self.driver_cache.set('GV19',  1)
+        self.meterReceived(state.power, state.energy)
+
+    def channelPushed(self, state):
+        """The values of this channel the device pushed (MQTT)"""
+        if 'ison' in state:
+            self.driver_cache.set('ST',    1 if state['ison'] else 0)
+        self.driver_cache.set('GV19',  1)
+        self.meterReceived(state.get('power'), state.get('energy'))
+
+    def meterReceived(self, power, energy):
+        """The reading of this channel's meter, either value may be None"""
+        if self.meter.add(power, energy):
+            for driver, value in self.meter.drivers().items():
+                self.driver_cache.set(driver, value)
+
+    def actionReceived(self, event):
+        """An action URL call from the device for this channel"""
+        if event in ACTION_OUTPUT:
+            self.driver_cache.set('ST',    ACTION_OUTPUT[event])
+            self.driver_cache.set('GV19',  1)
+        if event in ACTION_CONTROL:
+            self.reportCmd(ACTION_CONTROL[event])
+
+    def commandResult(self, state):
+        """The device answers with the resulting channel state, None if it did not answer in time"""
+        if state is not None:
+            self.channelReceived(state)
+
+    def sceneRequest(self, target):
+        """The request for a scene command, used by the scene dispatcher.  A color target only switches the channel."""
+        if not isinstance(target, POWER_STATE):
+            if getattr(target, 'on', None) is None:
+                return None
+            target = POWER_STATE.On if target.on else POWER_STATE.Off
+        return self.shelly_device.async_device_set_on_state(target, None, self.channel)
+
+    def statusFailed(self, ex):
+        if isinstance(ex, DeviceConnectorError):
+            self.driver_cache.set('GV19',  0)
+            self.driver_cache.set('ST',    0 )
+            self.driver_cache.set('CPW',   0)
+            self.driver_cache.set('GV20',  0)
+        else:
+            LOGGER.error('Node: %s: %s', self.name, str(ex))
+
+    def sendCommand(self, target):
+        """Send target through the scene dispatcher if there is one, straight to the device otherwise"""
+        self.device_node.commandReceived()
+        dispatcher = self.device_node.scene_dispatcher
+        if dispatcher is not None:
+            dispatcher.submit(self, target)
+            return
+        try:
+            self.commandResult(self.shelly_device._run(self.sceneRequest(target)))
+        except Exception as ex:
+            LOGGER.error('Node: %s: %s', self.name, str(ex))
+
+    def on_DON(self, command):
+        LOGGER.debug('Node: on_DON() called')
+        self.sendCommand(POWER_STATE.On)
+
+    def on_DOF(self, command):
+        LOGGER.debug('Node: on_DOF() called')
+        self.sendCommand(POWER_STATE.Off)
+
+    def On_Query(self, command):
+        LOGGER.debug('Node: On_Query() called')
+        self.driver_cache.force_refresh()
+        self.device_node.updateStatuses()
+
+    drivers = [{'driver': 'ST',   'value': 0, 'uom': ISY_UOM_2_BOOL},    # Status = Relay On State
+               {'driver': 'GV19', 'value': 0, 'uom': ISY_UOM_2_BOOL},      # Online/Offline
+               {'driver': 'CPW',  'value': 0, 'uom': ISY_UOM_73_WATT},     # Power
+               {'driver': 'TPW',  'value': 0, 'uom': ISY_UOM_33_KWH},      # Energy, the device's counter
+               {'driver': 'GV20', 'value': 0, 'uom': ISY_UOM_73_WATT},     # Power change per minute
+               {'driver': 'GV21', 'value': 0, 'uom': ISY_UOM_33_KWH},      # Energy today
+              ]
+
+    id = "Shelly1Device"
+    hint = '0x02000000'  #https://wiki.universal-devices.com/index.php?title=Node_Hints_Documentation
+    commands = {
+                    'DON': on_DON,
+                    'DOF': on_DOF,
+                    'QUERY': On_Query,
+                }
+
+
+class WhiteChannel_Node(RelayChannel_Node):
+    """One dimmable channel of an RGBW2 in white mode"""
+
+    def channelReceived(self, state):
+        self.driver_cache.set('ST',    1 if state.on else 0)
+        self.driver_cache.set('GV14',  state.brightness)
+        self.driver_cache.set('GV19',  1)
+        self.meterReceived(state.power, state.energy)
+
+    def channelPushed(self, state):
+        if 'brightness' in state:
+            self.driver_cache.set('GV14',  state['brightness'])
+        super(WhiteChannel_Node, self).channelPushed(state)
+
+    def sceneRequest(self, target):
+        """On/off, or the on state and brightness of a color target"""
+        if isinstance(target, POWER_STATE):
+            if target == POWER_STATE.Toggle:
+                return self.shelly_device.async_device_set_on_state(target, None, self.channel)
+            target = LED_COLOR(on=(target == POWER_STATE.On))
+        if target.on is None and target.brightness is None:
+            return None
+        return self.shelly_device.async_device_set_white(target, self.channel)
+
+    def statusFailed(self, ex):
+        if isinstance(ex, DeviceConnectorError):
+            self.driver_cache.set('GV14',  0)
+        super(WhiteChannel_Node, self).statusFailed(ex)
+
+    def On_Brightness(self, command):
+        try:
+            query  = command.get('query')
+            self.sendCommand(LED_COLOR(brightness=int(query.get('BRSB.uom78'))))
+        except Exception as ex:
+            LOGGER.error('On_BRT: %s', str(ex))
+
+    drivers = [{'driver': 'ST',   'value': 0, 'uom': ISY_UOM_2_BOOL},    # Status = Channel On State
+               {'driver': 'GV14', 'value': 0, 'uom': ISY_UOM_78_0TO100_ONOFF},   # Brightness
+               {'driver': 'GV19', 'value': 0, 'uom': ISY_UOM_2_BOOL},      # Online/Offline
+               {'driver': 'CPW',  'value': 0, 'uom': ISY_UOM_73_WATT},     # Power
+               {'driver': 'TPW',  'value': 0, 'uom': ISY_UOM_33_KWH},      # Energy, the device's counter
+               {'driver': 'GV20', 'value': 0, 'uom': ISY_UOM_73_WATT},     # Power change per minute
+               {'driver': 'GV21', 'value': 0, 'uom': ISY_UOM_33_KWH},      # Energy today
+              ]
+
+    id = "WhiteChannel"
+    hint = '0x01020000'  #https://wiki.universal-devices.com/index.php?title=Node_Hints_Documentation
+    commands = {
+                    'DON': RelayChannel_Node.on_DON,
+                    'DOF': RelayChannel_Node.on_DOF,
+                    'QUERY': RelayChannel_Node.On_Query,
+                    'SET_BRIGHTNESS': On_Brightness,
+                }
+
+
+class MultiChannel_Node(udi_interface.Node):
+    """
+    The physical device, polled by the controller.  Its channels are separate nodes in
+    self.channels, added to PG3 after this one.
+    """
+    def __init__(self, polyglot, primary, isy_address, device_address, device_name, device, channel_class):
+        super(MultiChannel_Node, self).__init__(polyglot, primary, isy_address, device_name)
+        LOGGER.debug("Node: Init Node " + device_name + " ("+ device_address + ")")
+
+        self.device_addr = device_address
+        self.queryON = True
+        self.shelly_device = device
+        self.push = PushTracker()
+        self.driver_cache = DriverCache(self)
+        self.poll_scheduler = None  # set by the controller
+        self.scene_dispatcher = None  # set by the controller
+        self.last_command = 0.0
+        self.update_time = LatencyHistogram()  # fetching a status and applying it to the drivers
+        self.channels = [channel_class(polyglot, self, channel) for channel in range(device.channel_count)]
+
+        polyglot.subscribe(polyglot.START, self.start, isy_address)
+
+    def start(self):
+        LOGGER.debug('Node: Start called for node ' + self.name + ' (' + self.address + ')')
+        if self.poll_scheduler is not None:
+            self.poll_scheduler.poll_now([self])
+        else:
+            self.updateStatuses()
+
+    def updateStatuses(self):
+        LOGGER.debug('Node: updateStatuses() called for  %s (%s)', self.name, self.address)
+        start = time.perf_counter()
+        try :
+            states = self.shelly_device.get_status_channel_states()
+        except Exception as ex :
+            self.statusFailed(ex)
+        else:
+            self.statusReceived(states)
+        self.update_time.observe(time.perf_counter() - start)
+
+    async def fetchStatus(self, full: bool = False):
+        """Every channel comes from the one /status, so a poll is always a full one"""
+        return await self.shelly_device.async_get_status_channel_states()
+
+    def statusReceived(self, states):
+        if states is None:
+            LOGGER.debug('Node: %s did not answer in time, keeping the last state', self.name)
+            return
+        try :
+            if len(states) < len(self.channels):
+                raise ValueError('device reports ' + str(len(states)) + ' channels, expected ' + str(len(self.channels)))
+            self.driver_cache.set('GV19',  1)
+            for channel, state in zip(self.channels, states):
+                channel.channelReceived(state)
+            startup_timer.reported(self.address)
+        except Exception as ex :
+            self.statusFailed(ex)
+
+    def statusFailed(self, ex):
+        if isinstance(ex, DeviceConnectorError):
+            self.driver_cache.set('GV19',  0)
+            for channel in self.channels:
+                channel.statusFailed(ex)
+        else:
+            LOGGER.error('Node: updateStatuses: %s', str(ex))
+
+    def pushReceived(self, state, valid_for, channel = 0):
+        """State of one channel pushed by the device (MQTT)"""
+        if not 0 <= channel < len(self.channels):
+            return
+        self.push.received(valid_for)
+        self.driver_cache.set('GV19',  1)
+        self.channels[channel].channelPushed(state)
+        startup_timer.reported(self.address)
+
+    def actionReceived(self, event, channel):
+        """An action URL call from the device, for one of the channels"""
+        if not 0 <= channel < len(self.channels):
+            return
+        if event in ACTION_OUTPUT:
+            self.driver_cache.set('GV19',  1)
+        self.channels[channel].actionReceived(event)
+
+    def commandReceived(self):
+        """Let the poll scheduler know the device is active, so it is polled at the full rate"""
+        self.last_command = time.monotonic()
+        if self.poll_scheduler is not None:
+            self.poll_scheduler.poke(self)
+
+    def On_Query(self, command):
+        LOGGER.debug('Node: On_Query() called')
+        self.driver_cache.force_refresh()
+        self.updateStatuses()
+
+    drivers = [{'driver': 'GV19', 'value': 0, 'uom': ISY_UOM_2_BOOL},      # Online/Offline
+              ]
+
+    id = "MultiChannelDevice"
+    hint = '0x02000000'  #https://wiki.universal-devices.com/index.php?title=Node_Hints_Documentation
+    commands = {
+                    'QUERY': On_Query,
+                }
@@ -1,17 +1,164 @@
 
 import udi_interface
 import logging
+import threading
+import time
 
 LOGGER = udi_interface.LOGGER
 
 
 # constants for ISY Nodeserver interface
 ISY_UOM_2_BOOL = 2 
+ISY_UOM_14_DEGREES = 14
 ISY_UOM_25_INDEX = 25 
+ISY_UOM_26_KELVIN = 26
+ISY_UOM_33_KWH = 33
 ISY_UOM_42_MILLISECOND = 42
+ISY_UOM_51_PERCENT = 51
 ISY_UOM_56_RAW = 56 
 ISY_UOM_58_SECONDS = 58 
 ISY_UOM_70_USER = 70
 ISY_UOM_73_WATT = 73 
 ISY_UOM_78_0TO100_ONOFF = 78 
 ISY_UOM_100_BYTE = 100
+
+# Gen1 action URL events (see Action_Receiver): the output state they report, and the control they send to ISY
+ACTION_OUTPUT  = {'out_on': 1, 'out_off': 0}
+ACTION_CONTROL = {'btn_on': 'DON', 'btn_off': 'DOF', 'shortpush': 'DON', 'longpush': 'DFON'}
+
+
+class PushTracker:
+    """Tracks whether a device is currently pushing its state to us (CoIoT etc.)"""
+    def __init__(self):
+        self.expires = 0.0
+        self.count = 0
+        self.subscribed = False  # the device calls us on every change (action URLs), it is pushing for as long as that is set up
+
+    def received(self, valid_for: float):
+        """A push arrived that the device says is good for valid_for seconds"""
+        self.expires = max(self.expires, time.monotonic() + valid_for)
+        self.count += 1
+
+    @property
+    def active(self) -> bool:
+        return self.subscribed or time.monotonic() < self.expires
+
+
+class DriverCache:
+    """Remembers the last value reported for each driver of a node so only real changes are sent to PG3/ISY"""
+    def __init__(self, node, parent: 'DriverCache' = None):
+        self._node = node
+        self._last = {}
+        self._parent = parent  # cache of the device node, for channel nodes, it counts their updates too
+        self._children = []
+        if parent is not None:
+            parent._children.append(self)
+        self.sent = 0
+        self.suppressed = 0
+
+    def set(self, driver: str, value) -> bool:
+        """Report the driver if its value changed.  Returns True if it was sent."""
+        if driver in self._last and self._last[driver] == value:
+            self._count('suppressed')
+            return False
+        batch = getattr(_thread_batch, 'batch', None)
+        if batch is not None:
+            self._node.setDriver(driver, value, report=False)
+            batch.add(self._node, driver, value)
+        elif driver in self._last:
+            self._node.setDriver(driver, value)
+        else:
+            # first report since start or a forced refresh, make sure ISY gets it
+            self._node.setDriver(driver, value, force=True)
+        self._last[driver] = value
+        self._count('sent')
+        return True
+
+    def prime(self, driver: str, value):
+        """The value ISY already has for the driver, e.g. restored after a restart, so it is not sent again"""
+        self._last[driver] = value
+
+    def force_refresh(self):
+        """Forget the reported values so the next update sends every driver, of the channel nodes too"""
+        self._last.clear()
+        for child in self._children:
+            child.force_refresh()
+
+    def _count(self, counter: str):
+        cache = self
+        while cache is not None:
+            setattr(cache, counter, getattr(cache, counter) + 1)
+            cache = cache._parent
+
+
+_thread_batch = threading.local()  # .batch is the DriverBatch collecting the updates made on this thread, if any
+
+
+class DriverBatch:
+    """
+    Driver updates of several nodes, reported to PG3 in one message.  Only the updates made
+    on the thread that is inside the with block are collected, other threads updating the
+    same nodes at the same time report theirs straight away as usual.
+    """
+    def __init__(self, poly):
+        self._poly = poly
+        self._updates = []
+
+    def __enter__(self) -> 'DriverBatch':
+        _thread_batch.batch = self
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        _thread_batch.batch = None
+        self.send()
+
+    def add(self, node, driver: str, value):
+        for entry in node.drivers:
+            if entry['driver'] == driver:
+                self._updates.append({'address': node.address, 'driver': driver, 'value': str(value),
+                                      'uom': entry['uom'], 'text': entry.get('text')})
+                break
+
+    def send(self) -> int:
+        """Report the collected drivers, returns how many were sent"""
+        if not self._updates:
+            return 0
+        self._poly.send({'set': self._updates}, 'status')
+        count = len(self._updates)
+        self._updates = []
+        return count
+
+
+class StartupTimer:
+    """Measures the time from the nodeserver starting to its device nodes first reporting a status"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = None
+        self._expected = set()
+        self._reported = set()
+
+    def start(self):
+        with self._lock:
+            self._start = time.monotonic()
+            self._expected.clear()
+            self._reported.clear()
+
+    def expect(self, address: str):
+        """A node was created that should report in"""
+        with self._lock:
+            self._expected.add(address)
+
+    def reported(self, address: str):
+        """The node has its first status from the device"""
+        with self._lock:
+            if self._start is None or address in self._reported:
+                return
+            self._reported.add(address)
+            elapsed = time.monotonic() - self._start
+            if len(self._reported) == 1:
+                LOGGER.info('Startup: first device status after %.2f seconds (%s)', elapsed, address)
+            if self._expected and self._expected <= self._reported:
+                LOGGER.info('Startup: all %d devices reported status after %.2f seconds', len(self._reported), elapsed)
+                self._start = None
+
+startup_timer = StartupTimer()
@@ -0,0 +1,206 @@
+#
+#
+#  Poll Scheduler
+#
+#  Fans the shortPoll status requests for all the device nodes out on the shared
+#  device loop, so a cycle takes as long as the slowest device instead of the sum
+#  of all of them.
+#
+#  Each node has its own poll interval, in multiples of the shortPoll:
+#    - offline devices back off exponentially (with jitter) up to MAX_OFFLINE_BACKOFF
+#    - devices that were just commanded or just changed are polled every shortPoll
+#    - devices that have been stable for a while are polled less often
+#    - devices pushing their state (CoIoT etc.) only get a slow liveness poll
+#    - devices publishing their state to MQTT are not polled until they stop
+#
+
+import asyncio
+import random
+import time
+from typing import Any, List
+
+from Node_Shared import *
+from ShellyDevice_Base import DeviceConnectorError, DeviceAuthError
+from ShellyDevice_Loop import ShellyDevice_Loop
+from ShellyDevice_Stats import LatencyHistogram, CYCLE_BUCKETS
+
+DEFAULT_MAX_CONCURRENT = 16
+DEFAULT_BASE_INTERVAL  = 5.0  # seconds, until the real shortPoll has been seen
+PUSH_LIVENESS_INTERVAL = 60   # seconds between polls of a device that is pushing its state to us
+MAX_OFFLINE_BACKOFF    = 300  # seconds, longest wait between retries of an offline device
+BACKOFF_JITTER         = 0.2  # +/- fraction, so devices that dropped together don't retry together
+RECENT_ACTIVITY        = 60   # seconds after a command or change that a device is polled every shortPoll
+STABLE_POLLS_PER_STEP  = 6    # unchanged polls before the interval doubles
+MAX_STABLE_FACTOR      = 4    # stable devices are polled at least every this many shortPolls
+POLL_NOW_WINDOW        = 0.05 # seconds poll_now() requests are collected for, the nodes starting up after a restart are polled together
+
+
+class _NodePollState:
+    """Poll schedule of one node"""
+    def __init__(self):
+        self.next_due = 0.0
+        self.failures = 0
+        self.stable_polls = 0
+        self.last_change = 0.0
+
+
+class PollScheduler:
+    """Polls a set of device nodes concurrently, with a cap on the number of requests in flight"""
+
+    def __init__(self, device_loop: ShellyDevice_Loop, max_concurrent: int = DEFAULT_MAX_CONCURRENT):
+        self._device_loop = device_loop
+        self._max_concurrent = max_concurrent
+        self._cycle = None
+        self._states = {}
+        self._last_tick = None
+        self._poll_now = {}
+        self._poll_now_timer = None
+        self.base_interval = DEFAULT_BASE_INTERVAL
+        self.full_every_cycle = False  # read /settings or /status every cycle instead of just the output channel
+        self.cycle_time = LatencyHistogram(CYCLE_BUCKETS)  # duration of the scheduled poll cycles
+
+    @property
+    def max_concurrent(self) -> int:
+        return self._max_concurrent
+
+    @max_concurrent.setter
+    def max_concurrent(self, value: int):
+        self._max_concurrent = max(1, int(value))
+
+    @property
+    def busy(self) -> bool:
+        """True while a poll cycle is still running"""
+        return self._cycle is not None and not self._cycle.done()
+
+    def poll(self, nodes: List[Any], force: bool = False, full: bool = False) -> None:
+        """
+        Start a poll cycle for the nodes that are due, without waiting for it to finish.  force
+        polls every node regardless of its schedule, and full reads the whole device settings/status.
+        """
+        if self.busy:
+            LOGGER.warning('PollScheduler: previous poll cycle still running, skipping this one')
+            return
+        self._cycle = self._device_loop.submit(self._tick(nodes, force, full or self.full_every_cycle))
+
+    def poll_now(self, nodes: List[Any]) -> None:
+        """
+        Poll the nodes straight away, outside the regular cycle, without waiting for the answers.
+        Nodes asked for within POLL_NOW_WINDOW of each other are polled in one go.
+        """
+        self._device_loop.loop.call_soon_threadsafe(self._queue_poll_now, nodes)
+
+    def poke(self, node: Any) -> None:
+        """A command was sent to the node, poll it at the full rate again and re-probe it now if it was offline"""
+        self._device_loop.loop.call_soon_threadsafe(self._poke, node)
+
+    async def async_poll(self, nodes: List[Any], full: bool = False) -> float:
+        """Poll all the nodes, applying each result as it arrives.  Returns the cycle time in seconds."""
+        devices = [node.shelly_device for node in nodes]
+        bytes_before = sum(device.bytes_received for device in devices)
+        parse_before = sum(device.parse_seconds for device in devices)
+        start = time.monotonic()
+        semaphore = asyncio.Semaphore(self._max_concurrent)
+        await asyncio.gather(*[self._poll_node(node, semaphore, full) for node in nodes])
+        elapsed = time.monotonic() - start
+        LOGGER.debug('PollScheduler: polled %d nodes (%s) in %.3f seconds, %d bytes received, %.2f ms parsing',
+                     len(nodes), 'full' if full else 'channel', elapsed,
+                     sum(device.bytes_received for device in devices) - bytes_before,
+                     (sum(device.parse_seconds for device in devices) - parse_before) * 1000.0)
+        return elapsed
+
+    #
+    # Private functions, these all run on the device loop
+    #
+    async def _tick(self, nodes: List[Any], force: bool, full: bool) -> float:
+        now = time.monotonic()
+        if not force:
+            # the shortPoll ticks set the base interval, forced (longPoll) ones don't count
+            if self._last_tick is not None and now - self._last_tick > 0.5:
+                self.base_interval = now - self._last_tick
+            self._last_tick = now
+
+        # anything due before the next tick is polled on this one
+        horizon = now + self.base_interval / 2
+        due = [node for node in nodes if force or (self._state(node).next_due <= horizon and not self._publishing(node))]
+        elapsed = await self.async_poll(due, full)
+        if due:
+            self.cycle_time.observe(elapsed)
+        return elapsed
+
+    def _state(self, node: Any) -> _NodePollState:
+        state = self._states.get(node.address)
+        if state is None:
+            state = _NodePollState()
+            self._states[node.address] = state
+        return state
+
+    @staticmethod
+    def _publishing(node: Any) -> bool:
+        """The device is publishing its state to the MQTT broker, it only needs polling once it stops"""
+        link = getattr(node.shelly_device, 'mqtt', None)
+        return link is not None and link.live
+
+    def _queue_poll_now(self, nodes: List[Any]) -> None:
+        for node in nodes:
+            self._poll_now[node.address] = node
+        if self._poll_now_timer is None:
+            self._poll_now_timer = self._device_loop.loop.call_later(POLL_NOW_WINDOW, self._flush_poll_now)
+
+    def _flush_poll_now(self) -> None:
+        self._poll_now_timer = None
+        nodes, self._poll_now = list(self._poll_now.values()), {}
+        self._device_loop.spawn(self.async_poll(nodes))
+
+    def _poke(self, node: Any) -> None:
+        state = self._state(node)
+        state.stable_polls = 0
+        state.next_due = 0.0
+        if state.failures > 0:
+            state.failures = 0
+            node.shelly_device.reachability.recheck()
+            self._device_loop.spawn(self.async_poll([node]))
+
+    def _reschedule(self, node: Any, online: bool, changed: bool) -> None:
+        state = self._state(node)
+        now = time.monotonic()
+        if not online:
+            state.failures += 1
+            state.stable_polls = 0
+            interval = min(self.base_interval * (2 ** state.failures), MAX_OFFLINE_BACKOFF)
+            interval *= random.uniform(1.0 - BACKOFF_JITTER, 1.0 + BACKOFF_JITTER)
+        else:
+            state.failures = 0
+            if changed:
+                state.last_change = now
+            push = getattr(node, 'push', None)
+            last_command = getattr(node, 'last_command', 0.0)
+            if push is not None and push.active:
+                interval = PUSH_LIVENESS_INTERVAL
+            elif now - max(state.last_change, last_command) < RECENT_ACTIVITY:
+                state.stable_polls = 0
+                interval = self.base_interval
+            else:
+                state.stable_polls += 1
+                interval = self.base_interval * min(2 ** (state.stable_polls // STABLE_POLLS_PER_STEP), MAX_STABLE_FACTOR)
+        state.next_due = now + interval
+
+    async def _poll_node(self, node: Any, semaphore: asyncio.Semaphore, full: bool) -> None:
+        sent_before = node.driver_cache.sent
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                status = await node.fetchStatus(full)
+            except Exception as ex:
+                node.statusFailed(ex)
+                self._update_done(node, start)
+                # a device that refuses our login backs off like an offline one, rather than failing every poll
+                self._reschedule(node, online=not isinstance(ex, (DeviceConnectorError, DeviceAuthError)), changed=False)
+                return
+        node.statusReceived(status)
+        self._update_done(node, start)
+        self._reschedule(node, online=status is not None, changed=node.driver_cache.sent > sent_before)
+
+    def _update_done(self, node: Any, start: float) -> None:
+        update_time = getattr(node, 'update_time', None)
+        if update_time is not None:
+            update_time.observe(time.perf_counter() - start)
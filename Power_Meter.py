@@ -0,0 +1,174 @@
+#
+#
+#  Power Meter
+#
+#  The power and energy readings the devices already send (meters[N] in /status,
+#  power in the color/0 answer, and the power and energy CoIoT, MQTT and Gen2 pushes),
+#  kept for each metered output in fixed size ring buffers backed by arrays: the
+#  recent samples at full resolution, and older ones downsampled to min/avg/max per
+#  HISTORY_BUCKET seconds.  The rate of change and the energy used today, which the
+#  nodes show as drivers, are worked out from them.
+#
+#  A meter is about 7 KB however often it is fed (RECENT_SAMPLES of 12 bytes and
+#  HISTORY_BUCKETS of 16 bytes, and the objects around them), 3.4 MB for 500.
+#
+
+import time
+from array import array
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+RECENT_SAMPLES  = 64    # full resolution samples, half an hour at the stable poll rate
+HISTORY_BUCKET  = 300   # seconds per downsampled min/avg/max bucket
+HISTORY_BUCKETS = 288   # a day of buckets
+RATE_WINDOW     = 300   # seconds of recent samples the rate of change is fitted over
+MAX_GAP         = 900   # seconds, power is not integrated across a longer gap (the device was offline)
+
+
+class RingBuffer:
+    """
+    A fixed number of rows, one array per column with the given typecodes, the oldest
+    row is overwritten first.  Nothing is allocated after construction.
+    """
+    __slots__ = ('size', 'count', 'columns', '_next')
+
+    def __init__(self, size: int, *typecodes: str):
+        self.size = size
+        self.count = 0
+        self.columns = tuple(array(typecode, bytes(array(typecode).itemsize * size)) for typecode in typecodes)
+        self._next = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, *values: float) -> None:
+        index = self._next
+        for column, value in zip(self.columns, values):
+            column[index] = value
+        self._next = (index + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def indexes(self) -> Iterator[int]:
+        """The array index of each row, newest first"""
+        for offset in range(1, self.count + 1):
+            yield (self._next - offset) % self.size
+
+    def rows(self) -> Iterator[Tuple[float, ...]]:
+        """The rows, oldest first"""
+        for index in reversed(list(self.indexes())):
+            yield tuple(column[index] for column in self.columns)
+
+    def nbytes(self) -> int:
+        return sum(column.itemsize * len(column) for column in self.columns)
+
+
+class PowerMeter:
+    """The power and energy history of one metered output, on the thread that feeds its node"""
+
+    def __init__(self):
+        self.recent  = RingBuffer(RECENT_SAMPLES, 'd', 'f')               # time, W
+        self.history = RingBuffer(HISTORY_BUCKETS, 'I', 'f', 'f', 'f')   # bucket number, min, avg, max W
+        self.power: Optional[float] = None   # W, last reading
+        self.energy: Optional[float] = None  # Wh, the device's energy counter, None if it has none
+        self.day: Optional[str] = None       # local date the today total is for
+        self.today = 0.0                     # Wh used today
+        self._bucket = None                  # the bucket being filled: number, min, max, sum, count
+        self._last_time = None
+
+    def add(self, power: float = None, energy: float = None, now: float = None) -> bool:
+        """A reading, power in W and the device's energy counter in Wh, either may be None.  Returns True if there was one."""
+        if power is None and energy is None:
+            return False
+        if now is None:
+            now = time.time()
+        day = time.strftime('%Y-%m-%d', time.localtime(now))
+        if day != self.day:
+            self.day = day
+            self.today = 0.0
+        if energy is not None:
+            if self.energy is not None:
+                used = energy - self.energy
+                self.today += used if used >= 0 else energy  # the counter starts again from 0 when the device restarts
+            self.energy = energy
+        elif power is not None and self.energy is None and self.power is not None and 0 < now - self._last_time <= MAX_GAP:
+            # no counter (yet), integrate the power readings instead
+            self.today += (self.power + power) / 2 * (now - self._last_time) / 3600
+        if power is not None:
+            self.power = power
+            self._last_time = now
+            self.recent.append(now, power)
+            self._downsample(now, power)
+        return True
+
+    def rate(self) -> float:
+        """Change of the power in W per minute, the slope of a least squares fit to the last RATE_WINDOW seconds"""
+        times, powers = self.recent.columns
+        newest = None
+        n = sum_t = sum_p = sum_tt = sum_tp = 0.0
+        for index in self.recent.indexes():
+            if newest is None:
+                newest = times[index]
+            t = times[index] - newest  # relative to the newest sample, the epoch times are too big to square precisely
+            if t < -RATE_WINDOW:
+                break
+            p = powers[index]
+            n += 1
+            sum_t += t
+            sum_p += p
+            sum_tt += t * t
+            sum_tp += t * p
+        spread = n * sum_tt - sum_t * sum_t
+        if n < 2 or spread <= 0:
+            return 0.0
+        return (n * sum_tp - sum_t * sum_p) / spread * 60
+
+    def drivers(self) -> Dict[str, Any]:
+        """The node drivers: power CPW (W), energy counter TPW (kWh), rate of change GV20 (W/min) and energy today GV21 (kWh)"""
+        values = {'GV20': round(self.rate(), 1), 'GV21': round(self.today / 1000, 3)}
+        if self.power is not None:
+            values['CPW'] = round(self.power, 1)
+        if self.energy is not None:
+            values['TPW'] = round(self.energy / 1000, 3)
+        return values
+
+    def snapshot(self) -> Dict[str, Any]:
+        """What to keep over a restart, so today's total goes on from where it was"""
+        return {'day': self.day, 'today': round(self.today, 3), 'energy': round(self.energy, 3) if self.energy is not None else None}
+
+    def restore(self, saved: Any) -> None:
+        if not isinstance(saved, dict) or saved.get('day') != time.strftime('%Y-%m-%d'):
+            return
+        self.day = saved['day']
+        self.today = float(saved.get('today') or 0.0)
+        self.energy = saved.get('energy')
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The readings and both buffers, for the stats server"""
+        return {
+            'power': self.power,
+            'energy_wh': self.energy,
+            'today_wh': round(self.today, 3),
+            'rate_w_per_min': round(self.rate(), 3),
+            'recent': [[round(t, 3), round(p, 2)] for t, p in self.recent.rows()],
+            'history': [[int(n) * HISTORY_BUCKET, round(low, 2), round(avg, 2), round(high, 2)] for n, low, avg, high in self.history.rows()],
+        }
+
+    def nbytes(self) -> int:
+        return self.recent.nbytes() + self.history.nbytes()
+
+    #
+    # Private functions
+    #
+    def _downsample(self, now: float, power: float) -> None:
+        number = int(now // HISTORY_BUCKET)
+        bucket = self._bucket
+        if bucket is not None and bucket[0] != number:
+            self.history.append(bucket[0], bucket[1], bucket[3] / bucket[4], bucket[2])
+            bucket = None
+        if bucket is None:
+            self._bucket = [number, power, power, power, 1]
+            return
+        bucket[1] = min(bucket[1], power)
+        bucket[2] = max(bucket[2], power)
+        bucket[3] += power
+        bucket[4] += 1
@@ -4,14 +4,32 @@
 #
 #
 
+import time
 import traceback
 import udi_interface
-from ShellyDevice_RGBW2 import ShellyDevice_RGBW2
+from ShellyDevice_RGBW2 import ShellyDevice_RGBW2, LED_COLOR
 from ShellyDevice_Base import DeviceConnectorError
+from ShellyDevice_Constants import POWER_STATE
+from ShellyDevice_Loop import get_device_loop
+from Command_Queue import ColorCommandQueue
+from ShellyDevice_Stats import LatencyHistogram
+from Power_Meter import PowerMeter
 
 from  Node_Shared import *
 #from device_finder import Device_Finder
 
+# pushed state values that map straight onto a driver
+_PUSH_DRIVERS = {
+    'red'   : 'GV10',
+    'green' : 'GV11',
+    'blue'  : 'GV12',
+    'white' : 'GV13',
+    'gain'  : 'GV14',
+    'transition' : 'GV17',
+    'effect' : 'GV18',
+    }
+_CHANNEL_DRIVERS = (('red', 'GV10'), ('green', 'GV11'), ('blue', 'GV12'), ('white', 'GV13'))
+
 
 class RGBW2_Node(udi_interface.Node):
     """
@@ -30,9 +48,16 @@ class RGBW2_Node(udi_interface.Node):
         self.device_addr = device_address
         self.queryON = True
         self.shelly_device = ShellyDevice_RGBW2(self.device_addr)
+        self.push = PushTracker()
+        self.driver_cache = DriverCache(self)
+        self.poll_scheduler = None  # set by the controller
+        self.scene_dispatcher = None  # set by the controller
+        self.last_command = 0.0
+        self.update_time = LatencyHistogram()  # fetching a status and applying it to the drivers
+        self.meter = PowerMeter()
+        self.color_queue = ColorCommandQueue(self.shelly_device, get_device_loop(), self.statusReceived, self.statusFailed)
 
         polyglot.subscribe(polyglot.START, self.start, isy_address)
-        polyglot.subscribe(polyglot.POLL, self.poll)
 
     def start(self):
         """
@@ -40,82 +65,185 @@ class RGBW2_Node(udi_interface.Node):
         and we get a return result from Polyglot. Only happens once.
         """
         LOGGER.debug('Node: Start called for node ' + self.name + ' (' + self.address + ')')
-        self.updateStatuses() 
-
-    def poll(self, pollflag):
-        if pollflag == 'shortPoll':
+        if self.poll_scheduler is not None:
+            self.poll_scheduler.poll_now([self])
+        else:
             self.updateStatuses()
 
     def updateStatuses(self):
         LOGGER.debug('Node: updateStatuses() called for  %s (%s)', self.name, self.address)
+        start = time.perf_counter()
         try :
-            device_status = self.shelly_device.get_device_settings()
-            if device_status is None:
-                raise DeviceConnectorError
-            red        = device_status['lights'][0]['red']
-            green      = device_status['lights'][0]['green']
-            blue       = device_status['lights'][0]['blue']
-            white      = device_status['lights'][0]['white']
-            brightness = device_status['lights'][0]['gain']
-            is_on       = device_status['lights'][0]['ison']
-            transition = device_status['lights'][0]['transition']
-            effect     = device_status['lights'][0]['effect']
-            on_state = 0
-            if is_on == True:
-                on_state = 1
-
-            LOGGER.debug('Node: LED status = RGBWBr[%s, %s, %s, %s, %s] - OTE[%s, %s, %s]', str(red), str(green), str(blue) ,str(white),str(brightness),str(is_on),str(transition),str(effect))
-
-            self.setDriver('ST',    on_state )
-            self.setDriver('GV10',  red)
-            self.setDriver('GV11',  green)
-            self.setDriver('GV12',  blue)
-            self.setDriver('GV13',  white)
-            self.setDriver('GV14',  brightness)
-            self.setDriver('GV16',  on_state)
-            self.setDriver('GV17',  transition) 
-            self.setDriver('GV18',  effect) 
-            self.setDriver('GV19',  1)  #Online/Offline
-
-        except DeviceConnectorError as ex :
-            LOGGER.debug('Node: Exception connection error, statuses set to 0')
-            self.setDriver('ST',    0 )
-            self.setDriver('GV10',  0)
-            self.setDriver('GV11',  0)
-            self.setDriver('GV12',  0)
-            self.setDriver('GV13',  0)
-            self.setDriver('GV14',  0)
-            self.setDriver('GV16',  0)
-            self.setDriver('GV17',  0) 
-            self.setDriver('GV18',  0) 
-            self.setDriver('GV19',  0)
+            color = self.shelly_device.get_channel_state()
+        except Exception as ex :
+            self.statusFailed(ex)
+        else:
+            self.statusReceived(color)
+        self.update_time.observe(time.perf_counter() - start)
+
+    async def fetchStatus(self, full: bool = False):
+        """
+        Get the device status without blocking, used by the controller poll scheduler.
+        Normally only the small color/0 channel state is read, full reads the whole /status,
+        with the configured transition and effect from the cached /settings.
+        """
+        if not full:
+            return await self.shelly_device.async_get_channel_state()
+        color = await self.shelly_device.async_get_status_channel_state()
+        if color is None:
+            return None
+        settings = await self.shelly_device.async_get_device_settings()
+        if settings is None:
+            return color
+        return LED_COLOR.from_json(settings['lights'][0]).merge(color)
 
+    def statusReceived(self, color):
+        """Update the drivers from the light state.  Commands get this back from the device too, so there is no need to ask again."""
+        if color is None:
+            # reachable but no answer in time, an unreachable device fails with DeviceConnectorError instead
+            LOGGER.debug('Node: %s did not answer in time, keeping the last state', self.name)
+            return
+        try :
+            self.colorReceived(color)
         except Exception as ex :
+            self.statusFailed(ex)
+
+    def commandResult(self, color):
+        """The device answers commands with the resulting light state"""
+        self.statusReceived(color)
+
+    def sceneRequest(self, target):
+        """
+        The request for a scene command, used by the scene dispatcher.  target is a POWER_STATE or an LED_COLOR.
+        It goes through the command queue too, in its place behind any command for the device that is still waiting.
+        """
+        return self.color_queue.hold(target)
+
+    def sendCommand(self, target):
+        """
+        Send on/off through the scene dispatcher, with the rest of a scene.  Without one (the
+        scripts and benchmarks) queue it and wait for the device's answer, as the commands used to.
+        """
+        self.commandReceived()
+        if self.scene_dispatcher is not None:
+            self.scene_dispatcher.submit(self, target)
+            return
+        try:
+            self.statusReceived(get_device_loop().run(self.color_queue.send(target)))
+        except Exception as ex:
+            LOGGER.error('Node: %s: %s', self.name, str(ex))
+
+    def colorReceived(self, color):
+        on_state = 0
+        if color.on == True:
+            on_state = 1
+
+        LOGGER.debug('Node: LED status = RGBWBr[%s, %s, %s, %s, %s] - OTE[%s, %s, %s]', str(color.red), str(color.green), str(color.blue) ,str(color.white),str(color.brightness),str(color.on),str(color.transition),str(color.effect))
+
+        self.driver_cache.set('ST',    on_state )
+        self.driver_cache.set('GV10',  color.red)
+        self.driver_cache.set('GV11',  color.green)
+        self.driver_cache.set('GV12',  color.blue)
+        self.driver_cache.set('GV13',  color.white)
+        self.driver_cache.set('GV14',  color.brightness)
+        self.driver_cache.set('GV16',  on_state)
+        self.driver_cache.set('GV17',  color.transition) 
+        self.driver_cache.set('GV18',  color.effect) 
+        self.driver_cache.set('GV19',  1)  #Online/Offline
+        self.colorModelReceived(color)
+        self.meterReceived(color.power, color.energy)
+        startup_timer.reported(self.address)
+
+    def colorModelReceived(self, color):
+        """Hue, saturation and color temperature of the channel values, when all four are known"""
+        hsv = color.hsv()
+        if hsv is None:
+            return
+        self.driver_cache.set('GV22',  hsv[0])
+        self.driver_cache.set('GV23',  hsv[1])
+        self.driver_cache.set('GV24',  color.kelvin())
+
+    def statusFailed(self, ex):
+        if isinstance(ex, DeviceConnectorError):
+            LOGGER.debug('Node: Exception connection error, statuses set to 0')
+            self.driver_cache.set('ST',    0 )
+            self.driver_cache.set('GV10',  0)
+            self.driver_cache.set('GV11',  0)
+            self.driver_cache.set('GV12',  0)
+            self.driver_cache.set('GV13',  0)
+            self.driver_cache.set('GV14',  0)
+            self.driver_cache.set('GV16',  0)
+            self.driver_cache.set('GV17',  0) 
+            self.driver_cache.set('GV18',  0) 
+            self.driver_cache.set('GV19',  0)
+            self.driver_cache.set('CPW',   0)
+            self.driver_cache.set('GV20',  0)
+            self.driver_cache.set('GV22',  0)
+            self.driver_cache.set('GV23',  0)
+            self.driver_cache.set('GV24',  0)
+        else:
             LOGGER.error('Node: Exception in updateStatuses: %s', str(ex))
             #LOGGER.error('Node: updateStatuses: %s', traceback.format_exc())
 
+    def pushReceived(self, state, valid_for, channel = 0):
+        """State pushed by the device (CoIoT, MQTT), only the values it sent are updated"""
+        if channel != 0:
+            return
+        LOGGER.debug('Node: pushReceived() for %s (%s): %s', self.name, self.address, str(state))
+        self.push.received(valid_for)
+        if 'ison' in state:
+            on_state = 1 if state['ison'] else 0
+            self.driver_cache.set('ST',    on_state)
+            self.driver_cache.set('GV16',  on_state)
+        for key, driver in _PUSH_DRIVERS.items():
+            if key in state:
+                self.driver_cache.set(driver, state[key])
+        if any(key in state for key, _ in _CHANNEL_DRIVERS):
+            # a push may carry only some of the channels, the drivers have the others
+            self.colorModelReceived(LED_COLOR(**{key: int(state.get(key, self.getDriver(driver))) for key, driver in _CHANNEL_DRIVERS}))
+        self.driver_cache.set('GV19',  1)
+        self.meterReceived(state.get('power'), state.get('energy'))
+        startup_timer.reported(self.address)
+
+    def meterReceived(self, power, energy):
+        """A power meter reading that came with a status or a push, either value may be None"""
+        if self.meter.add(power, energy):
+            for driver, value in self.meter.drivers().items():
+                self.driver_cache.set(driver, value)
+
+    def actionReceived(self, event, channel):
+        """An action URL call from the device: the light was switched, or the input was switched or pushed"""
+        if channel != 0:
+            return
+        if event in ACTION_OUTPUT:
+            self.driver_cache.set('ST',    ACTION_OUTPUT[event])
+            self.driver_cache.set('GV16',  ACTION_OUTPUT[event])
+            self.driver_cache.set('GV19',  1)
+        if event in ACTION_CONTROL:
+            self.reportCmd(ACTION_CONTROL[event])
+
+    def commandReceived(self):
+        """Let the poll scheduler know the device is active, so it is polled at the full rate"""
+        self.last_command = time.monotonic()
+        if self.poll_scheduler is not None:
+            self.poll_scheduler.poke(self)
+
     def on_DON(self, command):
         LOGGER.debug('Node: on_DON() called')
-        try:
-            self.shelly_device.device_turn_on()
-            self.updateStatuses()
-        except Exception as ex:
-            LOGGER.error('Node: on_DON: %s', str(ex))
+        self.sendCommand(POWER_STATE.On)
         
     def on_DOF(self, command):
         LOGGER.debug('Node: on_DOF() called')
-        try :
-            self.shelly_device.device_turn_off()
-            self.updateStatuses()
-        except Exception as ex:
-            LOGGER.error('on_DOF: %s', str(ex))
+        self.sendCommand(POWER_STATE.Off)
     
     def On_Query(self, command):
         LOGGER.debug('Node: On_Query() called')
+        self.driver_cache.force_refresh()
         self.updateStatuses()
 
     def On_SetAllColor(self, command):
         LOGGER.debug('Node: On_SetAllColor() called')
+        self.commandReceived()
         try:
             query  = command.get('query')
             r_cmd  = int(query.get('R.uom100'))
@@ -130,47 +258,78 @@ class RGBW2_Node(udi_interface.Node):
             if on_cmd == 1:
                 on_state = True
 
-            self.shelly_device.device_on_with_color(red = r_cmd, green = g_cmd, blue = b_cmd, white = w_cmd, brightness = br_cmd, timer = timer_cmd, on=on_state)
-            self.updateStatuses()
+            self.color_queue.submit(LED_COLOR(red = r_cmd, green = g_cmd, blue = b_cmd, white = w_cmd, brightness = br_cmd, on=on_state, timer = timer_cmd))
         except Exception as ex:
             LOGGER.error('On_SetColor: %s', str(ex))
 
     def On_SetColor(self, command):
         LOGGER.debug('Node: On_SetAllColor() called')
+        self.commandReceived()
         try:
             query  = command.get('query')
             r_cmd  = int(query.get('RSC.uom100'))
             g_cmd  = int(query.get('GSC.uom100'))
             b_cmd  = int(query.get('BSC.uom100'))
             w_cmd  = int(query.get('WSC.uom100'))
-            self.shelly_device.device_on_with_color(red = r_cmd, green = g_cmd, blue = b_cmd, white = w_cmd)
-            self.updateStatuses()
+            self.color_queue.submit(LED_COLOR(red = r_cmd, green = g_cmd, blue = b_cmd, white = w_cmd))
         except Exception as ex:
             LOGGER.error('On_SetAllColor: %s', str(ex))
 
     def On_Brightness(self, command):
+        self.commandReceived()
         try:
             query  = command.get('query')
             gain  = int(query.get('BRSB.uom78'))
-            self.shelly_device.device_on_with_color(brightness=gain)
-            self.updateStatuses()
+            self.color_queue.submit(LED_COLOR(brightness=gain))
         except Exception as ex:
             LOGGER.error('On_BRT: %s', str(ex))
 
+    def On_SetHSV(self, command):
+        LOGGER.debug('Node: On_SetHSV() called')
+        self.commandReceived()
+        try:
+            query  = command.get('query')
+            hue    = float(query.get('HUE.uom14'))
+            sat    = float(query.get('SAT.uom51'))
+            br_cmd = query.get('BRHS.uom78')
+            self.color_queue.submit(LED_COLOR.from_hsv(hue, sat, int(br_cmd) if br_cmd is not None else None))
+        except Exception as ex:
+            LOGGER.error('On_SetHSV: %s', str(ex))
+
+    def On_SetColorTemperature(self, command):
+        LOGGER.debug('Node: On_SetColorTemperature() called')
+        self.commandReceived()
+        try:
+            query  = command.get('query')
+            kelvin = float(query.get('CT.uom26'))
+            br_cmd = query.get('BRCT.uom78')
+            self.color_queue.submit(LED_COLOR.from_kelvin(kelvin, int(br_cmd) if br_cmd is not None else None))
+        except Exception as ex:
+            LOGGER.error('On_SetColorTemperature: %s', str(ex))
     
     def On_SetEffect(self, command):
         LOGGER.debug('Node: On_SetEffect() called')
-        query  = command.get('query')
-        eff_num  = int(query.get('EFF.uom25'))
-        self.shelly_device.device_set_color_effect(eff_num)
-        self.updateStatuses()
+        self.commandReceived()
+        try:
+            query  = command.get('query')
+            eff_num  = int(query.get('EFF.uom25'))
+            if eff_num not in range(0, 4):
+                # effect number the device does not support, nothing is sent
+                self.updateStatuses()
+                return
+            self.color_queue.submit(lambda: self.shelly_device.async_device_set_color_effect(eff_num))
+        except Exception as ex:
+            LOGGER.error('On_SetEffect: %s', str(ex))
 
     def On_SetTransition(self, command):
         LOGGER.debug('Node: On_SetTransition() called')
-        query  = command.get('query')
-        eff_num  = int(query.get('TRN.uom42'))
-        self.shelly_device.device_set_default_color_transition(eff_num)
-        self.updateStatuses()
+        self.commandReceived()
+        try:
+            query  = command.get('query')
+            eff_num  = int(query.get('TRN.uom42'))
+            self.color_queue.submit(lambda: self.shelly_device.async_device_set_default_color_transition(eff_num))
+        except Exception as ex:
+            LOGGER.error('On_SetTransition: %s', str(ex))
 
     def isOn(self) : 
         return self.shelly_device.get_device_is_on()
@@ -190,6 +349,13 @@ class RGBW2_Node(udi_interface.Node):
                {'driver': 'GV17', 'value': 0, 'uom': ISY_UOM_42_MILLISECOND},      # Transition Time
                {'driver': 'GV18', 'value': 0, 'uom': ISY_UOM_25_INDEX},      # Effect
                {'driver': 'GV19', 'value': 0, 'uom': ISY_UOM_2_BOOL},      # Online/Offline
+               {'driver': 'CPW',  'value': 0, 'uom': ISY_UOM_73_WATT},     # Power
+               {'driver': 'TPW',  'value': 0, 'uom': ISY_UOM_33_KWH},      # Energy, the device's counter
+               {'driver': 'GV20', 'value': 0, 'uom': ISY_UOM_73_WATT},     # Power change per minute
+               {'driver': 'GV21', 'value': 0, 'uom': ISY_UOM_33_KWH},      # Energy today
+               {'driver': 'GV22', 'value': 0, 'uom': ISY_UOM_14_DEGREES},  # Hue
+               {'driver': 'GV23', 'value': 0, 'uom': ISY_UOM_51_PERCENT},  # Saturation
+               {'driver': 'GV24', 'value': 0, 'uom': ISY_UOM_26_KELVIN},   # Color temperature, 0 if not a white
               ]  
 
     #hint = '0x01020A00' #https://github.com/UniversalDevicesInc-PG3/udi-poly-ecobee/blob/7893dea2349b855d70a391347bd9130dde0e8804/nodes/Thermostat.py#L700
@@ -203,6 +369,8 @@ class RGBW2_Node(udi_interface.Node):
                     'SET_ALL_COLOR': On_SetAllColor,
                     'SET_COLOR_RGBW': On_SetColor,
                     'SET_BRIGHTNESS': On_Brightness,
+                    'SET_HSV': On_SetHSV,
+                    'SET_CT': On_SetColorTemperature,
                     'SET_TRANSITION': On_SetTransition,
                     'SET_EFFECT': On_SetEffect,
                 }
@@ -0,0 +1,106 @@
+#
+#
+#  Scene Dispatcher
+#
+#  An ISY scene reaches the nodeserver as one command per member node, one after the
+#  other.  Sent one at a time the devices switch one by one, so commands arriving
+#  within a short window are collected and sent to all their devices at once, then
+#  the resulting driver values of every node go to PG3 in a single message.
+#
+#  A node's request is made when its command arrives and only awaited when the window
+#  ends, so a node with a command queue of its own (the RGBW2) keeps the command in its
+#  place among the others it is sent.
+#
+
+import asyncio
+import concurrent.futures
+from typing import Any, Awaitable, Dict, List, Optional, Tuple, Union
+
+from Node_Shared import *
+from ShellyDevice_Constants import POWER_STATE
+from ShellyDevice_Loop import ShellyDevice_Loop
+from ShellyDevice_RGBW2 import LED_COLOR
+
+SCENE_WINDOW = 0.05  # seconds to wait for the rest of a scene's commands before sending
+
+SceneTarget = Union[POWER_STATE, LED_COLOR]
+
+
+class SceneDispatcher:
+    """Sends on/off/toggle or color commands for a group of nodes concurrently"""
+
+    def __init__(self, poly: Any, device_loop: ShellyDevice_Loop, window: float = SCENE_WINDOW):
+        self._poly = poly
+        self._device_loop = device_loop
+        self._window = window
+        self._pending: Dict[str, Tuple[Any, SceneTarget, Awaitable[Any]]] = {}
+        self._timer = None
+        self.batches = 0
+        self.commands = 0
+
+    def submit(self, node: Any, target: SceneTarget) -> None:
+        """Queue a command for one node.  Safe to call from any thread, returns straight away."""
+        self._device_loop.loop.call_soon_threadsafe(self._queue, node, target)
+
+    def dispatch(self, nodes: List[Any], target: SceneTarget) -> concurrent.futures.Future:
+        """Send target to all the nodes now, the future gives the number of commands sent"""
+        return self._device_loop.submit(self._dispatch(nodes, target))
+
+    #
+    # Private functions, these all run on the device loop
+    #
+    def _queue(self, node: Any, target: SceneTarget) -> None:
+        previous = self._pending.pop(node.address, None)
+        if previous is not None:
+            if isinstance(previous[1], LED_COLOR) and isinstance(target, LED_COLOR):
+                target = previous[1].merge(target)
+            _discard(previous[2])
+        request = self._request(node, target)
+        if request is not None:
+            self._pending[node.address] = (node, target, request)
+        if self._timer is None:
+            self._timer = self._device_loop.loop.call_later(self._window, self._flush)
+
+    def _request(self, node: Any, target: SceneTarget) -> Optional[Awaitable[Any]]:
+        request = node.sceneRequest(target)
+        if request is None:
+            LOGGER.debug('SceneDispatcher: %s does not support %s', node.name, str(target))
+        return request
+
+    def _flush(self) -> None:
+        self._timer = None
+        commands, self._pending = list(self._pending.values()), {}
+        self._device_loop.spawn(self._send([(node, request) for node, target, request in commands]))
+
+    async def _dispatch(self, nodes: List[Any], target: SceneTarget) -> int:
+        requests = [(node, self._request(node, target)) for node in nodes]
+        return await self._send([(node, request) for node, request in requests if request is not None])
+
+    async def _send(self, requests: List[Tuple[Any, Awaitable[Any]]]) -> int:
+        if not requests:
+            return 0
+
+        self.batches += 1
+        self.commands += len(requests)
+        LOGGER.debug('SceneDispatcher: sending %d commands at once', len(requests))
+        results = await asyncio.gather(*[request for node, request in requests], return_exceptions=True)
+
+        # the driver updates made here, on the device loop, go in one message, not those of PG3's threads
+        with DriverBatch(self._poly):
+            for (node, request), result in zip(requests, results):
+                try:
+                    if isinstance(result, BaseException):
+                        node.statusFailed(result)
+                    else:
+                        node.commandResult(result)
+                except Exception as ex:
+                    LOGGER.error('SceneDispatcher: %s: %s', node.name, str(ex))
+        return len(requests)
+
+
+def _discard(request: Awaitable[Any]) -> None:
+    """Drop the request of a command a later one for the same node replaced"""
+    if asyncio.iscoroutine(request):
+        request.close()  # never started
+    else:
+        request.add_done_callback(lambda future: future.cancelled() or future.exception())  # already queued, nobody waits for its answer
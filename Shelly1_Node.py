@@ -1,9 +1,13 @@
 import udi_interface
+import time
 import traceback
 
 from  Node_Shared import *
 from ShellyDevice_Shelly1 import ShellyDevice_Shelly1
 from ShellyDevice_Base import DeviceConnectorError
+from ShellyDevice_Constants import POWER_STATE
+from ShellyDevice_Stats import LatencyHistogram
+from Power_Meter import PowerMeter
 #from device_finder import Device_Finder
 
 
@@ -15,18 +19,26 @@ class Shelly1_Node(udi_interface.Node):
     self.address: String address of this Node 14 character limit. (ISY limitation)
     self.added: Boolean Confirmed added to ISY
     """
-    def __init__(self, polyglot, primary, isy_address, device_address, device_name):
+    def __init__(self, polyglot, primary, isy_address, device_address, device_name, device = None):
         #You do NOT have to override the __init__ method, but if you do, you MUST call super.
+        #device is the Shelly device to use instead of a Gen1 Shelly1, e.g. a Gen2 Plus 1
         super(Shelly1_Node, self).__init__(polyglot, primary, isy_address, device_name)
         LOGGER.debug("Node: Init Node " + device_name + " ("+ device_address + ")")
 
         #set specific values
         self.device_addr = device_address
         self.queryON = True
-        self.shelly_device = ShellyDevice_Shelly1(self.device_addr)
+        self.shelly_device = device if device is not None else ShellyDevice_Shelly1(self.device_addr)
+        self.shelly_device.on_push = self.pushReceived
+        self.push = PushTracker()
+        self.driver_cache = DriverCache(self)
+        self.poll_scheduler = None  # set by the controller
+        self.scene_dispatcher = None  # set by the controller
+        self.last_command = 0.0
+        self.update_time = LatencyHistogram()  # fetching a status and applying it to the drivers
+        self.meter = PowerMeter()  # fed by the full polls, relay/0 has no meter reading
 
         polyglot.subscribe(polyglot.START, self.start, isy_address)
-        polyglot.subscribe(polyglot.POLL, self.poll)
 
     def start(self):
         """
@@ -34,55 +46,133 @@ class Shelly1_Node(udi_interface.Node):
         and we get a return result from Polyglot. Only happens once.
         """
         LOGGER.debug('Node: Start called for node ' + self.name + ' (' + self.address + ')')
-        self.updateStatuses() 
-
-    def poll(self, pollflag):
-        if pollflag == 'shortPoll':
+        if self.poll_scheduler is not None:
+            self.poll_scheduler.poll_now([self])
+        else:
             self.updateStatuses()
 
     def updateStatuses(self):
         LOGGER.debug('Node: updateStatuses() called for  %s (%s)', self.name, self.address)
+        start = time.perf_counter()
         try :
-            # json_state =  self.shelly_device.get_device_status()
-            # LOGGER.info('Node: status is  %s', json_state)
-            # is_on = json_state[self.shelly_device.primary_status_channel][0]['ison']
+            relay_state = self.shelly_device.get_channel_state()
+        except Exception as ex :
+            self.statusFailed(ex)
+        else:
+            self.statusReceived(relay_state)
+        self.update_time.observe(time.perf_counter() - start)
 
-            is_on = self.shelly_device.get_device_is_on()
+    async def fetchStatus(self, full: bool = False):
+        """
+        Get the relay state without blocking, used by the controller poll scheduler.
+        Normally only the small relay/0 state is read, full reads the whole /status.
+        """
+        if not full:
+            return await self.shelly_device.async_get_channel_state()
+        return await self.shelly_device.async_get_status_channel_state()
+
+    def statusReceived(self, relay_state):
+        if relay_state is None:
+            # the device is reachable but did not answer in time, which says nothing about the relay
+            LOGGER.debug('Node: %s did not answer in time, keeping the last state', self.name)
+            return
+        try :
+            is_on = relay_state.on
             on_state = 0
             if is_on == True:
                 on_state = 1
 
             LOGGER.debug('Node: Relay status = ' + str(is_on))
 
-            self.setDriver('ST',    on_state )
-            self.setDriver('GV19',  1)
-
-        except DeviceConnectorError as ex :
-            self.setDriver('GV19',  0)
-            self.setDriver('ST',    0 )
+            self.driver_cache.set('ST',    on_state )
+            self.driver_cache.set('GV19',  1)
+            self.meterReceived(relay_state.power, relay_state.energy)
+            startup_timer.reported(self.address)
 
         except Exception as ex :
+            self.statusFailed(ex)
+
+    def commandResult(self, relay_state):
+        """The device answers relay/0 requests with the resulting relay state, so use it rather than asking again"""
+        self.statusReceived(relay_state)
+
+    def sceneRequest(self, target):
+        """The request for a scene command, used by the scene dispatcher.  A color target only switches the relay."""
+        if not isinstance(target, POWER_STATE):
+            if getattr(target, 'on', None) is None:
+                return None
+            target = POWER_STATE.On if target.on else POWER_STATE.Off
+        return self.shelly_device.async_device_set_on_state(target)
+
+    def statusFailed(self, ex):
+        if isinstance(ex, DeviceConnectorError):
+            self.driver_cache.set('GV19',  0)
+            self.driver_cache.set('ST',    0 )
+            self.driver_cache.set('CPW',   0)
+            self.driver_cache.set('GV20',  0)
+        else:
             LOGGER.error('Node: updateStatuses: %s', str(ex))
             #LOGGER.error('Node: updateStatuses: %s', traceback.format_exc())
 
+    def pushReceived(self, state, valid_for, channel = 0):
+        """State pushed by the device (CoIoT, MQTT), only the values it sent are updated"""
+        if channel != 0:
+            return
+        LOGGER.debug('Node: pushReceived() for %s (%s): %s', self.name, self.address, str(state))
+        self.push.received(valid_for)
+        if 'ison' in state:
+            self.driver_cache.set('ST',    1 if state['ison'] else 0)
+        self.driver_cache.set('GV19',  1)
+        self.meterReceived(state.get('power'), state.get('energy'))
+        startup_timer.reported(self.address)
+
+    def meterReceived(self, power, energy):
+        """A power meter reading that came with a status or a push, either value may be None"""
+        if self.meter.add(power, energy):
+            for driver, value in self.meter.drivers().items():
+                self.driver_cache.set(driver, value)
+
+    def actionReceived(self, event, channel):
+        """An action URL call from the device: the relay changed, or the input was switched or pushed"""
+        if channel != 0:
+            return
+        if event in ACTION_OUTPUT:
+            self.driver_cache.set('ST',    ACTION_OUTPUT[event])
+            self.driver_cache.set('GV19',  1)
+        if event in ACTION_CONTROL:
+            self.reportCmd(ACTION_CONTROL[event])
+
+    def commandReceived(self):
+        """Let the poll scheduler know the device is active, so it is polled at the full rate"""
+        self.last_command = time.monotonic()
+        if self.poll_scheduler is not None:
+            self.poll_scheduler.poke(self)
+
     def on_DON(self, command):
         LOGGER.debug('Node: on_DON() called')
+        self.commandReceived()
+        if self.scene_dispatcher is not None:
+            self.scene_dispatcher.submit(self, POWER_STATE.On)
+            return
         try:
-            self.shelly_device.device_turn_on()
-            self.updateStatuses()
+            self.commandResult(self.shelly_device.device_turn_on())
         except Exception as ex:
             LOGGER.error('Node: on_DON: %s', str(ex))
         
     def on_DOF(self, command):
         LOGGER.debug('Node: on_DOF() called')
+        self.commandReceived()
+        if self.scene_dispatcher is not None:
+            self.scene_dispatcher.submit(self, POWER_STATE.Off)
+            return
         try :
-            self.shelly_device.device_turn_off()
-            self.updateStatuses()
+            self.commandResult(self.shelly_device.device_turn_off())
         except Exception as ex:
             LOGGER.error('on_DOF: %s', str(ex))
     
     def On_Query(self, command):
         LOGGER.debug('Node: On_Query() called')
+        self.driver_cache.force_refresh()
         self.updateStatuses()
 
     def isOn(self) : 
@@ -90,6 +180,10 @@ class Shelly1_Node(udi_interface.Node):
     
     drivers = [{'driver': 'ST',   'value': 0, 'uom': ISY_UOM_2_BOOL},    # Status = DevicePower On State
                {'driver': 'GV19', 'value': 0, 'uom': ISY_UOM_2_BOOL},      # Online/Offline
+               {'driver': 'CPW',  'value': 0, 'uom': ISY_UOM_73_WATT},     # Power
+               {'driver': 'TPW',  'value': 0, 'uom': ISY_UOM_33_KWH},      # Energy, the device's counter
+               {'driver': 'GV20', 'value': 0, 'uom': ISY_UOM_73_WATT},     # Power change per minute
+               {'driver': 'GV21', 'value': 0, 'uom': ISY_UOM_33_KWH},      # Energy today
               ]  
 
     id = "Shelly1Device"
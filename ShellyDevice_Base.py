@@ -1,18 +1,61 @@
 import enum
 import asyncio
 import json
-from typing import Any
+import time
+from urllib.parse import quote
+from typing import Any, Awaitable, Callable, Optional
 
-from aiohttp import ClientSession, ClientResponseError,ClientTimeout, BasicAuth, ClientConnectorError
+from aiohttp import ClientSession, ClientResponseError,ClientTimeout, BasicAuth, ClientConnectorError, ClientConnectionError
 from ShellyDevice_Constants import *
+from ShellyDevice_Loop import get_device_loop
+from ShellyDevice_Reachability import DeviceReachability
+from ShellyDevice_Stats import DeviceStats
 
 EP_TIMEOUT = ClientTimeout(
     total=3  # It on LAN, and if too long we will get warning about the update duration in logs
 )
 
+CONFIG_TTL = 3600  # seconds /shelly and /settings answers are reused for, they only change when the device is reconfigured
+
 class DeviceConnectorError(Exception):
    pass
 
+class DeviceAuthError(Exception):
+    """The device wants a login, and none is configured for it or it was rejected"""
+    pass
+
+
+class RELAY_STATE:
+    def __init__(self, on: bool = None, timer_remaining: int = None, source: str = None, power: float = None, energy: float = None):
+        """Initialize  the relay state class"""
+        self.on              = on
+        self.timer_remaining = timer_remaining
+        self.source          = source
+        self.power           = power   # W, on devices with a meter
+        self.energy          = energy  # Wh, the meter's counter
+
+    @staticmethod
+    def from_json(state_dict: dict) -> 'RELAY_STATE':
+        """The relay state from a relay/N response or a relays[N] status entry"""
+        return RELAY_STATE(
+            on              = state_dict["ison"],
+            timer_remaining = state_dict.get("timer_remaining"),
+            source          = state_dict.get("source"),
+        )
+
+    def __str__(self):
+        return "Relay State: on=" + str(self.on) + ",  timer_remaining=" + str(self.timer_remaining) + ",  source=" + str(self.source) + ",  power=" + str(self.power)
+
+
+def apply_meter(state: Any, meter: dict) -> None:
+    """Set the power and energy of a channel state from its meters[N] status entry, the device counts energy in watt-minutes"""
+    if not meter.get('is_valid', True):
+        return
+    if meter.get('power') is not None:
+        state.power = meter['power']
+    if meter.get('total') is not None:
+        state.energy = meter['total'] / 60.0
+
 
 class ShellyDevice_Base:
     """Controller class for the Shelly1 """
@@ -21,109 +64,308 @@ class ShellyDevice_Base:
         """Initialize a Shelly1."""
         self._host = host
         self._base_url = "http://" + host + "/"
+        self._session = session  # optional caller owned session, must belong to the device loop
         self.primary_output_channel = None
         self.primary_status_channel = None
+        self.channel_count = 1     # output channels of the device, relay/0..N-1 etc.
         self.auth_cred = None
+        self.auth_required = None  # whether the device has a login set, from /shelly, None until known
+        self.bytes_received = 0    # response body bytes, for measuring what polling costs
+        self.parse_seconds = 0.0   # time spent decoding the JSON responses
+        self.stats = DeviceStats()  # request latency and error counts
+        self.reachability = DeviceReachability()  # whether the device accepts connections, so a down one fails fast
+        self.firmware = None       # firmware version, from the last /settings or /status read
+        self._config_cache = {}    # /shelly and /settings: key -> (time read, answer)
+        self._last_uptime = None
+        self.on_push = None  # called with (state, valid_for) by devices that push their state over the connection (Gen2)
+        self.mqtt = None     # MqttLink of a device publishing to the broker, commands go over it while it is live
+        self.set_credentials(user, pwd)
+
+    def set_credentials(self, user: str = None, pwd: str = None) -> None:
+        """The login to use if the device has one set, None for none"""
         if( user is not None and pwd is not None):
             self.auth_cred = BasicAuth(user,pwd)
+        else:
+            self.auth_cred = None
 
 
     @property
     def host(self) -> str:
         """Get the IP used by this client."""
         return self._host
+
+    @host.setter
+    def host(self, host: str):
+        """Change the IP used by this client, e.g. after the device got a new DHCP address."""
+        self._host = host
+        self._base_url = "http://" + host + "/"
+        self.auth_required = None
+        self.reachability.reset()
+        self.invalidate_config()
+
+    def invalidate_config(self) -> None:
+        """Forget the cached identity and settings, the next read gets them from the device"""
+        self._config_cache.clear()
     #
     # Device Information Funtions
     #
-    def get_device_settings(self) -> Any:
-        """Retrieve the device configuration information."""
-        json_settings = asyncio.run(self._send_request("settings"))
-        if json_settings is None:
-            return None
-        settings_dict = json.loads(json_settings)
+    def get_device_settings(self, max_age: float = None) -> Any:
+        """Retrieve the device configuration information, from the cache if it was read less than max_age (default CONFIG_TTL) seconds ago."""
+        return self._run(self.async_get_device_settings(max_age))
+
+    async def async_get_device_settings(self, max_age: float = None) -> Any:
+        """Retrieve the device configuration information without blocking the device loop.  The answer is shared, don't modify it."""
+        settings_dict = await self._get_config('settings', lambda: self._send_json_request('settings'), max_age)
+        if settings_dict is not None:
+            self.firmware = settings_dict.get('fw', self.firmware)
         return settings_dict
 
-    def get_device_info(self) -> Any:
+    def get_device_info(self, max_age: float = None) -> Any:
         """Provides basic information about the device. This does not require HTTP authentication. Can be used in for device discovery and identification."""
-        return asyncio.run( self._send_request( "shelly"))
+        return self._run(self.async_get_device_info(max_age))
+
+    async def async_get_device_info(self, max_age: float = None) -> Any:
+        """The /shelly identity (type, MAC, firmware, auth), cached like the settings."""
+        info = await self._get_config('shelly', lambda: self._send_json_request('shelly'), max_age)
+        if info is not None and 'auth' in info:
+            self.auth_required = bool(info['auth'])
+        return info
 
     def get_device_status(self) -> Any:
         """Retrieve the device status information such as free ram, free memory, and uptime."""
-        json_status =   asyncio.run( self._send_request("status"))
+        return self._run(self.async_get_device_status())
+
+    async def async_get_device_status(self) -> Any:
+        """Retrieve the device status information without blocking the device loop."""
+        json_status = await self._send_request("status")
         if json_status is None:
             return None
-        status_dict = json.loads(json_status)
+        status_dict = self._json_loads(json_status)
+        self.firmware = status_dict.get('update', {}).get('old_version', self.firmware)
+        self._check_uptime(status_dict.get('uptime'))
         return status_dict
 
-    def get_device_is_on(self) -> bool:
-            """is the device turned on or not"""
-            assert(self.primary_status_channel != None )  # Need to set primary status channel in derived class __init__
-            
-            json_state =  self.get_device_status()
-            if json_state is None:
-                return False
-            return json_state[self.primary_status_channel][0]['ison']
+    def get_channel_state(self, channel: int = 0) -> Any:
+        """Retrieve just the state of an output channel (relay/N or color/0), a much smaller answer than /settings or /status"""
+        return self._run(self.async_get_channel_state(channel))
+
+    async def async_get_channel_state(self, channel: int = 0) -> Any:
+        """Retrieve the state of an output channel without blocking the device loop."""
+        return await self._send_channel_request(self.channel_endpoint(channel))
+
+    def channel_endpoint(self, channel: int) -> str:
+        """The endpoint of an output channel, e.g. relay/1 for the second relay"""
+        assert(self.primary_output_channel != None )  # Need to set primary channel in derived class __init__
+        if channel == 0:
+            return self.primary_output_channel
+        return self.primary_output_channel[:self.primary_output_channel.rindex('/') + 1] + str(channel)
+
+    async def async_get_status_channel_state(self) -> Any:
+        """The state of the primary output channel from the full /status, for when the rest of the status is wanted too."""
+        states = await self.async_get_status_channel_states()
+        if states is None:
+            return None
+        return states[0]
+
+    def get_status_channel_states(self) -> Any:
+        """The state of every output channel, all from one /status request."""
+        return self._run(self.async_get_status_channel_states())
+
+    async def async_get_status_channel_states(self) -> Any:
+        """The state of every output channel from one /status, with its power meter reading, without blocking the device loop."""
+        assert(self.primary_status_channel != None )  # Need to set primary status channel in derived class __init__
+        json_state = await self.async_get_device_status()
+        if json_state is None:
+            return None
+        states = [self._parse_channel_state(channel_state) for channel_state in json_state[self.primary_status_channel]]
+        for state, meter in zip(states, json_state.get('meters') or []):
+            apply_meter(state, meter)
+        return states
+
+    def get_device_is_on(self) -> Optional[bool]:
+        """is the device turned on or not, None if it did not answer in time"""
+        return self._run(self.async_get_device_is_on())
+
+    async def async_get_device_is_on(self) -> Optional[bool]:
+        """is the device turned on or not, without blocking the device loop.  Raises DeviceConnectorError if it can't be reached."""
+        assert(self.primary_status_channel != None )  # Need to set primary status channel in derived class __init__
+
+        json_state = await self.async_get_device_status()
+        if json_state is None:
+            return None
+        return json_state[self.primary_status_channel][0]['ison']
+
+    async def async_get_actions(self) -> Any:
+        """The action URLs set on the device, e.g. {'out_on_url': [{'index': 0, 'enabled': True, 'urls': [...]}]}"""
+        actions = await self._send_json_request('settings/actions')
+        if actions is None:
+            return None
+        return actions.get('actions', {})
 
     #
     # Device Action Functions
     #  
     def device_reboot(self) -> Any:
-        """Retrieve the device information."""
-        return asyncio.run( self._send_request( "reboot"))
+        """Reboot the device, its settings are read again afterwards."""
+        self.invalidate_config()
+        return self._run( self._send_request( "reboot"))
 
-    def device_turn_on(self,timer: int = None) -> Any:
+    def device_turn_on(self,timer: int = None, channel: int = 0) -> Any:
         """Turns on  device.  Optional parameter specifies automatic flip-back timer in seconds (e.g. turned On or OFF for X seconds and will be switched back to previous state after that)"""
-        assert(self.primary_output_channel != None )  # Need to set primary channel in derived class __init__
-        cmd = self.primary_output_channel + '?turn=on'
-        if timer != None:
-            cmd += "&timer="+str(timer)
-        return asyncio.run( self._send_request(cmd ))
+        return self._run(self.async_device_set_on_state(POWER_STATE.On, timer, channel))
 
-    def device_turn_off(self) -> Any:
+    def device_turn_off(self, channel: int = 0) -> Any:
         """Turns off relay device"""
-        assert(self.primary_output_channel != None )  # Need to set primary channel in derived class __init__
-        cmd = self.primary_output_channel + '?turn=off'
-        return asyncio.run( self._send_request(cmd ))
-
+        return self._run(self.async_device_set_on_state(POWER_STATE.Off, None, channel))
 
-    def device_set_on_state(self,state: POWER_STATE,timer: int = None) -> Any:
+    def device_set_on_state(self,state: POWER_STATE,timer: int = None, channel: int = 0) -> Any:
         """Accepted values: on, off or toggle.  Optional parameter specifies automatic flip-back timer in seconds (e.g. turned On or OFF for X seconds and will be switched back to previous state after that)"""
-        assert(self.primary_output_channel != None )  # Need to set primary channel in derived class __init__
-        cmd = self.primary_output_channel + '?turn='+str(state.value)
+        return self._run(self.async_device_set_on_state(state, timer, channel))
+
+    async def async_device_set_on_state(self,state: POWER_STATE,timer: int = None, channel: int = 0) -> Any:
+        """
+        Set the on state without blocking the device loop.  Returns the resulting channel state, or None if
+        the device did not answer, or if the command went over MQTT (the device publishes its new state).
+        """
+        if timer is None and self.mqtt is not None and self.mqtt.live:
+            self.mqtt.publish(self.channel_endpoint(channel) + '/command', str(state.value))
+            return None
+        cmd = self.channel_endpoint(channel) + '?turn='+str(state.value)
         if timer != None:
             cmd += "&timer="+str(timer)
-        return asyncio.run( self._send_request(cmd ))
+        return await self._send_channel_request(cmd)
+
+    async def async_set_action_urls(self, action: str, urls: list, channel: int = 0) -> Any:
+        """Set the URLs the device calls on an action (out_on_url, btn_on_url, ...) of a channel, no URLs disables it"""
+        cmd = 'settings/actions?index=' + str(channel) + '&name=' + action + '&enabled=' + ('true' if urls else 'false')
+        for url in urls:
+            cmd += '&urls[]=' + quote(url, safe='')
+        return await self._send_json_request(cmd)
 
     #
     # Private functions
     #
+    def _run(self, coro) -> Any:
+        """Run a request on the shared device loop and wait for the result"""
+        return get_device_loop().run(coro)
+
+    def _get_session(self) -> ClientSession:
+        if self._session is not None:
+            return self._session
+        return get_device_loop().get_session()
+
+    def _json_loads(self, text: str) -> Any:
+        start = time.perf_counter()
+        try:
+            return json.loads(text)
+        finally:
+            self.parse_seconds += time.perf_counter() - start
+
+    def _parse_channel_state(self, state_dict: dict) -> Any:
+        """Convert the JSON the device returns for an output channel into its typed state"""
+        return RELAY_STATE.from_json(state_dict)
+
+    async def _get_config(self, key: str, fetch: Callable[[], Awaitable[Any]], max_age: float = None) -> Any:
+        """A cached config answer if it is new enough, otherwise fetch() it and keep it"""
+        if max_age is None:
+            max_age = CONFIG_TTL
+        now = time.monotonic()
+        cached = self._config_cache.get(key)
+        if cached is not None and now - cached[0] < max_age:
+            self.stats.cache_hits += 1
+            return cached[1]
+        value = await fetch()
+        if value is not None:
+            self._config_cache[key] = (now, value)
+        return value
+
+    def _check_uptime(self, uptime: Any) -> None:
+        """An uptime going backwards means the device rebooted, maybe after a firmware update or a reset"""
+        if uptime is None:
+            return
+        if self._last_uptime is not None and uptime < self._last_uptime:
+            self.invalidate_config()
+        self._last_uptime = uptime
+
+    async def _no_answer(self) -> None:
+        """A slow answer and an unplugged device look the same, a connect tells them apart"""
+        if not await self.reachability.probe(self._host):
+            raise DeviceConnectorError
+        return None
+
+    async def _send_json_request(self, endpoint: str) -> Any:
+        text = await self._send_request(endpoint)
+        if text is None:
+            return None
+        return self._json_loads(text)
+
+    async def _send_channel_request(self, endpoint: str) -> Any:
+        """Send a request to an output channel and return the channel state the device answers with"""
+        json_state = await self._send_request(endpoint)
+        if json_state is None:
+            return None
+        return self._parse_channel_state(self._json_loads(json_state))
+
     async def _send_request( self, endpoint: str, data: Any = None, retry: int = 1 ) -> Any:
-        """Send a request"""
-        session = ClientSession(raise_for_status=True, timeout=EP_TIMEOUT, auth=self.auth_cred )
+        """
+        Send a request.  The login is sent with it if the device is known to have one, and
+        with a login configured, /shelly (which never needs one) is asked first to find out.
+        Returns None if the device is reachable but did not answer in time, and raises
+        DeviceConnectorError straight away if it is known to be down.
+        """
+        if not await self.reachability.check(self._host):
+            self.stats.unreachable += 1
+            raise DeviceConnectorError
+        if endpoint.startswith('settings') and '?' in endpoint:
+            self.invalidate_config()  # a settings change, e.g. settings/color/0?transition=
+        if self.auth_required is None and self.auth_cred is not None and endpoint != 'shelly':
+            await self.async_get_device_info()
+        auth = self.auth_cred if self.auth_required else None
+        session = self._get_session()
+        start = time.perf_counter()
         try:
-            response = await session.request(
+            async with session.request(
                  method="GET" if data is None else "POST",
                  url=self._base_url + endpoint,
                  json=data,
+                 auth=auth,
                  timeout=EP_TIMEOUT,
-             )
-            data = await response.text()
-            await session.close()
-            return data
+                 raise_for_status=True,
+             ) as response:
+                body = await response.read()
+                self.reachability.mark_up()
+                if endpoint.startswith('settings') and '?' in endpoint:
+                    self.invalidate_config()  # again, in case a read raced with the change
+                self.stats.observe(endpoint, time.perf_counter() - start)
+                self.bytes_received += len(body)
+                return body.decode('utf-8', errors='replace')
 
         except ClientConnectorError:
-            await session.close()
+            self.stats.connect_errors += 1
+            self.reachability.mark_down()
             raise  DeviceConnectorError
 
         except asyncio.TimeoutError:
-            await session.close()
+            self.stats.timeouts += 1
+            return await self._no_answer()
+
+        except ClientConnectionError:
+            # dropped mid-request, e.g. a stale keep-alive connection or the device rebooting
+            self.stats.connect_errors += 1
+            return await self._no_answer()
 
         except ClientResponseError as err:
-            if err.code == 401 and retry > 0:
+            self.reachability.mark_up()
+            if err.code != 401:
+                self.stats.http_errors += 1
+                raise
+            if auth is None and self.auth_cred is not None and retry > 0:
+                # the login was set after /shelly was read, send it from now on
+                self.stats.auth_retries += 1
+                self.auth_required = True
                 return await self._send_request(endpoint, data, retry - 1)
-            await session.close()
-            raise
-        except:
-            await session.close()
-            raise
-       
+            self.auth_required = True
+            self.stats.http_errors += 1
+            if self.auth_cred is None:
+                raise DeviceAuthError(self._host + ' has a login set, configure DeviceUser/DevicePassword or AUTH_<DeviceID>')
+            raise DeviceAuthError(self._host + ' rejected the login')
@@ -0,0 +1,338 @@
+#
+#
+#  Shelly Gen2 (Plus/Pro) devices
+#
+#  Gen2 devices speak JSON-RPC, and over a websocket they also push NotifyStatus
+#  frames to every client that has sent them a request.  One socket per device is
+#  kept open for the life of the nodeserver and carries the commands, the status
+#  reads and the pushes, so polling a Gen2 device costs no HTTP requests at all.
+#
+
+import asyncio
+import itertools
+import json
+import time
+from typing import Any, Dict, Optional
+
+from aiohttp import ClientSession, ClientError, WSMsgType
+from ShellyDevice_Base import *
+from ShellyDevice_RGBW2 import LED_COLOR
+
+RPC_CLIENT_ID   = 'udi-shelly-nodeserver'  # src of our requests, the device sends its notifications back to it
+WS_HEARTBEAT    = 30    # seconds between websocket pings, a missed pong drops the connection
+PUSH_VALID_FOR  = 2 * WS_HEARTBEAT  # seconds an open socket counts as a live push channel, renewed every heartbeat
+RECONNECT_MIN   = 1     # seconds before the first reconnect attempt
+RECONNECT_MAX   = 60    # longest wait between reconnect attempts
+
+COMPONENT_SWITCH = 'switch'
+COMPONENT_LIGHT  = 'light'
+
+
+class DeviceRpcError(Exception):
+    """The device answered an RPC request with an error"""
+    def __init__(self, code: int, message: str):
+        super().__init__(str(code) + ': ' + str(message))
+        self.code = code
+
+
+class ShellyDevice_Gen2(ShellyDevice_Base):
+    """Controller class for the Gen2 Plus/Pro devices, one output component (switch:N or light:N)"""
+
+    def __init__(self, host: str, user: str = None, pwd: str = None, session: ClientSession = None, component: str = COMPONENT_SWITCH, channel: int = 0):
+        # Gen2 auth is digest based and is not supported yet, the device must have auth off
+        super().__init__(host, None, None, session)
+        self.component = component
+        self.channel = channel
+        self.primary_output_channel = component + ':' + str(channel)
+        self.primary_status_channel = self.primary_output_channel
+        self._ws = None
+        self._lock = None  # made by _connect on the device loop, before 3.10 a lock is bound to the loop of the thread that makes it
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self._renew = None
+        self._reconnect_task = None
+        self._closed = False
+        self._status: Dict[str, Any] = {}  # last known status of the component, kept up to date by the pushes
+
+    @ShellyDevice_Base.host.setter
+    def host(self, host: str):
+        """Change the IP, the socket to the old address is dropped and reopened to the new one"""
+        ShellyDevice_Base.host.fset(self, host)
+        if self._ws is not None:
+            device_loop = get_device_loop()
+            device_loop.loop.call_soon_threadsafe(device_loop.spawn, self._drop())
+
+    def set_credentials(self, user: str = None, pwd: str = None) -> None:
+        """Gen2 logins use digest auth, which is not supported yet"""
+        self.auth_cred = None
+
+    @property
+    def connected(self) -> bool:
+        return self._ws is not None and not self._ws.closed
+
+    #
+    # Device Information Funtions
+    #
+    async def async_get_device_info(self, max_age: float = None) -> Any:
+        """Basic information about the device (id, model, firmware), cached."""
+        info = await self._get_config('shelly', lambda: self.async_call('Shelly.GetDeviceInfo'), max_age)
+        if info is not None:
+            self.firmware = info.get('ver', self.firmware)
+        return info
+
+    async def async_get_device_settings(self, max_age: float = None) -> Any:
+        """The device configuration, cached."""
+        return await self._get_config('settings', lambda: self.async_call('Shelly.GetConfig'), max_age)
+
+    async def async_get_device_status(self) -> Any:
+        """The status of every component of the device."""
+        status = await self.async_call('Shelly.GetStatus')
+        if status is not None:
+            self._check_uptime(status.get('sys', {}).get('uptime'))
+        return status
+
+    async def async_get_channel_state(self, channel: int = None) -> Any:
+        """The state of the output component, the device object is for one component so channel is ignored."""
+        status = await self.async_call(self._method('GetStatus'), {'id': self.channel})
+        if status is None:
+            return None
+        self._status = status
+        return self._parse_channel_state(status)
+
+    async def async_get_actions(self) -> Any:
+        """Gen2 devices push their changes over the socket, they have no action URLs to set"""
+        return None
+
+    async def async_get_status_channel_state(self) -> Any:
+        """The component status is already complete, there is no bigger status to read."""
+        return await self.async_get_channel_state()
+
+    async def async_get_status_channel_states(self) -> Any:
+        state = await self.async_get_channel_state()
+        if state is None:
+            return None
+        return [state]
+
+    async def async_get_device_is_on(self) -> Optional[bool]:
+        state = await self.async_get_channel_state()
+        if state is None:
+            return None
+        return bool(state.on)
+
+    #
+    # Device Action Functions
+    #
+    def device_reboot(self) -> Any:
+        self.invalidate_config()
+        return self._run(self.async_call('Shelly.Reboot'))
+
+    async def async_device_set_on_state(self, state: POWER_STATE, timer: int = None, channel: int = None) -> Any:
+        """Set the output, the state it ends up in is worked out from the answer rather than read again"""
+        if state == POWER_STATE.Toggle:
+            result = await self.async_call(self._method('Toggle'), {'id': self.channel})
+            if result is None:
+                return None
+            on = not result.get('was_on', False)
+        else:
+            on = (state == POWER_STATE.On)
+            params = {'id': self.channel, 'on': on}
+            if timer is not None:
+                params['toggle_after'] = timer
+            if await self.async_call(self._method('Set'), params) is None:
+                return None
+        return await self._changed({'output': on})
+
+    def device_set_color(self, color: LED_COLOR) -> Any:
+        return self._run(self.async_device_set_color(color))
+
+    async def async_device_set_color(self, color: LED_COLOR) -> Any:
+        """Lights only have on and brightness, the color values are ignored"""
+        params = {'id': self.channel}
+        change = {}
+        if color.on is not None:
+            params['on'] = change['output'] = bool(color.on)
+        if color.brightness is not None:
+            params['brightness'] = change['brightness'] = max(0, min(100, color.brightness))
+        if color.transition is not None:
+            params['transition_duration'] = color.transition / 1000.0
+        if await self.async_call(self._method('Set'), params) is None:
+            return None
+        return await self._changed(change)
+
+    async def async_call(self, method: str, params: Dict[str, Any] = None) -> Any:
+        """
+        Send an RPC request over the device socket and return its result.  Returns None if
+        the device did not answer in time, raises DeviceConnectorError if it can't be reached
+        and DeviceRpcError if it answered with an error.
+        """
+        if method.endswith('.SetConfig'):
+            self.invalidate_config()
+        if not self.connected and not await self.reachability.check(self.host):
+            self.stats.unreachable += 1
+            raise DeviceConnectorError
+        await self._connect()
+        ws = self._ws
+        if ws is None:
+            self.stats.connect_errors += 1
+            raise DeviceConnectorError
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        start = time.perf_counter()
+        try:
+            await ws.send_str(json.dumps({'id': request_id, 'src': RPC_CLIENT_ID, 'method': method, 'params': params or {}}))
+            result = await asyncio.wait_for(future, EP_TIMEOUT.total)
+        except asyncio.TimeoutError:
+            self.stats.timeouts += 1
+            if not await self.reachability.probe(self.host):
+                raise DeviceConnectorError
+            return None
+        except DeviceRpcError:
+            self.stats.http_errors += 1
+            raise
+        except (DeviceConnectorError, ClientError, ConnectionError):
+            self.stats.connect_errors += 1
+            raise DeviceConnectorError
+        finally:
+            self._pending.pop(request_id, None)
+        self.stats.observe(method, time.perf_counter() - start)
+        return result
+
+    async def async_close(self) -> None:
+        """Close the socket for good, on the device loop"""
+        self._closed = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        await self._drop()
+
+    #
+    # Private functions, these all run on the device loop
+    #
+    def _method(self, name: str) -> str:
+        return self.component.capitalize() + '.' + name
+
+    def _parse_channel_state(self, status: dict) -> Any:
+        energy = (status.get('aenergy') or {}).get('total')  # Wh, on the PM models
+        if self.component == COMPONENT_LIGHT:
+            return LED_COLOR(on=status.get('output'), brightness=status.get('brightness'), power=status.get('apower'), energy=energy)
+        timer_remaining = None
+        if status.get('timer_started_at') is not None and status.get('timer_duration') is not None:
+            timer_remaining = max(0, int(status['timer_started_at'] + status['timer_duration'] - time.time()))
+        return RELAY_STATE(on=status.get('output'), timer_remaining=timer_remaining, source=status.get('source'),
+                           power=status.get('apower'), energy=energy)
+
+    async def _changed(self, change: Dict[str, Any]) -> Any:
+        """The state after a command, from the last known status with the change applied"""
+        if not self._status:
+            return await self.async_get_channel_state()
+        self._status.update(change)
+        return self._parse_channel_state(self._status)
+
+    async def _connect(self) -> None:
+        """Open the socket if it is not open, raises DeviceConnectorError if the device can't be reached"""
+        if self.connected:
+            return
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.connected or self._closed:
+                return
+            try:
+                ws = await asyncio.wait_for(
+                    self._get_session().ws_connect('ws://' + self.host + '/rpc', heartbeat=WS_HEARTBEAT),
+                    EP_TIMEOUT.total)
+            except (ClientError, OSError, asyncio.TimeoutError):
+                self.stats.connect_errors += 1
+                self.reachability.mark_down()
+                raise DeviceConnectorError
+            self.reachability.mark_up()
+            self._ws = ws
+            get_device_loop().spawn(self._read(ws))
+            self._renew = asyncio.get_running_loop().call_later(WS_HEARTBEAT, self._renew_push)
+        # the first request registers us for the device notifications, and brings the state up to date
+        get_device_loop().spawn(self._resync())
+
+    async def _resync(self) -> None:
+        try:
+            status = await self.async_call(self._method('GetStatus'), {'id': self.channel})
+        except Exception:
+            return
+        if status is not None:
+            self._status = status
+            self._push(status)
+
+    async def _read(self, ws: Any) -> None:
+        try:
+            async for message in ws:
+                if message.type == WSMsgType.TEXT:
+                    self.bytes_received += len(message.data)
+                    self._frame(self._json_loads(message.data))
+                elif message.type == WSMsgType.ERROR:
+                    break
+        finally:
+            self._disconnected(ws)
+
+    def _frame(self, frame: Dict[str, Any]) -> None:
+        future = self._pending.get(frame.get('id'))
+        if future is not None:
+            if not future.done():
+                if 'error' in frame:
+                    error = frame['error'] or {}
+                    future.set_exception(DeviceRpcError(error.get('code'), error.get('message')))
+                else:
+                    # some methods answer with a null result, keep None for 'no answer'
+                    result = frame.get('result')
+                    future.set_result(result if result is not None else {})
+            return
+        if frame.get('method') in ('NotifyStatus', 'NotifyFullStatus'):
+            status = (frame.get('params') or {}).get(self.primary_output_channel)
+            if status is not None:
+                self._status.update(status)
+                self._push(status)
+
+    def _push(self, status: Dict[str, Any]) -> None:
+        """Hand the values in a component status to the node, in the names the Gen1 pushes use"""
+        if self.on_push is None:
+            return
+        state = {}
+        if 'output' in status:
+            state['ison'] = status['output']
+        if 'brightness' in status:
+            state['gain'] = status['brightness']
+        if 'apower' in status:
+            state['power'] = status['apower']
+        if (status.get('aenergy') or {}).get('total') is not None:
+            state['energy'] = status['aenergy']['total']
+        self.on_push(state, PUSH_VALID_FOR)
+
+    def _renew_push(self) -> None:
+        """The socket is still open (the heartbeat drops it otherwise), so the device is still pushing"""
+        if not self.connected:
+            return
+        self._push({})
+        self._renew = asyncio.get_running_loop().call_later(WS_HEARTBEAT, self._renew_push)
+
+    def _disconnected(self, ws: Any) -> None:
+        if self._ws is ws:
+            self._ws = None
+        if self._renew is not None:
+            self._renew.cancel()
+            self._renew = None
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(DeviceConnectorError())
+        if not self._closed and (self._reconnect_task is None or self._reconnect_task.done()):
+            self._reconnect_task = get_device_loop().spawn(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        delay = RECONNECT_MIN
+        while not self._closed and not self.connected:
+            await asyncio.sleep(delay)
+            try:
+                await self._connect()
+            except DeviceConnectorError:
+                delay = min(delay * 2, RECONNECT_MAX)
+
+    async def _drop(self) -> None:
+        if self._ws is not None:
+            await self._ws.close()
@@ -0,0 +1,116 @@
+import asyncio
+import threading
+import concurrent.futures
+from typing import Any, Coroutine, Optional, Set
+
+from aiohttp import ClientSession, TCPConnector
+
+CONNECTIONS_PER_HOST = 2   # Gen1 devices only have a few sockets, don't open more than this to any one of them
+KEEPALIVE_TIMEOUT    = 30  # seconds an idle connection to a device is kept open for reuse
+STOP_TIMEOUT         = 5   # seconds to wait for the session to close when stopping
+
+
+class ShellyDevice_Loop:
+    """Long lived background event loop and pooled ClientSession shared by all the Shelly devices"""
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._session: Optional[ClientSession] = None
+        self._lock = threading.Lock()
+        self._tasks: Set[asyncio.Task] = set()  # started with spawn(), the loop itself only keeps weak references
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """Get the event loop, starting it if needed."""
+        self.start()
+        return self._loop
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def in_loop_thread(self) -> bool:
+        """True if the caller is running on the device loop thread"""
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def start(self) -> None:
+        """Start the background loop thread.  Safe to call more than once."""
+        with self._lock:
+            if self.is_running:
+                return
+            self._loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run_loop, args=(ready,), name='ShellyDeviceLoop', daemon=True)
+            self._thread.start()
+            ready.wait()
+
+    def stop(self) -> None:
+        """Close the shared session and stop the background loop thread."""
+        with self._lock:
+            if not self.is_running:
+                return
+            try:
+                asyncio.run_coroutine_threadsafe(self._close_session(), self._loop).result(STOP_TIMEOUT)
+            except concurrent.futures.TimeoutError:
+                pass
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(STOP_TIMEOUT)
+            self._thread = None
+
+    def get_session(self) -> ClientSession:
+        """Get the shared keep-alive session.  Must be called from the device loop."""
+        if self._session is None or self._session.closed:
+            connector = TCPConnector(limit_per_host=CONNECTIONS_PER_HOST, keepalive_timeout=KEEPALIVE_TIMEOUT)
+            self._session = ClientSession(connector=connector, raise_for_status=True)
+        return self._session
+
+    def submit(self, coro: Coroutine) -> concurrent.futures.Future:
+        """Schedule a coroutine on the device loop and return a future for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def spawn(self, coro: Coroutine) -> asyncio.Task:
+        """
+        Start a coroutine as a task of its own, kept until it is done.  Must be called from
+        the device loop.  An exception it ends with goes to the loop's exception handler
+        as soon as it happens, rather than when the task is garbage collected.
+        """
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def run(self, coro: Coroutine) -> Any:
+        """Run a coroutine on the device loop and block until it completes."""
+        if self.in_loop_thread():
+            coro.close()
+            raise RuntimeError('Blocking device call made from the device loop, await the coroutine instead')
+        return self.submit(coro).result()
+
+    #
+    # Private functions
+    #
+    def _run_loop(self, ready: threading.Event) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._loop.call_soon(ready.set)
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.close()
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self._loop.call_exception_handler({'message': 'Device loop task failed', 'exception': task.exception(), 'task': task})
+
+    async def _close_session(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+_device_loop = ShellyDevice_Loop()
+
+def get_device_loop() -> ShellyDevice_Loop:
+    """The process wide device loop used by all ShellyDevice classes"""
+    return _device_loop
@@ -3,11 +3,15 @@ import json
 from typing import Any
 from ShellyDevice_Constants import *
 from ShellyDevice_Base import *
+from Color_Conversion import hsv_to_rgbw, kelvin_to_rgbw, rgbw_to_hsv, rgbw_to_kelvin
 
 
 
 class LED_COLOR:
-    def __init__(self,  red: int =None, green: int =None, blue: int =None, white: int =None, brightness: int =None, on: bool = None,timer: int = None):
+    # one is made for every command and status, slots keep them small and quick to build
+    __slots__ = ('red', 'green', 'blue', 'white', 'brightness', 'on', 'timer', 'transition', 'effect', 'power', 'energy')
+
+    def __init__(self,  red: int =None, green: int =None, blue: int =None, white: int =None, brightness: int =None, on: bool = None,timer: int = None, transition: int = None, effect: int = None, power: float = None, energy: float = None):
         """Initialize  the LED color class"""
         self.red         = red
         self.green       = green
@@ -16,8 +20,103 @@ class LED_COLOR:
         self.brightness  = brightness
         self.on          = on
         self.timer       = timer
+        self.transition  = transition
+        self.effect      = effect
+        self.power       = power   # W, read from the device, never sent to it
+        self.energy      = energy  # Wh, the meter's counter
+
+    @staticmethod
+    def from_json(state_dict: dict) -> 'LED_COLOR':
+        """The color state from a color/0 or settings/color/0 response, or a lights[0] settings entry"""
+        return LED_COLOR(
+            red        = state_dict["red"],
+            green      = state_dict["green"],
+            blue       = state_dict["blue"],
+            white      = state_dict["white"],
+            brightness = state_dict["gain"],
+            on         = state_dict["ison"],
+            transition = state_dict.get("transition"),
+            effect     = state_dict.get("effect"),
+            power      = state_dict.get("power"),
+        )
+
+    @staticmethod
+    def from_hsv(hue: float, saturation: float, brightness: int = None, on: bool = None) -> 'LED_COLOR':
+        """The color for hue in degrees and saturation in percent, mixed onto the white channel as Color_Conversion does"""
+        red, green, blue, white = hsv_to_rgbw(hue, saturation)
+        return LED_COLOR(red, green, blue, white, brightness, on)
+
+    @staticmethod
+    def from_kelvin(kelvin: float, brightness: int = None, on: bool = None) -> 'LED_COLOR':
+        """The white of a color temperature in Kelvin, 1000 to 10000"""
+        red, green, blue, white = kelvin_to_rgbw(kelvin)
+        return LED_COLOR(red, green, blue, white, brightness, on)
+
+    def hsv(self):
+        """(hue, saturation) of the channel values, None if they are not all known"""
+        if None in (self.red, self.green, self.blue, self.white):
+            return None
+        return rgbw_to_hsv(self.red, self.green, self.blue, self.white)
+
+    def kelvin(self):
+        """The color temperature of the channel values, 0 if they are not a white, None if they are not all known"""
+        if None in (self.red, self.green, self.blue, self.white):
+            return None
+        return rgbw_to_kelvin(self.red, self.green, self.blue, self.white)
+
+    def merge(self, newer: 'LED_COLOR') -> 'LED_COLOR':
+        """A new LED_COLOR with the values set in newer replacing the ones in this one"""
+        merged = LED_COLOR()
+        for name in LED_COLOR.__slots__:
+            value = getattr(newer, name)
+            setattr(merged, name, value if value is not None else getattr(self, name))
+        return merged
+
     def __str__(self):
-        return "LED Colors: red=" + str(self.red) + ",  green=" + str(self.green) + ",  blue=" + str(self.blue) + ",  white=" + str(self.white) + ",  brightness=" + str(self.brightness) + ",  on=" + str(self.on)  + ",  timer=" + str(self.timer)
+        return "LED Colors: red=" + str(self.red) + ",  green=" + str(self.green) + ",  blue=" + str(self.blue) + ",  white=" + str(self.white) + ",  brightness=" + str(self.brightness) + ",  on=" + str(self.on)  + ",  timer=" + str(self.timer) + ",  transition=" + str(self.transition) + ",  effect=" + str(self.effect)
+
+
+def build_color_cmd(color: LED_COLOR) -> str:
+    """Build the color/0 request for the values set in color"""
+    cmd = "color/0?"
+    joiner = ''
+    if (color.red != None) and  (0 <= color.red <= 255):
+        cmd += joiner + "red="+str(color.red)
+        joiner = '&'
+    if  (color.green != None) and  (0 <= color.green <= 255):
+        cmd += joiner + 'green='+str(color.green)
+        joiner = '&'
+    if  (color.blue != None) and  (0 <= color.blue <= 255):
+        cmd += joiner + 'blue='+str(color.blue)
+        joiner = '&'
+    if  (color.white != None) and  (0 <= color.white <= 255):
+        cmd += joiner + 'white='+str(color.white)
+        joiner = '&'
+    if  (color.brightness != None) and  (0 <= color.brightness <= 100):
+        cmd += joiner + 'gain='+str(color.brightness)
+        joiner = '&'
+    if color.on == 1:
+        cmd += joiner + 'turn=on'
+        joiner = '&'
+    if color.on == 0:
+        cmd += joiner + 'turn=off'
+        joiner = '&'
+    if color.timer != None:
+        cmd += joiner + 'timer='+str(color.timer)
+        joiner = '&'
+    return cmd
+
+
+def build_color_set(color: LED_COLOR, brightness_key: str = 'gain') -> str:
+    """The JSON for a color/N/set or white/N/set MQTT topic, with the values build_color_cmd would send"""
+    payload = {}
+    for name, key, top in (('red', 'red', 255), ('green', 'green', 255), ('blue', 'blue', 255), ('white', 'white', 255), ('brightness', brightness_key, 100)):
+        value = getattr(color, name)
+        if value != None and 0 <= value <= top:
+            payload[key] = value
+    if color.on != None:
+        payload['turn'] = 'on' if color.on else 'off'
+    return json.dumps(payload)
 
 
 class ShellyDevice_RGBW2(ShellyDevice_Base):
@@ -35,26 +134,19 @@ class ShellyDevice_RGBW2(ShellyDevice_Base):
     #
     def get_device_color_settings(self) -> Any:
             """Retrieve the device settings for color mode."""
-            return asyncio.run( self._send_request( "settings/color/0"))
+            return self._run( self._send_request( "settings/color/0"))
 
     def get_device_color_state(self) -> Any:
             """Retrieve the device settings for color mode."""
-            return asyncio.run( self._send_request( "color/0"))
+            return self._run( self._send_request( "color/0"))
 
     def get_device_color(self) -> LED_COLOR:
             """is the device turned on or not"""
-            json_state =  self.get_device_color_state()
-            state_dict = json.loads(json_state)
-            color = LED_COLOR(
-                red        = state_dict["red"],
-                green      = state_dict["green"],
-                blue       = state_dict["blue"],
-                white      = state_dict["white"],
-                brightness = state_dict["gain"],
-                on         = state_dict["ison"],
-            )
-            return color
+            return self._run( self._send_channel_request( "color/0"))
 
+    def _parse_channel_state(self, state_dict: dict) -> LED_COLOR:
+        """The color channel answers with the light state"""
+        return LED_COLOR.from_json(state_dict)
 
     #
     # Device Action Functions
@@ -63,80 +155,116 @@ class ShellyDevice_RGBW2(ShellyDevice_Base):
         """Set one of the effects from COLOR_EFFECT."""
         if not effect in range(0,4):
             return None
+        return self._run( self.async_device_set_color_effect(effect))
+
+    async def async_device_set_color_effect(self,effect: int) -> Any:
+        """Set one of the effects from COLOR_EFFECT without blocking the device loop."""
         cmd = "settings/color/0"+ "?effect="+str(effect)
-        return asyncio.run( self._send_request(cmd ))
+        return await self._send_channel_request(cmd )
 
     def device_set_default_color_transition(self,delay: int) -> Any:
         """Set transition time between on/off and color change, [0-5000] ms."""
+        return self._run( self.async_device_set_default_color_transition(delay))
+
+    async def async_device_set_default_color_transition(self,delay: int) -> Any:
+        """Set the transition time without blocking the device loop."""
         cmd = "settings/color/0"+ "?transition="+str(delay)
-        return asyncio.run( self._send_request(cmd ))
+        return await self._send_channel_request(cmd )
 
     def device_set_default_power_on_state(self,state: POWER_ON_STATE) -> Any:
         """Sets default power-on state: on, off or last"""
         cmd = "settings/color/0"+ "?default_state="+state.value
-        return asyncio.run( self._send_request(cmd ))
+        return self._run( self._send_channel_request(cmd ))
 
     def device_set_power_auto_on_time(self,time: int) -> Any:
         """Sets a default timer to turn ON after every OFF command in seconds."""
         cmd = "settings/color/0"+ "?auto_on="+str(time)
-        return asyncio.run( self._send_request(cmd ))
+        return self._run( self._send_channel_request(cmd ))
 
     def device_set_power_auto_off_time(self,time: int) -> Any:
         """Sets a default timer to turn OFF after every ON command in seconds."""
         cmd = "settings/color/0"+ "?auto_off="+str(time)
-        return asyncio.run( self._send_request(cmd ))
+        return self._run( self._send_channel_request(cmd ))
 
     def device_set_button_type(self,type: BUTTON_INPUT_TYPE) -> Any:
         """Input type: momentary, toggle, edge, detached or action."""
         cmd = "settings/color/0"+ "?btn_type="+type.value
-        return asyncio.run( self._send_request(cmd ))
+        return self._run( self._send_channel_request(cmd ))
 
     def device_set_button_invert_external_input(self,state: bool) -> Any:
         """Whether to invert external switch input."""
         cmd = "settings/color/0"+ "?btn_reverse="+str(int(state))
-        return asyncio.run( self._send_request(cmd ))
+        return self._run( self._send_channel_request(cmd ))
 
     def device_set_schedule_enabled(self,state: bool) -> Any:
         """Enable or disable schedule timer."""
         cmd = "settings/color/0"+ "?schedule="+str(int(state))
-        return asyncio.run( self._send_request(cmd ))
+        return self._run( self._send_channel_request(cmd ))
 
     def device_set_one_shot_color_transition(self,delay: int) -> Any:
         """Set one-shot transition time between on/off and color change, [0-5000] ms."""
         cmd = "color/0"+ "?transition="+str(delay)
-        return asyncio.run( self._send_request(cmd ))
+        return self._run( self._send_channel_request(cmd ))
 
     def device_set_color(self,color: LED_COLOR ) -> Any:
         """Set the RGBW and brightness values."""
-        cmd = "color/0?"
-        joiner = ''
-        if (color.red != None) and  (0 <= color.red <= 255):
-            cmd += joiner + "red="+str(color.red)
-            joiner = '&'
-        if  (color.green != None) and  (0 <= color.green <= 255):
-            cmd += joiner + 'green='+str(color.green)
-            joiner = '&'
-        if  (color.blue != None) and  (0 <= color.blue <= 255):
-            cmd += joiner + 'blue='+str(color.blue)
-            joiner = '&'
-        if  (color.white != None) and  (0 <= color.white <= 255):
-            cmd += joiner + 'white='+str(color.white)
-            joiner = '&'
-        if  (color.brightness != None) and  (0 <= color.brightness <= 100):
-            cmd += joiner + 'gain='+str(color.brightness)
-            joiner = '&'
-        if color.on == 1:
-            cmd += joiner + 'turn=on'
-            joiner = '&'
-        if color.on == 0:
-            cmd += joiner + 'turn=off'
-            joiner = '&'
-        if color.timer != None:
-            cmd += joiner + 'timer='+str(color.timer)
-            joiner = '&'
-        return asyncio.run( self._send_request(cmd ))
+        return self._run(self.async_device_set_color(color))
+
+    async def async_device_set_color(self,color: LED_COLOR ) -> Any:
+        """Set the RGBW and brightness values without blocking the device loop, over MQTT if the device is publishing there."""
+        if color.timer == None and self.mqtt is not None and self.mqtt.live:
+            self.mqtt.publish('color/0/set', build_color_set(color))
+            return None
+        return await self._send_channel_request(build_color_cmd(color))
 
     def device_on_with_color(self, red: int =None, green: int =None, blue: int =None, white: int =None, brightness: int =None, on: bool = None, timer: int = None) -> Any:
         color = LED_COLOR(red, green, blue, white, brightness, on, timer )
         return self.device_set_color(color)
 
+    def device_set_hsv(self, hue: float, saturation: float, brightness: int = None) -> Any:
+        """Set the color by hue (degrees) and saturation (percent)."""
+        return self.device_set_color(LED_COLOR.from_hsv(hue, saturation, brightness))
+
+    def device_set_color_temperature(self, kelvin: float, brightness: int = None) -> Any:
+        """Set a white by its color temperature, [1000-10000] K."""
+        return self.device_set_color(LED_COLOR.from_kelvin(kelvin, brightness))
+
+
+
+class ShellyDevice_RGBW2_White(ShellyDevice_Base):
+    """Controller class for the Shelly_RGBW2 in white mode, four dimmable channels white/0 to white/3."""
+
+    def __init__(self, host: str, user: str = None, pwd: str = None,session: ClientSession = None):
+        super().__init__( host, user, pwd, session)
+        self.primary_output_channel  = 'white/0'
+        self.primary_status_channel = 'lights'
+        self.channel_count = 4
+
+    def _parse_channel_state(self, state_dict: dict) -> LED_COLOR:
+        """A white channel has only on, brightness and transition"""
+        return LED_COLOR(
+            brightness = state_dict["brightness"],
+            on         = state_dict["ison"],
+            transition = state_dict.get("transition"),
+            power      = state_dict.get("power"),
+        )
+
+    def device_set_white(self, color: LED_COLOR, channel: int = 0) -> Any:
+        """Set the on state and brightness of one channel, the color values are ignored."""
+        return self._run(self.async_device_set_white(color, channel))
+
+    async def async_device_set_white(self, color: LED_COLOR, channel: int = 0) -> Any:
+        """Set one channel without blocking the device loop, over MQTT if the device is publishing there."""
+        if color.timer == None and color.transition == None and self.mqtt is not None and self.mqtt.live:
+            self.mqtt.publish(self.channel_endpoint(channel) + '/set', build_color_set(LED_COLOR(brightness=color.brightness, on=color.on), 'brightness'))
+            return None
+        params = []
+        if (color.brightness != None) and  (0 <= color.brightness <= 100):
+            params.append("brightness=" + str(color.brightness))
+        if color.on != None:
+            params.append("turn=" + ("on" if color.on else "off"))
+        if color.timer != None:
+            params.append("timer=" + str(color.timer))
+        if color.transition != None:
+            params.append("transition=" + str(color.transition))
+        return await self._send_channel_request(self.channel_endpoint(channel) + "?" + "&".join(params))
@@ -0,0 +1,102 @@
+#
+#
+#  Device reachability
+#
+#  Whether a device can be reached at all, so an unplugged device does not cost the
+#  full request timeout on every poll.  A request that times out is followed by a
+#  short TCP connect probe: a device that does not even accept a connection is marked
+#  down, and requests to it then fail straight away with DeviceConnectorError.  A
+#  down device is probed again at most every PROBE_INTERVAL seconds, and is up again
+#  as soon as a probe or a request gets through.
+#
+
+import asyncio
+import time
+from typing import Optional, Tuple
+
+PROBE_TIMEOUT  = 0.5  # seconds for a TCP connect, a device on the LAN accepts in a few ms
+PROBE_INTERVAL = 10   # seconds a down device is not probed again for, requests fail straight away meanwhile
+DEFAULT_PORT   = 80
+
+
+def split_host(host: str) -> Tuple[str, int]:
+    """The address and port of a device host, which is an IP with an optional :port"""
+    address, sep, port = host.rpartition(':')
+    if sep and port.isdigit() and ':' not in address:
+        return address, int(port)
+    return host, DEFAULT_PORT
+
+
+class DeviceReachability:
+    """Reachability of one device, on the device loop"""
+
+    def __init__(self):
+        self.reachable: Optional[bool] = None  # None until a request or probe has been made
+        self.changed = 0.0                     # monotonic time reachable last changed
+        self.probes = 0
+        self._last_probe = 0.0
+        self._probe: Optional[asyncio.Future] = None  # probe in flight, shared by the requests waiting for it
+
+    @property
+    def down(self) -> bool:
+        return self.reachable is False
+
+    def mark_up(self) -> None:
+        self._set(True)
+
+    def mark_down(self) -> None:
+        self._set(False)
+        self._last_probe = time.monotonic()
+
+    def recheck(self) -> None:
+        """Probe a down device on the next request rather than waiting out PROBE_INTERVAL, e.g. when it is sent a command"""
+        self._last_probe = 0.0
+
+    def reset(self) -> None:
+        """Forget what is known, e.g. after the device moved to another IP"""
+        self.reachable = None
+        self._last_probe = 0.0
+
+    async def check(self, host: str) -> bool:
+        """
+        Before a request: True if it is worth sending.  A device known to be down is probed
+        again once PROBE_INTERVAL has passed, until then it is reported down without any traffic.
+        """
+        if not self.down:
+            return True
+        if time.monotonic() - self._last_probe < PROBE_INTERVAL:
+            return False
+        return await self.probe(host)
+
+    async def probe(self, host: str) -> bool:
+        """Try a TCP connect to the device and record the outcome.  Concurrent callers share one probe."""
+        if self._probe is None or self._probe.done():
+            self._probe = asyncio.ensure_future(self._connect(host))
+        reachable = await asyncio.shield(self._probe)
+        if reachable:
+            self.mark_up()
+        else:
+            self.mark_down()
+        return reachable
+
+    #
+    # Private functions
+    #
+    def _set(self, reachable: bool) -> None:
+        if self.reachable != reachable:
+            self.reachable = reachable
+            self.changed = time.monotonic()
+
+    async def _connect(self, host: str) -> bool:
+        self.probes += 1
+        address, port = split_host(host)
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(address, port), PROBE_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return True
@@ -12,3 +12,17 @@ class ShellyDevice_Shelly1(ShellyDevice_Base):
         self.primary_output_channel  = 'relay/0'
         self.primary_status_channel = 'relays'
 
+
+class ShellyDevice_Shelly25(ShellyDevice_Shelly1):
+    """Controller class for the Shelly 2.5 in relay mode, relay/0 and relay/1"""
+
+    def __init__(self, host: str, user: str = None, pwd: str = None, session: ClientSession = None):
+        super().__init__( host, user, pwd, session)
+        self.channel_count = 2
+
+class ShellyDevice_Shelly4Pro(ShellyDevice_Shelly1):
+    """Controller class for the Shelly 4Pro, relay/0 to relay/3"""
+
+    def __init__(self, host: str, user: str = None, pwd: str = None, session: ClientSession = None):
+        super().__init__( host, user, pwd, session)
+        self.channel_count = 4
@@ -0,0 +1,200 @@
+#
+#
+#  Request statistics
+#
+#  Latency histograms and error counters for the device requests, the node status
+#  updates and the poll cycles, so a slow or flaky device can be picked out of the log
+#  or from the optional stats endpoint (Prometheus text or JSON).
+#
+
+import bisect
+from typing import Any, Dict, List, Optional, Tuple
+
+# bucket upper bounds in seconds, the last bucket holds everything slower
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+CYCLE_BUCKETS   = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class LatencyHistogram:
+    """Counts of durations per bucket, plus their count, sum and maximum"""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other: 'LatencyHistogram') -> None:
+        """Add the observations of other, which must have the same buckets"""
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound of the bucket the fraction falls in, the maximum if it is in the last bucket"""
+        if self.count == 0:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return min(self.buckets[index], self.max) if index < len(self.buckets) else self.max
+        return self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'count': self.count,
+            'sum': round(self.total, 6),
+            'max': round(self.max, 6),
+            'p50': round(self.percentile(0.50), 6),
+            'p99': round(self.percentile(0.99), 6),
+            'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts)),
+        }
+
+
+class DeviceStats:
+    """Request latency per endpoint and error counts of one device"""
+
+    def __init__(self):
+        self.endpoints: Dict[str, LatencyHistogram] = {}
+        self.timeouts = 0
+        self.auth_retries = 0
+        self.connect_errors = 0
+        self.http_errors = 0
+        self.cache_hits = 0  # /shelly and /settings reads answered from the device's config cache
+        self.unreachable = 0  # requests failed straight away because the device is known to be down
+
+    def observe(self, endpoint: str, seconds: float) -> None:
+        """A request answered, the query string is left out so settings/color/0?... all count as one endpoint"""
+        endpoint = endpoint.split('?', 1)[0]
+        histogram = self.endpoints.get(endpoint)
+        if histogram is None:
+            histogram = LatencyHistogram()
+            self.endpoints[endpoint] = histogram
+        histogram.observe(seconds)
+
+    @property
+    def requests(self) -> int:
+        return sum(histogram.count for histogram in self.endpoints.values())
+
+    @property
+    def errors(self) -> int:
+        return self.timeouts + self.connect_errors + self.http_errors
+
+    def latency(self) -> LatencyHistogram:
+        """All the endpoints together"""
+        combined = LatencyHistogram()
+        for histogram in self.endpoints.values():
+            combined.merge(histogram)
+        return combined
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'requests': self.requests,
+            'timeouts': self.timeouts,
+            'auth_retries': self.auth_retries,
+            'connect_errors': self.connect_errors,
+            'http_errors': self.http_errors,
+            'cache_hits': self.cache_hits,
+            'unreachable': self.unreachable,
+            'endpoints': {endpoint: histogram.to_dict() for endpoint, histogram in self.endpoints.items()},
+        }
+
+
+class StatsSource:
+    """What the stats report shows for one device node"""
+    def __init__(self, address: str, name: str, host: str, device: DeviceStats, update_time: Optional[LatencyHistogram], meters: Dict[str, Any] = None):
+        self.address = address
+        self.name = name
+        self.host = host
+        self.device = device
+        self.update_time = update_time
+        self.meters = meters or {}  # PowerMeter by channel number, of the outputs that have had a reading
+
+
+def stats_json(sources: List[StatsSource], poll_cycles: LatencyHistogram) -> Dict[str, Any]:
+    return {
+        'poll_cycle_seconds': poll_cycles.to_dict(),
+        'devices': {
+            source.address: {
+                'name': source.name,
+                'host': source.host,
+                'requests': source.device.to_dict(),
+                'update_seconds': source.update_time.to_dict() if source.update_time is not None else None,
+                'power': {channel: meter.to_dict() for channel, meter in source.meters.items()},
+            } for source in sources
+        },
+    }
+
+
+def stats_prometheus(sources: List[StatsSource], poll_cycles: LatencyHistogram) -> str:
+    """The stats in the Prometheus text exposition format"""
+    lines = []
+
+    def histogram(metric: str, labels: str, values: LatencyHistogram) -> None:
+        cumulative = 0
+        for bound, count in zip([str(bound) for bound in values.buckets] + ['+Inf'], values.counts):
+            cumulative += count
+            lines.append(metric + '_bucket{' + labels + (',' if labels else '') + 'le="' + bound + '"} ' + str(cumulative))
+        braces = '{' + labels + '}' if labels else ''
+        lines.append(metric + '_sum' + braces + ' ' + repr(round(values.total, 6)))
+        lines.append(metric + '_count' + braces + ' ' + str(values.count))
+
+    lines.append('# HELP shelly_request_duration_seconds Time for a device to answer a request')
+    lines.append('# TYPE shelly_request_duration_seconds histogram')
+    for source in sources:
+        for endpoint, values in sorted(source.device.endpoints.items()):
+            histogram('shelly_request_duration_seconds', _labels(source, endpoint=endpoint), values)
+
+    for counter, help_text in (('timeouts', 'Requests the device did not answer in time'),
+                               ('auth_retries', 'Requests retried after a 401'),
+                               ('connect_errors', 'Requests that could not connect to the device'),
+                               ('http_errors', 'Requests the device answered with an HTTP error'),
+                               ('cache_hits', 'Identity and settings reads answered from the cache'),
+                               ('unreachable', 'Requests not sent because the device is down')):
+        metric = 'shelly_request_' + counter + '_total'
+        lines.append('# HELP ' + metric + ' ' + help_text)
+        lines.append('# TYPE ' + metric + ' counter')
+        for source in sources:
+            lines.append(metric + '{' + _labels(source) + '} ' + str(getattr(source.device, counter)))
+
+    lines.append('# HELP shelly_node_update_seconds Time to fetch a status and update the node drivers')
+    lines.append('# TYPE shelly_node_update_seconds histogram')
+    for source in sources:
+        if source.update_time is not None:
+            histogram('shelly_node_update_seconds', _labels(source), source.update_time)
+
+    for metric, help_text, value in (('shelly_power_watts', 'Power of an output, from its meter', lambda meter: meter.power),
+                                     ('shelly_energy_today_watthours', 'Energy an output used today', lambda meter: round(meter.today, 3))):
+        lines.append('# HELP ' + metric + ' ' + help_text)
+        lines.append('# TYPE ' + metric + ' gauge')
+        for source in sources:
+            for channel, meter in sorted(source.meters.items()):
+                if value(meter) is not None:
+                    lines.append(metric + '{' + _labels(source, channel=channel) + '} ' + repr(value(meter)))
+
+    lines.append('# HELP shelly_poll_cycle_seconds Time for a poll cycle of all the due devices')
+    lines.append('# TYPE shelly_poll_cycle_seconds histogram')
+    histogram('shelly_poll_cycle_seconds', '', poll_cycles)
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(source: StatsSource, **extra: str) -> str:
+    labels = {'address': source.address, 'name': source.name, 'host': source.host}
+    labels.update(extra)
+    return ','.join(key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for key, value in labels.items())
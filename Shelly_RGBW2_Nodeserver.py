@@ -6,28 +6,92 @@ This is a NodeServer for the Shelly RGBW written by TangoWhiskey1
 import udi_interface
 import sys
 import time
+import threading
 import logging
 from copy import deepcopy
 from types import BuiltinFunctionType
 from typing import Any
 from device_finder import Device_Finder
 
-from ShellyDevice_RGBW2 import ShellyDevice_RGBW2
-from ShellyDevice_Shelly1 import ShellyDevice_Shelly1
+from ShellyDevice_RGBW2 import ShellyDevice_RGBW2, ShellyDevice_RGBW2_White
+from ShellyDevice_Shelly1 import ShellyDevice_Shelly25, ShellyDevice_Shelly4Pro
+from ShellyDevice_Gen2 import ShellyDevice_Gen2
+from ShellyDevice_Constants import POWER_STATE
+from ShellyDevice_Loop import get_device_loop
+from Poll_Scheduler import PollScheduler, DEFAULT_MAX_CONCURRENT
+from Scene_Dispatcher import SceneDispatcher
+from State_Snapshot import StateSnapshot, SNAPSHOT_KEY
+from Device_Credentials import DeviceCredentials, AUTH_PARAM_PREFIX
+from CoIoT_Listener import CoIoTListener
+from MQTT_Listener import MqttListener, MQTT_DEFAULT_PORT
+from Local_Http_Server import LocalHttpServer
+from Action_Receiver import ActionReceiver, ACTION_PATH
+from ShellyDevice_Stats import LatencyHistogram, StatsSource, stats_json, stats_prometheus
+from aiohttp import web
 from Node_Shared import *
 from RGBW2_Node import *
 from Shelly1_Node import *
+from MultiChannel_Node import MultiChannel_Node, RelayChannel_Node, WhiteChannel_Node
 
 _MIN_IP_ADDR_LEN = 6
 
 _NETWORK_DEVICE_IDS = { 
     'shellyrgbw2-' : 'RGBW2_' ,
-    'shelly1-' :    'SHELLY1_'
+    'shelly1-' :    'SHELLY1_',
+    'shellyplus1-' : 'SHELLYPLUS1_',
+    'shellyswitch25-' : 'SHELLY25_',
+    'shelly4pro-' : 'SHELLY4PRO_',
     }
 
+# An RGBW2 in white mode is four dimmers rather than one color light.  It is found as an RGBW2,
+# the name it is saved under says which mode it is in.
+_RGBW2_WHITE_ID = 'RGBW2WHITE_'
+_DEVICE_TYPE_IDS = list(_NETWORK_DEVICE_IDS.values()) + [_RGBW2_WHITE_ID]
+
+# devices with several outputs: the device class and the node class of each channel
+_MULTI_CHANNEL_DEVICES = {
+    'SHELLY25' : (ShellyDevice_Shelly25, RelayChannel_Node),
+    'SHELLY4PRO' : (ShellyDevice_Shelly4Pro, RelayChannel_Node),
+    'RGBW2WHITE' : (ShellyDevice_RGBW2_White, WhiteChannel_Node),
+    }
+
+# Custom Params keys that configure the nodeserver rather than name a device
+_SETTING_POLL_CONCURRENCY = 'PollConcurrency'
+_SETTING_COIOT = 'CoIoT'
+_SETTING_POLL_MODE = 'PollMode'
+_SETTING_AUTO_ADD = 'AutoAddDevices'
+_SETTING_STATS_PORT = 'StatsPort'
+_SETTING_DEVICE_USER = 'DeviceUser'
+_SETTING_DEVICE_PASSWORD = 'DevicePassword'
+_SETTING_ACTION_PORT = 'ActionPort'
+_SETTING_PROVISION_ACTIONS = 'ProvisionActions'
+_SETTING_MQTT_BROKER = 'MqttBroker'
+_SETTING_MQTT_USER = 'MqttUser'
+_SETTING_MQTT_PASSWORD = 'MqttPassword'
+_CONTROLLER_SETTINGS = {
+    _SETTING_POLL_CONCURRENCY : str(DEFAULT_MAX_CONCURRENT),
+    _SETTING_COIOT : 'true',
+    _SETTING_POLL_MODE : 'channel',
+    _SETTING_AUTO_ADD : 'true',
+    _SETTING_STATS_PORT : '0',
+    _SETTING_DEVICE_USER : '',
+    _SETTING_DEVICE_PASSWORD : '',
+    _SETTING_ACTION_PORT : '0',
+    _SETTING_PROVISION_ACTIONS : 'true',
+    _SETTING_MQTT_BROKER : '',
+    _SETTING_MQTT_USER : '',
+    _SETTING_MQTT_PASSWORD : '',
+    }
+
+_STATS_SLOWEST_DEVICES = 3  # devices listed by name in the longPoll stats summary, besides any with errors
+
 LOGGER = udi_interface.LOGGER
 Custom = udi_interface.Custom
 
+def device_id(device_name)->str:
+    """The device part of a saved name, e.g. 'A1B2C3' of RGBW2_A1B2C3, the same whatever type prefix it is saved with"""
+    return device_name.partition('_')[2]
+
 #
 #
 #  Controller Class
@@ -40,14 +104,42 @@ class RGBW2Controller(object):
         self.poly = polyglot
 
         LOGGER.debug('Entered init')
+        startup_timer.start()
 
         # implementation specific
         self.customParams = Custom(polyglot, 'customparams')
+        self.customData = Custom(polyglot, 'customdata')
+        self.snapshot = StateSnapshot()
+        self.credentials = DeviceCredentials()
+        self.config_done = False  # nodes are added once all the config, and the saved state in it, is in
         self.device_nodes = dict()  #dictionary of ISY address to device Name and device IP address.
         self.configComplete = False
+        self.devices_lock = threading.RLock()
+        self.auto_add_devices = True
+        self.stats_server = None
+        self.action_server = None
+        self.action_receiver = None  # takes the action URL calls of the Gen1 devices, while action_server runs
+        self.provision_actions = True
+        self.mqtt_config = {}    # broker, user and password from the custom params
+        self.mqtt_started = None  # the config the listener was started with
+
+        # one event loop and pooled http session shared by every device, for the life of the nodeserver
+        self.device_loop = get_device_loop()
+        self.device_loop.start()
+        self.poll_scheduler = PollScheduler(self.device_loop)
+        self.scene_dispatcher = SceneDispatcher(polyglot, self.device_loop)
+        self.coiot_listener = CoIoTListener()
+        self.start_coiot()
+        self.mqtt_listener = MqttListener()
+        self.device_finder = Device_Finder( ['shellyrgbw2','shelly1','shellyplus1','shellyswitch25','shelly4pro'])
+        self.start_discovery()
 
         polyglot.subscribe(polyglot.CUSTOMPARAMS, self.parameterHandler)
+        polyglot.subscribe(polyglot.CUSTOMDATA, self.dataHandler)
+        polyglot.subscribe(polyglot.CONFIGDONE, self.configDoneHandler)
         polyglot.subscribe(polyglot.DISCOVER, self.on_discover)
+        polyglot.subscribe(polyglot.STOP, self.stop)
+        polyglot.subscribe(polyglot.POLL, self.poll)
 
         polyglot.setCustomParamsDoc()
         polyglot.updateProfile()
@@ -58,11 +150,23 @@ class RGBW2Controller(object):
     def parameterHandler(self, params):
         self.poly.Notices.clear()
         self.configComplete = False
+        self.credentials.clear()
+        self.mqtt_config = {}
 
         if params and params != {}:
             for devName in params:
                 device_name = devName.strip()
-                if device_name[:device_name.index('_')+1] not in _NETWORK_DEVICE_IDS.values():
+                if device_name in _CONTROLLER_SETTINGS:
+                    self.apply_setting(device_name, params[devName])
+                    continue
+                if device_name.startswith(AUTH_PARAM_PREFIX):
+                    if not self.credentials.set_device(device_name[len(AUTH_PARAM_PREFIX):], params[devName]):
+                        self.poly.Notices['bad_auth'] = 'Custom Params login ' + device_name + ' must have a value of user:password'
+                        LOGGER.error('Controller: Custom Params login ' + device_name + ' must have a value of user:password')
+                    continue
+                device_type, underscore, _ = device_name.partition('_')
+                if not underscore or device_type + underscore not in _DEVICE_TYPE_IDS:
+                    # not a setting, a login or a device, skip it rather than fail the whole config
                     self.poly.Notices['bad_name'] = 'Custom Params device name format incorrect. Must start with valid Shelly device type, instead found name of ' + device_name
                     LOGGER.error('Controller: Custom Params device name format incorrect. Must start with valid Shelly device type, instead found name of ' + device_name)
                     continue
@@ -77,60 +181,277 @@ class RGBW2Controller(object):
                 self.device_nodes[isy_addr] = [device_name, device_addr]
                 LOGGER.debug('Controller: Added device_node: ' + device_name + ' as isy address ' + isy_addr + ' (' + device_addr + ')')
             
+            self.apply_credentials()
+            self.start_mqtt()
             if len(self.device_nodes) == 0:
                 LOGGER.error('Controller: No valid devices found in config, nothing to do!')
             else:
                 self.configComplete = True
                 self.add_devices()
         else:
-            # No custom parameters, try auto discover
-            self.auto_find_devices()
-            if len(self.device_nodes) > 0:
-                self.configComplete = True
-                self.add_devices()
+            # No custom parameters, add whatever discovery has found.  Nodes are added for the rest as they appear.
+            self.on_discover()
+
+    def dataHandler(self, data):
+        self.customData.load(data)
+        count = self.snapshot.load(self.customData[SNAPSHOT_KEY])
+        if count > 0:
+            LOGGER.info('Controller: saved state of %d nodes loaded', count)
+
+    def configDoneHandler(self):
+        """All the config is in, add the nodes for the devices found in it"""
+        self.config_done = True
+        self.add_devices()
+
+    def save_snapshot(self):
+        """Save the driver values of every node, they are restored when the nodes are created on the next start"""
+        with self.devices_lock:
+            nodes = [(node, self.device_nodes[node.address][0]) for node in self.get_device_node_list()]
+        try:
+            if self.snapshot.save(self.customData, nodes):
+                LOGGER.debug('Controller: saved the state of %d devices', len(nodes))
+        except Exception as ex:
+            LOGGER.error('Controller: unable to save the device state: ' + str(ex))
+
+    def apply_setting(self, name, value):
+        try:
+            if name == _SETTING_POLL_CONCURRENCY:
+                self.poll_scheduler.max_concurrent = int(value)
+            if name == _SETTING_POLL_MODE:
+                self.poll_scheduler.full_every_cycle = (str(value).strip().lower() == 'settings')
+            if name == _SETTING_COIOT:
+                if str(value).strip().lower() in ('false', 'no', 'off', '0'):
+                    self.device_loop.loop.call_soon_threadsafe(self.coiot_listener.stop)
+                else:
+                    self.start_coiot()
+            if name == _SETTING_AUTO_ADD:
+                self.auto_add_devices = str(value).strip().lower() not in ('false', 'no', 'off', '0')
+            if name == _SETTING_STATS_PORT:
+                self.start_stats_server(int(value))
+            if name == _SETTING_ACTION_PORT:
+                self.start_action_server(int(value))
+            if name == _SETTING_PROVISION_ACTIONS:
+                self.provision_actions = str(value).strip().lower() not in ('false', 'no', 'off', '0')
+            if name in (_SETTING_MQTT_BROKER, _SETTING_MQTT_USER, _SETTING_MQTT_PASSWORD):
+                self.mqtt_config[name] = str(value).strip()
+                value = '********' if name == _SETTING_MQTT_PASSWORD and value else value
+            if name == _SETTING_DEVICE_USER:
+                self.credentials.default_user = str(value).strip() or None
+            if name == _SETTING_DEVICE_PASSWORD:
+                self.credentials.default_password = str(value) or None
+                value = '********' if value else value
+            LOGGER.debug('Controller: Setting ' + name + ' = ' + str(value))
+        except ValueError:
+            self.poly.Notices['bad_setting'] = 'Custom Params setting ' + name + ' has an invalid value: ' + str(value)
+            LOGGER.error('Controller: Custom Params setting ' + name + ' has an invalid value: ' + str(value))
+
+    def apply_credentials(self, nodes = None):
+        """Give the device of each node its login, or none"""
+        with self.devices_lock:
+            if nodes is None:
+                nodes = self.get_device_node_list()
+            for node in nodes:
+                credential = self.credentials.get(device_id(self.device_nodes[node.address][0])) or (None, None)
+                node.shelly_device.set_credentials(*credential)
+
+    def start_coiot(self):
+        """Start listening for CoIoT status pushes from the devices, if not already"""
+        def started(future):
+            if future.exception() is not None:
+                LOGGER.error('Controller: Unable to listen for CoIoT, devices will only be polled: ' + str(future.exception()))
+        self.device_loop.submit(self.coiot_listener.start(self.device_loop.loop)).add_done_callback(started)
+
+    def start_mqtt(self):
+        """Connect to the MQTT broker from the custom params, if it changed.  No broker turns MQTT off."""
+        if self.mqtt_config == self.mqtt_started:
+            return
+        self.mqtt_started = dict(self.mqtt_config)
+        broker = self.mqtt_config.get(_SETTING_MQTT_BROKER)
+        if not broker:
+            self.mqtt_listener.stop()
+            return
+        host, _, port = broker.partition(':')
+        try:
+            self.mqtt_listener.start(self.device_loop.loop, host, int(port) if port else MQTT_DEFAULT_PORT,
+                                     self.mqtt_config.get(_SETTING_MQTT_USER), self.mqtt_config.get(_SETTING_MQTT_PASSWORD))
+        except ValueError:
+            self.poly.Notices['bad_setting'] = 'Custom Params setting ' + _SETTING_MQTT_BROKER + ' must be host or host:port, not ' + broker
+            LOGGER.error('Controller: Custom Params setting ' + _SETTING_MQTT_BROKER + ' must be host or host:port, not ' + broker)
+
+    def start_stats_server(self, port):
+        """Serve the request stats on http://<host>:port/metrics (Prometheus) and /stats (JSON), port 0 turns it off"""
+        if self.stats_server is not None:
+            if self.stats_server.port == port:
+                return
+            self.device_loop.submit(self.stats_server.stop())
+            self.stats_server = None
+        if port <= 0:
+            return
+
+        def started(future):
+            if future.exception() is not None:
+                LOGGER.error('Controller: Unable to serve stats on port ' + str(port) + ': ' + str(future.exception()))
+                if self.stats_server is server:
+                    self.stats_server = None
+        server = LocalHttpServer(self.device_loop, port)
+        self.stats_server = server
+        server.add_route('GET', '/metrics', self.on_stats_metrics)
+        server.add_route('GET', '/stats', self.on_stats_json)
+        self.device_loop.submit(server.start()).add_done_callback(started)
+
+    def start_action_server(self, port):
+        """Take the action URL calls of the devices on port (0 turns it off), and set the URLs on them if provision_actions"""
+        if self.action_server is not None:
+            if self.action_server.port == port:
+                return
+            self.device_loop.submit(self.action_server.stop())
+            self.action_server = None
+            self.action_receiver = None
+            for node in self.get_device_node_list():
+                node.push.subscribed = False
+        if port <= 0:
+            return
+
+        def started(future):
+            if future.exception() is not None:
+                LOGGER.error('Controller: Unable to take device actions on port ' + str(port) + ': ' + str(future.exception()))
+                if self.action_server is server:
+                    self.action_server = None
+                    self.action_receiver = None
+                return
+            self.register_actions(self.get_device_node_list())
+        receiver = ActionReceiver(port)
+        server = LocalHttpServer(self.device_loop, port)
+        server.add_route('GET', ACTION_PATH + '{address}/{channel}/{event}', receiver.on_action)
+        self.action_server = server
+        self.action_receiver = receiver
+        self.device_loop.submit(server.start()).add_done_callback(started)
+
+    def register_actions(self, nodes):
+        """Route the action URL calls of the nodes' devices to them, and set the URLs on the devices if provision_actions"""
+        receiver = self.action_receiver
+        if receiver is None or not self.action_server.running:
+            return
+        for node in nodes:
+            receiver.register(node)
+            if not self.provision_actions:
+                continue
+            def provisioned(future, node=node):
+                if future.exception() is not None:
+                    LOGGER.error('Controller: Unable to set the action URLs on ' + node.name + ': ' + str(future.exception()))
+                elif future.result():
+                    LOGGER.debug('Controller: ' + node.name + ' reports its changes, polling it less')
+            self.device_loop.submit(receiver.provision(node)).add_done_callback(provisioned)
+
+    def stats_sources(self) -> list:
+        return [StatsSource(node.address, node.name, node.shelly_device.host, node.shelly_device.stats, node.update_time, self.node_meters(node))
+                for node in self.get_device_node_list()]
+
+    @staticmethod
+    def node_meters(node) -> dict:
+        """The power meters of a device node (or of its channel nodes) that have had a reading, by channel"""
+        if hasattr(node, 'channels'):
+            meters = {str(channel.channel): channel.meter for channel in node.channels}
+        else:
+            meters = {'0': node.meter} if getattr(node, 'meter', None) is not None else {}
+        return {channel: meter for channel, meter in meters.items() if meter.day is not None}
+
+    async def on_stats_metrics(self, request):
+        text = stats_prometheus(self.stats_sources(), self.poll_scheduler.cycle_time)
+        return web.Response(body=text.encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    async def on_stats_json(self, request):
+        return web.json_response(stats_json(self.stats_sources(), self.poll_scheduler.cycle_time))
 
     def start(self):
         """
-        This  runs once the NodeServer connects to Polyglot and gets it's config.
+        This  runs once the NodeServer connects to Polyglot.  The config arrives
+        separately in parameterHandler, which creates the nodes, so nothing here waits on it.
         No need to Super this method, the parent version does nothing.
         """        
         LOGGER.info('Controller: Started ShellyRGBW2 Node Server')
 
-        # if stil no custom configuration, no devices found or given, so nothing to do
-        while not self.configComplete:
+        if not self.configComplete:
             self.poly.Notices['missing'] = "ShellyRGBW2: Waiting for a valid user config"
             LOGGER.info('Waiting for a valid user config')
-            time.sleep(5)
-
-        self.poly.Notices.clear()
 
-        # save devices to customParams (this will trigger handler)
+    def start_discovery(self):
+        """Keep an mDNS browser open on the device loop, it calls device_seen as devices appear or change address"""
+        def started(future):
+            if future.exception() is not None:
+                LOGGER.error('Controller: Unable to start device discovery: ' + str(future.exception()))
+        self.device_loop.submit(self.device_finder.async_start_browsing(self.device_seen, self.device_gone)).add_done_callback(started)
+
+    def device_seen(self, devName, address):
+        """Called on the device loop by the discovery browser, hand it off so adding nodes never blocks the loop"""
+        def added(future):
+            if not future.cancelled() and future.exception() is not None:
+                LOGGER.error('Controller: Unable to add ' + devName + ': ' + str(future.exception()))
+        add_new = self.auto_add_devices or len(self.device_nodes) == 0
+        self.device_loop.loop.run_in_executor(None, self.device_found, devName, address, add_new).add_done_callback(added)
+
+    def device_gone(self, devName):
+        LOGGER.info('Controller: ' + devName + ' has left the network')
+
+    def save_devices(self):
+        """Save the devices to customParams so they are there on the next start (this will trigger handler)"""
         if len(self.device_nodes) > 0:
-            for dev in self.device_nodes:
+            self.poly.Notices.delete('missing')
+            for dev in list(self.device_nodes):
                 self.customParams[self.device_nodes[dev][0]] = self.device_nodes[dev][1]
-                
-
-
-    def auto_find_devices(self) -> bool:
-        self.poly.Notices['auto'] = "Looking for devices on network, this will take few seconds"
-        new_device_found = False
-        finder = Device_Finder( ['shellyrgbw2','shelly1']) 
-        finder.look_for_devices()
 
-        LOGGER.info( "Controller: Found " + str(len(finder.devices)) + " devices:" )
-        for devName in finder.devices:
-            ipAddr = finder.devices[devName][:-3] #remove the port number from the address
-            cleaned_dev_name = self.generate_name(devName)
-            if( cleaned_dev_name == None):
-                LOGGER.error('Controller: Invalid name for device found in config, device not added: ' + devName )
-                continue
+    def device_found(self, devName, address, add_new = True) -> bool:
+        """
+        A device was found on the network.  Known devices that moved to a new IP address are
+        followed, new ones get a node if add_new.  Returns True if a node was added.
+        """
+        ipAddr = address[:address.rindex(':')] #remove the port number from the address
+        cleaned_dev_name = self.generate_name(devName)
+        if( cleaned_dev_name == None):
+            LOGGER.error('Controller: Invalid name for device found in config, device not added: ' + devName )
+            return False
+
+        with self.devices_lock:
+            for isy_addr in self.device_nodes:
+                if device_id(self.device_nodes[isy_addr][0]) == device_id(cleaned_dev_name):
+                    node = self.poly.getNode(isy_addr)
+                    if node and node.shelly_device.host != ipAddr:
+                        self.device_moved(node, ipAddr)
+                    return False
 
             isy_addr = 's'+ipAddr.replace(".","")
+            if isy_addr in self.device_nodes or not add_new:
+                return False
+            if cleaned_dev_name.startswith(_NETWORK_DEVICE_IDS['shellyrgbw2-']):
+                cleaned_dev_name = self.rgbw2_name(cleaned_dev_name, ipAddr)
+            LOGGER.info('Controller: Found ' + cleaned_dev_name + ' at ' + ipAddr)
             self.device_nodes[isy_addr] = [cleaned_dev_name, ipAddr]
-            new_device_found = True
+            self.configComplete = True
+            self.add_devices()
+        self.save_devices()
+        return True
 
-        self.poly.Notices.delete('auto')
-        return new_device_found
+    def device_moved(self, node, ipAddr):
+        """
+        The device got a new IP address.  The node keeps its ISY address and the saved
+        config keeps the first IP, discovery finds the device again after a restart.
+        """
+        LOGGER.info('Controller: ' + node.name + ' moved from ' + node.shelly_device.host + ' to ' + ipAddr)
+        node.device_addr = ipAddr
+        node.shelly_device.host = ipAddr
+        if not isinstance(node, MultiChannel_Node):
+            self.coiot_listener.register(node, ipAddr)
+
+    def rgbw2_name(self, name, ipAddr)->str:
+        """The name for a new RGBW2, by the mode it is in.  Color mode is assumed if it can't be read."""
+        try:
+            settings = ShellyDevice_RGBW2(ipAddr, *(self.credentials.get(device_id(name)) or (None, None))).get_device_settings()
+        except Exception as ex:
+            LOGGER.debug('Controller: reading the mode of ' + name + ': ' + str(ex))
+            return name
+        if settings is not None and settings.get('mode') == 'white':
+            return name.replace(_NETWORK_DEVICE_IDS['shellyrgbw2-'], _RGBW2_WHITE_ID, 1)
+        return name
 
     def generate_name(self, network_device_name)->str:
         try:
@@ -143,29 +464,162 @@ class RGBW2Controller(object):
 
     def add_devices(self):
         LOGGER.debug('Controller: add_devices called')
-        for isy_addr in self.device_nodes.keys():
+        if not self.config_done:
+            return
+        with self.devices_lock:
+            self._add_device_nodes()
+
+    def _add_device_nodes(self):
+        for isy_addr in list(self.device_nodes.keys()):
             if not self.poly.getNode(isy_addr):
                 device_name = self.device_nodes[isy_addr][0]
                 device_addr = self.device_nodes[isy_addr][1]
-                device_type = device_name[:device_name.index('_')] 
+                device_type = device_name.partition('_')[0]
 
+                node = None
                 if device_type == 'RGBW2':
-                    self.poly.addNode( RGBW2_Node(self.poly, isy_addr, isy_addr, device_addr, device_name) )
+                    node = RGBW2_Node(self.poly, isy_addr, isy_addr, device_addr, device_name)
                 if device_type == 'SHELLY1':
-                    self.poly.addNode( Shelly1_Node(self.poly, isy_addr, isy_addr, device_addr, device_name) )
+                    node = Shelly1_Node(self.poly, isy_addr, isy_addr, device_addr, device_name)
+                if device_type == 'SHELLYPLUS1':
+                    node = Shelly1_Node(self.poly, isy_addr, isy_addr, device_addr, device_name, ShellyDevice_Gen2(device_addr))
+                if device_type in _MULTI_CHANNEL_DEVICES:
+                    device_class, channel_class = _MULTI_CHANNEL_DEVICES[device_type]
+                    node = MultiChannel_Node(self.poly, isy_addr, isy_addr, device_addr, device_name, device_class(device_addr), channel_class)
+                if node is not None:
+                    node.poll_scheduler = self.poll_scheduler
+                    node.scene_dispatcher = self.scene_dispatcher
+                    self.apply_credentials([node])
+                    if self.snapshot.restore(node, device_name):
+                        for channel in getattr(node, 'channels', ()):
+                            self.snapshot.restore(channel)
+                    startup_timer.expect(isy_addr)
+                    self.poly.addNode( node )
+                    if isinstance(node, MultiChannel_Node):
+                        # the channels of a device are all in the one /status the device node polls
+                        for channel in node.channels:
+                            self.poly.addNode( channel )
+                    else:
+                        self.coiot_listener.register(node, device_addr, device_id(device_name))
+                    if device_type != 'SHELLYPLUS1':
+                        self.mqtt_listener.register(node, device_id(device_name))
+                    self.register_actions([node])
            
     
+    def poll(self, pollflag):
+        if pollflag == 'shortPoll':
+            self.shortPoll()
+        if pollflag == 'longPoll':
+            self.longPoll()
+
     def shortPoll(self):
         """
-        This runs every 10 seconds. You would probably update your nodes either here
-        or longPoll. No need to Super this method the parent version does nothing.
-        The timer can be overriden in the server.json.
+        This runs every shortPoll seconds (set in the server.json).  The status
+        requests for all the device nodes are sent concurrently by the poll scheduler
+        and each node is updated as its answer comes back.
         """
         LOGGER.debug('Controller: shortPoll called')
-        self.setDriver('ST',  1)
-        for node in self.nodes:
-            if node != self.address:
-                self.nodes[node].shortPoll()
+        self.poll_scheduler.poll(self.get_device_node_list())
+
+    def longPoll(self):
+        """
+        This runs every longPoll seconds (set in the server.json).  The full device
+        settings are read, and every driver of every node is sent to the ISY again in
+        case it missed a change.
+        """
+        LOGGER.debug('Controller: longPoll called')
+        nodes = self.get_device_node_list()
+        sent, suppressed = 0, 0
+        for node in nodes:
+            sent += node.driver_cache.sent
+            suppressed += node.driver_cache.suppressed
+            node.driver_cache.force_refresh()
+        LOGGER.info('Controller: driver updates sent %d, suppressed as unchanged %d', sent, suppressed)
+        self.log_stats(nodes)
+        self.save_snapshot()
+        self.poll_scheduler.poll(nodes, force=True, full=True)
+
+    def log_stats(self, nodes):
+        """Log the request stats since the start, with the slowest devices and any that had errors"""
+        total = LatencyHistogram()
+        timeouts, connect_errors, auth_retries = 0, 0, 0
+        latencies = {}
+        for node in nodes:
+            stats = node.shelly_device.stats
+            latencies[node.address] = stats.latency()
+            total.merge(latencies[node.address])
+            timeouts += stats.timeouts
+            connect_errors += stats.connect_errors
+            auth_retries += stats.auth_retries
+        cycles = self.poll_scheduler.cycle_time
+        LOGGER.info('Controller: %d requests p50 %.0f ms p99 %.0f ms, %d timeouts, %d connection errors, %d auth retries; poll cycle p50 %.2f s max %.2f s',
+                    total.count, total.percentile(0.50) * 1000.0, total.percentile(0.99) * 1000.0, timeouts, connect_errors, auth_retries,
+                    cycles.percentile(0.50), cycles.max)
+
+        slowest = sorted(nodes, key=lambda node: latencies[node.address].percentile(0.99), reverse=True)
+        for index, node in enumerate(slowest):
+            stats = node.shelly_device.stats
+            if index >= _STATS_SLOWEST_DEVICES and stats.errors == 0:
+                continue
+            latency = latencies[node.address]
+            LOGGER.info('Controller:   %s (%s) %d requests p99 %.0f ms max %.0f ms, %d timeouts, %d connection errors, status update p99 %.0f ms',
+                        node.name, node.shelly_device.host, latency.count, latency.percentile(0.99) * 1000.0, latency.max * 1000.0,
+                        stats.timeouts, stats.connect_errors, node.update_time.percentile(0.99) * 1000.0)
+
+    def set_group(self, nodes, target):
+        """
+        Switch a group of device nodes together (every output of a multi channel device): target
+        is a POWER_STATE (on/off/toggle) or an LED_COLOR.  All the requests go out at once and the
+        drivers are reported in one message.  Returns a future for the number of commands sent.
+        """
+        outputs = []
+        for node in nodes:
+            node.commandReceived()
+            outputs.extend(getattr(node, 'channels', [node]))
+        return self.scene_dispatcher.dispatch(outputs, target)
+
+    def set_all(self, target):
+        def sent(future):
+            if future.exception() is not None:
+                LOGGER.error('Controller: Unable to switch all the devices: ' + str(future.exception()))
+            else:
+                LOGGER.info('Controller: %d devices switched %s', future.result(), target.value)
+        self.set_group(self.get_device_node_list(), target).add_done_callback(sent)
+
+    def get_device_node_list(self) -> list:
+        nodes = []
+        for isy_addr in list(self.device_nodes.keys()):
+            node = self.poly.getNode(isy_addr)
+            if node:
+                nodes.append(node)
+        return nodes
+
+    def stop(self):
+        """
+        This is sent by Polyglot when the NodeServer is stopped.  Close the shared
+        device session and stop the device loop.
+        """
+        LOGGER.info('Controller: Stopping The ShellyRGBW2 Nodeserver')
+        self.save_snapshot()
+        try:
+            self.device_loop.submit(self.device_finder.async_stop_browsing()).result(5)
+        except Exception as ex:
+            LOGGER.debug('Controller: stopping discovery: ' + str(ex))
+        for node in self.get_device_node_list():
+            close = getattr(node.shelly_device, 'async_close', None)
+            if close is not None:
+                try:
+                    self.device_loop.submit(close()).result(5)
+                except Exception as ex:
+                    LOGGER.debug('Controller: closing ' + node.name + ': ' + str(ex))
+        self.mqtt_listener.stop()
+        for server in (self.stats_server, self.action_server):
+            if server is not None:
+                try:
+                    self.device_loop.submit(server.stop()).result(5)
+                except Exception as ex:
+                    LOGGER.debug('Controller: stopping local http server: ' + str(ex))
+        self.device_loop.stop()
 
     def delete(self):
         """
@@ -177,14 +631,24 @@ class RGBW2Controller(object):
 
     
     def on_discover(self):
-        dev_found = self.auto_find_devices()
+        """Add a node for every device the discovery browser knows about, without a new scan"""
+        self.start_discovery()
+        for devName, address in list(self.device_finder.devices.items()):
+            self.device_found(devName, address)
 
-        # save devices to customParams (will trigger handler)
-        if len(self.device_nodes) > 0:
-            for dev in self.device_nodes:
-                self.customParams[self.device_nodes[dev][0]] = self.device_nodes[dev][1]
+    def on_all_on(self, command):
+        """Switch every device on at once"""
+        self.set_all(POWER_STATE.On)
+
+    def on_all_off(self, command):
+        """Switch every device off at once"""
+        self.set_all(POWER_STATE.Off)
 
     id = 'RGBW2Controller'
+    commands = {
+                    'ALL_ON': on_all_on,
+                    'ALL_OFF': on_all_off,
+                }
 
 if __name__ == "__main__":
     try:
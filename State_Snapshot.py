@@ -0,0 +1,107 @@
+#
+#
+#  State Snapshot
+#
+#  The last known driver values of every node, kept in the nodeserver's customdata
+#  so they survive a restart.  Nodes are created with the saved values instead of the
+#  driver defaults, and their driver caches start out knowing what ISY already has,
+#  so the first poll after a restart only reports what actually changed.
+#
+
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from Node_Shared import *
+
+SNAPSHOT_KEY     = 'snapshot'  # customdata key
+SNAPSHOT_VERSION = 1
+SNAPSHOT_MAX_AGE = 7 * 24 * 3600  # seconds, an older snapshot is not restored
+
+
+class StateSnapshot:
+    """Saves and restores the driver values, IP address, type and firmware of the device nodes"""
+
+    def __init__(self):
+        self._nodes: Dict[str, Dict[str, Any]] = {}
+        self._saved: Optional[Dict[str, Any]] = None  # last snapshot written, an unchanged one is not written again
+        self.restored = 0
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def load(self, data: Any) -> int:
+        """Load a snapshot read from customdata, returns the number of nodes in it"""
+        self._nodes = {}
+        if not isinstance(data, dict) or data.get('v') != SNAPSHOT_VERSION:
+            return 0
+        if time.time() - data.get('saved', 0) > SNAPSHOT_MAX_AGE:
+            LOGGER.info('StateSnapshot: saved state is too old, not restoring it')
+            return 0
+        self._nodes = data.get('nodes') or {}
+        self._saved = data
+        return len(self._nodes)
+
+    def restore(self, node: Any, device_name: str = None) -> bool:
+        """
+        Set the node's drivers to the saved values, before it is added.  A device node also
+        gets the IP address the device was last seen at.  Returns True if there was a saved state.
+        """
+        entry = self._nodes.get(node.address)
+        if entry is None:
+            return False
+        if device_name is not None and entry.get('type') != device_name:
+            return False
+        ip = entry.get('ip')
+        if ip and device_name is not None and ip != node.shelly_device.host:
+            LOGGER.info('StateSnapshot: %s was last seen at %s', node.name, ip)
+            node.device_addr = ip
+            node.shelly_device.host = ip
+        if entry.get('fw') and getattr(node, 'shelly_device', None) is not None and node.shelly_device.firmware is None:
+            node.shelly_device.firmware = entry['fw']
+        values = entry.get('drivers') or {}
+        for driver in node.drivers:
+            if driver['driver'] in values:
+                driver['value'] = values[driver['driver']]
+                node.driver_cache.prime(driver['driver'], driver['value'])
+        if getattr(node, 'meter', None) is not None:
+            node.meter.restore(entry.get('meter'))
+        self.restored += 1
+        return True
+
+    def capture(self, nodes: List[Tuple[Any, str]]) -> Dict[str, Any]:
+        """The snapshot of the device nodes, given with their config names, and of their channel nodes"""
+        entries = {}
+        for node, device_name in nodes:
+            entries[node.address] = self._meter(node, {
+                'type'   : device_name,
+                'ip'     : node.shelly_device.host,
+                'fw'     : node.shelly_device.firmware,
+                'drivers': self._drivers(node),
+            })
+            for channel in getattr(node, 'channels', ()):
+                entries[channel.address] = self._meter(channel, {'drivers': self._drivers(channel)})
+        return {'v': SNAPSHOT_VERSION, 'saved': int(time.time()), 'nodes': entries}
+
+    def save(self, custom_data: Any, nodes: List[Tuple[Any, str]]) -> bool:
+        """Write the snapshot to customdata if anything in it changed.  Returns True if it was written."""
+        snapshot = self.capture(nodes)
+        if self._saved is not None and self._saved.get('nodes') == snapshot['nodes']:
+            return False
+        custom_data[SNAPSHOT_KEY] = snapshot
+        self._saved = snapshot
+        return True
+
+    #
+    # Private functions
+    #
+    @staticmethod
+    def _drivers(node: Any) -> Dict[str, Any]:
+        return {driver['driver']: driver['value'] for driver in node.drivers}
+
+    @staticmethod
+    def _meter(node: Any, entry: Dict[str, Any]) -> Dict[str, Any]:
+        """Today's energy total of a metered node, so it goes on from there after a restart"""
+        meter = getattr(node, 'meter', None)
+        if meter is not None and meter.day is not None:
+            entry['meter'] = meter.snapshot()
+        return entry
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+"""
+Load test of the real device nodes, poll scheduler and device classes against
+device_simulator.py.
+
+The simulator runs in its own process so the CPU and memory reported here are only the
+nodeserver side.  Each phase reports requests/s, p50/p99 latency and errors, then the
+CPU time and RSS of this process.
+
+    python3 benchmark_runner.py --rgbw2 200 --shelly1 100 --cycles 20
+    python3 benchmark_runner.py --rgbw2 50 --latency 0.03 --loss 0.01 --json results.json
+    python3 benchmark_runner.py --hosts-file devices.json   # devices from a simulator that is already running
+    python3 benchmark_runner.py --rgbw2 0 --shelly1 0 --plus1 100  # Gen2 devices over their RPC websockets
+    python3 benchmark_runner.py --rgbw2 0 --shelly1 0 --shelly25 100  # two channel nodes per device, one poll each
+
+The phases are:
+    poll      PollScheduler.async_poll() of every node, channel endpoint only (the shortPoll)
+    poll-full PollScheduler.async_poll() of every node, full /settings or /status (the longPoll)
+    commands  on_DON/on_DOF of every node (every channel node of the multi channel devices) from a pool of ISY command threads
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from Node_Shared import LOGGER
+from Poll_Scheduler import PollScheduler, DEFAULT_MAX_CONCURRENT
+from ShellyDevice_Loop import get_device_loop
+from RGBW2_Node import RGBW2_Node
+from Shelly1_Node import Shelly1_Node
+from MultiChannel_Node import MultiChannel_Node, RelayChannel_Node
+from ShellyDevice_Gen2 import ShellyDevice_Gen2
+from ShellyDevice_Shelly1 import ShellyDevice_Shelly25
+from device_simulator import DEFAULT_BASE_PORT, TYPE_RGBW2, TYPE_PLUS1, TYPE_SHELLY25
+
+SIMULATOR_START_TIMEOUT = 60  # seconds for the simulator to open all its ports
+
+
+class StandInPolyglot:
+    """Just enough of the PG3 interface for device nodes to run, counts what they would send to ISY"""
+    START = 'START'
+
+    def __init__(self):
+        self.nodes = {}
+        self.messages = 0
+        self.driver_updates = 0
+
+    def subscribe(self, topic: str, callback: Any, address: str = None) -> None:
+        pass
+
+    def db_getNodeDrivers(self, address: str) -> List[Dict[str, Any]]:
+        return []
+
+    def send(self, message: Dict[str, Any], msg_type: str) -> None:
+        self.messages += 1
+        self.driver_updates += len(message.get('set', []))
+
+    def addNode(self, node: Any, conn_status: str = None, rename: bool = False) -> Any:
+        self.nodes[node.address] = node
+        return node
+
+    def getNode(self, address: str) -> Any:
+        return self.nodes.get(address)
+
+
+class LatencyRecorder:
+    """Collects the latency of each request of a phase"""
+    def __init__(self):
+        self.samples: List[float] = []
+        self.errors = 0
+
+    def wrap(self, node: Any) -> None:
+        """Time every fetchStatus of the node, a None answer or an exception counts as an error"""
+        fetch = node.fetchStatus
+
+        async def timed_fetch(full: bool = False):
+            start = time.perf_counter()
+            try:
+                status = await fetch(full)
+            except Exception:
+                self.errors += 1
+                raise
+            finally:
+                self.samples.append(time.perf_counter() - start)
+            if status is None:
+                self.errors += 1
+            return status
+        node.fetchStatus = timed_fetch
+
+    def call(self, func: Any) -> None:
+        start = time.perf_counter()
+        try:
+            func()
+        except Exception:
+            self.errors += 1
+        self.samples.append(time.perf_counter() - start)
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def rss_kb() -> int:
+    """Current resident set size of this process"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_phase(name: str, body: Any, recorder: LatencyRecorder, poly: StandInPolyglot) -> Dict[str, Any]:
+    updates_before = poly.driver_updates
+    cpu_before = cpu_seconds()
+    start = time.perf_counter()
+    body()
+    elapsed = time.perf_counter() - start
+    cpu = cpu_seconds() - cpu_before
+    result = {
+        'phase': name,
+        'requests': len(recorder.samples),
+        'errors': recorder.errors,
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(recorder.samples) / elapsed, 1) if elapsed > 0 else 0.0,
+        'p50_ms': round(percentile(recorder.samples, 0.50) * 1000.0, 2),
+        'p99_ms': round(percentile(recorder.samples, 0.99) * 1000.0, 2),
+        'cpu_seconds': round(cpu, 3),
+        'cpu_percent': round(100.0 * cpu / elapsed, 1) if elapsed > 0 else 0.0,
+        'rss_kb': rss_kb(),
+        'driver_updates': poly.driver_updates - updates_before,
+    }
+    print('%-10s %6d req %5d err %8.1f req/s  p50 %7.2f ms  p99 %7.2f ms  cpu %5.1f%%  rss %7d kB  %6d driver updates' % (
+        name, result['requests'], result['errors'], result['requests_per_second'], result['p50_ms'], result['p99_ms'],
+        result['cpu_percent'], result['rss_kb'], result['driver_updates']), flush=True)
+    return result
+
+
+def start_simulator(args: argparse.Namespace) -> Any:
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'device_simulator.py'),
+           '--rgbw2', str(args.rgbw2), '--shelly1', str(args.shelly1), '--plus1', str(args.plus1), '--shelly25', str(args.shelly25), '--base-port', str(args.base_port),
+           '--latency', str(args.latency), '--jitter', str(args.jitter), '--loss', str(args.loss), '--timeouts', str(args.timeouts)]
+    if getattr(args, 'mqtt', None):
+        cmd += ['--mqtt', args.mqtt]
+    simulator = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    line = simulator.stdout.readline()
+    if not line:
+        simulator.wait(SIMULATOR_START_TIMEOUT)
+        raise RuntimeError('device simulator exited with ' + str(simulator.returncode))
+    return simulator, json.loads(line)['devices']
+
+
+def create_nodes(poly: StandInPolyglot, devices: List[Dict[str, Any]]) -> List[Any]:
+    nodes = []
+    for index, device in enumerate(devices):
+        address, name = 'sim%05d' % index, device['type'] + ' ' + device['id']
+        if device['type'] == TYPE_RGBW2:
+            node = RGBW2_Node(poly, 'controller', address, device['host'], name)
+        elif device['type'] == TYPE_PLUS1:
+            node = Shelly1_Node(poly, 'controller', address, device['host'], name, ShellyDevice_Gen2(device['host']))
+        elif device['type'] == TYPE_SHELLY25:
+            node = MultiChannel_Node(poly, 'controller', address, device['host'], name, ShellyDevice_Shelly25(device['host']), RelayChannel_Node)
+            for channel in node.channels:
+                poly.addNode(channel)
+        else:
+            node = Shelly1_Node(poly, 'controller', address, device['host'], name)
+        nodes.append(poly.addNode(node))
+    return nodes
+
+
+def benchmark(args: argparse.Namespace, devices: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    poly = StandInPolyglot()
+    nodes = create_nodes(poly, devices)
+    device_loop = get_device_loop()
+    device_loop.start()
+    scheduler = PollScheduler(device_loop, args.concurrency)
+    print('%d devices, %d cycles, %d concurrent requests, rss %d kB' % (len(nodes), args.cycles, args.concurrency, rss_kb()), flush=True)
+
+    # the first cycle opens the connections, don't count it
+    device_loop.run(scheduler.async_poll(nodes))
+
+    results = []
+    for name, full in (('poll', False), ('poll-full', True)):
+        recorder = LatencyRecorder()
+        for node in nodes:
+            node.__dict__.pop('fetchStatus', None)
+            recorder.wrap(node)
+
+        def poll_cycles():
+            for cycle in range(args.cycles):
+                device_loop.run(scheduler.async_poll(nodes, full))
+        results.append(run_phase(name, poll_cycles, recorder, poly))
+
+    recorder = LatencyRecorder()
+    command_nodes = [channel for node in nodes for channel in getattr(node, 'channels', [node])]
+
+    def commands():
+        with ThreadPoolExecutor(args.command_threads) as pool:
+            for cycle in range(args.cycles):
+                command = 'on_DON' if cycle % 2 == 0 else 'on_DOF'
+                list(pool.map(lambda node: recorder.call(lambda: getattr(node, command)(None)), command_nodes))
+    results.append(run_phase('commands', commands, recorder, poly))
+
+    for node in nodes:
+        close = getattr(node.shelly_device, 'async_close', None)
+        if close is not None:
+            device_loop.run(close())
+    device_loop.stop()
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Load test the nodeserver against simulated Shelly devices')
+    parser.add_argument('--rgbw2', type=int, default=50, help='number of simulated RGBW2 devices')
+    parser.add_argument('--shelly1', type=int, default=50, help='number of simulated Shelly1 devices')
+    parser.add_argument('--plus1', type=int, default=0, help='number of simulated Gen2 Plus 1 devices')
+    parser.add_argument('--shelly25', type=int, default=0, help='number of simulated Shelly 2.5 devices')
+    parser.add_argument('--base-port', type=int, default=DEFAULT_BASE_PORT, help='port of the first simulated device')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds before each answer')
+    parser.add_argument('--jitter', type=float, default=0.0, help='simulated +/- seconds added to the latency')
+    parser.add_argument('--loss', type=float, default=0.0, help='fraction of requests the simulator drops')
+    parser.add_argument('--timeouts', type=float, default=0.0, help='fraction of requests that hang past the client timeout')
+    parser.add_argument('--hosts-file', help='JSON printed by a device_simulator.py that is already running, instead of starting one')
+    parser.add_argument('--cycles', type=int, default=10, help='poll cycles / command rounds per phase')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_MAX_CONCURRENT, help='poll requests in flight (PollConcurrency)')
+    parser.add_argument('--command-threads', type=int, default=8, help='threads sending commands at the same time')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the nodeserver log')
+    args = parser.parse_args()
+
+    # importing udi_interface sends stdout/stderr to the nodeserver log, this is a console tool
+    sys.stdout = sys.__stdout__
+    sys.stderr = sys.__stderr__
+    if not args.verbose:
+        LOGGER.setLevel(logging.CRITICAL)
+
+    simulator = None
+    if args.hosts_file:
+        with open(args.hosts_file) as hosts_file:
+            devices = json.load(hosts_file)['devices']
+    else:
+        simulator, devices = start_simulator(args)
+    try:
+        results = benchmark(args, devices)
+    finally:
+        if simulator is not None:
+            simulator.terminate()
+            simulator.wait()
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'devices': len(devices), 'args': vars(args), 'results': results}, json_file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
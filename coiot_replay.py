@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+"""
+Replays captured CoIoT datagrams over loopback into a CoIoTListener and checks what
+the nodes would have been sent.
+
+Capture files have one datagram per line as hex (e.g. from a tcpdump/wireshark export
+of udp port 5683), blank lines and lines starting with # are ignored.
+
+    python3 coiot_replay.py capture.txt                   # print what each packet decodes to
+    python3 coiot_replay.py capture.txt --expect out.json # exit 1 if the decoded states differ
+    python3 coiot_replay.py --sample capture.txt          # write a capture built from sample packets
+
+coiot_sample.txt is such a capture and coiot_sample.json what it should decode to:
+
+    python3 coiot_replay.py coiot_sample.txt --expect coiot_sample.json
+"""
+import argparse
+import asyncio
+import json
+import socket
+import sys
+from typing import Any, Dict, List
+
+from CoIoT_Listener import CoIoTListener, COAP_CODE_STATUS, COIOT_OPTION_GLOBAL_DEVID, COIOT_OPTION_STATUS_VALIDITY, COIOT_OPTION_STATUS_SERIAL
+
+REPLAY_TIMEOUT = 2.0  # seconds to wait for the listener to hand a packet to the node
+
+_SAMPLE_PACKETS = [
+    ('SHRGBW2', 'A1B2C3', 1, [[0, 1101, 1], [0, 5105, 255], [0, 5106, 128], [0, 5107, 0], [0, 5108, 10], [0, 5102, 75]]),
+    ('SHRGBW2', 'A1B2C3', 2, [[0, 1101, 0], [0, 5102, 75]]),
+    ('SHSW-1',  'D4E5F6', 1, [[0, 1101, 1], [0, 2101, 0]]),
+    ('SHSW-1',  'D4E5F6', 2, [[0, 1101, 0], [0, 2101, 1]]),
+    ('SHSW-PM', 'F1E2D3', 1, [[0, 1101, 1], [0, 4101, 60.5], [0, 4103, 7200]]),
+]
+
+
+def build_coiot_packet(device_type: str, device_id: str, serial: int, sensors: List[List[int]], validity: int = 380, message_id: int = 1) -> bytes:
+    """Build a CoIoT status datagram the way the Gen1 firmware sends it"""
+    packet = bytearray([0x50, COAP_CODE_STATUS]) + message_id.to_bytes(2, 'big')
+    options = [
+        (COIOT_OPTION_GLOBAL_DEVID, (device_type + '#' + device_id + '#2').encode('ascii')),
+        (COIOT_OPTION_STATUS_VALIDITY, validity.to_bytes(2, 'big')),
+        (COIOT_OPTION_STATUS_SERIAL, serial.to_bytes(2, 'big')),
+    ]
+    last = 0
+    for number, value in options:
+        delta_nibble, delta_ext = _option_nibble(number - last)
+        length_nibble, length_ext = _option_nibble(len(value))
+        last = number
+        packet.append((delta_nibble << 4) | length_nibble)
+        packet += delta_ext + length_ext + value
+    packet.append(0xFF)
+    packet += json.dumps({'G': sensors}).encode('utf-8')
+    return bytes(packet)
+
+
+def _option_nibble(value: int):
+    if value < 13:
+        return value, b''
+    if value < 269:
+        return 13, bytes([value - 13])
+    return 14, (value - 269).to_bytes(2, 'big')
+
+
+class ReplayNode:
+    """Stands in for a device node and records what the listener pushes to it"""
+    def __init__(self):
+        self.pushes = []
+        self.received = asyncio.Event()
+
+    def pushReceived(self, state: Dict[str, Any], valid_for: float) -> None:
+        self.pushes.append(state)
+        self.received.set()
+
+
+def read_capture(file_name: str) -> List[bytes]:
+    datagrams = []
+    with open(file_name) as capture:
+        for line in capture:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            datagrams.append(bytes.fromhex(line.replace(' ', '').replace(':', '')))
+    return datagrams
+
+
+async def replay(datagrams: List[bytes]) -> List[Any]:
+    """Send each datagram to a loopback listener and return what the node got for each (None if dropped)"""
+    loop = asyncio.get_running_loop()
+    listener = CoIoTListener()
+    node = ReplayNode()
+    listener.register(node, '127.0.0.1')
+    await listener.start(loop, bind_addr='127.0.0.1', port=0, multicast=False)
+
+    results = []
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for datagram in datagrams:
+            node.received.clear()
+            sender.sendto(datagram, ('127.0.0.1', listener.port))
+            try:
+                await asyncio.wait_for(node.received.wait(), REPLAY_TIMEOUT)
+                results.append(node.pushes[-1])
+            except asyncio.TimeoutError:
+                results.append(None)
+    finally:
+        sender.close()
+        listener.stop()
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Replay captured CoIoT datagrams into the CoIoT listener')
+    parser.add_argument('capture', help='capture file, one hex datagram per line')
+    parser.add_argument('--expect', help='JSON list of the states the node should receive, in order')
+    parser.add_argument('--sample', action='store_true', help='write sample packets to the capture file and exit')
+    args = parser.parse_args()
+
+    # importing udi_interface (through CoIoT_Listener) sends stdout/stderr to the nodeserver log, this is a console tool
+    sys.stdout = sys.__stdout__
+    sys.stderr = sys.__stderr__
+
+    if args.sample:
+        with open(args.capture, 'w') as capture:
+            for device_type, device_id, serial, sensors in _SAMPLE_PACKETS:
+                capture.write('# ' + device_type + ' ' + device_id + ' ' + json.dumps(sensors) + '\n')
+                capture.write(build_coiot_packet(device_type, device_id, serial, sensors).hex() + '\n')
+        return 0
+
+    results = asyncio.run(replay(read_capture(args.capture)))
+    for index, state in enumerate(results):
+        print(str(index) + ': ' + ('dropped' if state is None else json.dumps(state, sort_keys=True)))
+
+    if args.expect:
+        with open(args.expect) as expect_file:
+            expected = json.load(expect_file)
+        if expected != results:
+            print('FAIL: decoded states do not match ' + args.expect)
+            return 1
+        print('OK: ' + str(len(results)) + ' packets matched')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,9 +2,11 @@ import asyncio
 from typing import Any, Optional, cast, List
 
 from zeroconf import IPVersion, ServiceBrowser, ServiceStateChange, Zeroconf
-from zeroconf.asyncio import AsyncServiceInfo, AsyncZeroconf
+from zeroconf.asyncio import AsyncServiceBrowser, AsyncServiceInfo, AsyncZeroconf
 
-async def async_get_services(aiozc: AsyncZeroconf,service_type, device_name, loops, wait) -> None:
+RESOLVE_TIMEOUT = 3000  # ms to wait for a device to answer the address request
+
+async def async_get_services(aiozc: AsyncZeroconf,service_type, device_name, loops, wait, on_found = None) -> None:
     devices = {}  
     zeroconf = aiozc.zeroconf
     for x in range(loops):  # How many seconds to allow the query
@@ -12,35 +14,47 @@ async def async_get_services(aiozc: AsyncZeroconf,service_type, device_name, loo
         for name in zeroconf.cache.names():
             if not name.endswith(service_type):
                 continue
-            try:
-                found_device_name = name
-                name_end = found_device_name.index('-')
-                found_device_name = found_device_name[:name_end]
-                if found_device_name not in device_name:
-                    continue
-                infos.append(AsyncServiceInfo(service_type, name))
-            except ValueError as ex:
+            if not is_wanted_device(name, device_name):
                 continue
+            if short_device_name(name, service_type) in devices:
+                continue  # already resolved on an earlier loop
+            infos.append(AsyncServiceInfo(service_type, name))
 
         tasks = [info.async_request(aiozc.zeroconf, 1000) for info in infos]
         await asyncio.gather(*tasks)
         for info in infos:
                 addresses = ["%s:%d" % (addr, cast(int, info.port)) for addr in info.parsed_addresses()]
                 assert addresses[0]
-                if info.name.find(service_type) > 2:
-                    devices[info.name[:info.name.index(service_type)-1]] = addresses[0]
-                else: 
-                    devices[info.name] = addresses[0]
+                found_name = short_device_name(info.name, service_type)
+                if on_found is not None and found_name not in devices:
+                    on_found(found_name, addresses[0])
+                devices[found_name] = addresses[0]
         await asyncio.sleep(wait)
     return devices
 
 
+def is_wanted_device(name: str, device_name: List[str]) -> bool:
+    """True if the mDNS name starts with one of the device names followed by a '-'"""
+    try:
+        return name[:name.index('-')] in device_name
+    except ValueError:
+        return False
+
+def short_device_name(name: str, service_type: str) -> str:
+    """The mDNS name without the service type, e.g. shellyrgbw2-AABBCC"""
+    if name.find(service_type) > 2:
+        return name[:name.index(service_type)-1]
+    return name
+
+
 #Looks for a MDNS device on using the [service_type] with a name that begins with [device_name]
 # It looks [loops] times waiting [wait] seconds between each loop.  So total delay time is (loops * wait)
+# If given, [on_found] is called with the name and address of each device as soon as it is found.
 class Device_Finder:
-    def __init__(self,  device_name: List[str], service_type = "_http._tcp.local.",loops = 10, wait = 0.5) -> None:
+    def __init__(self,  device_name: List[str], service_type = "_http._tcp.local.",loops = 10, wait = 0.5, on_found = None) -> None:
         self.loops = loops
         self.wait = wait
+        self._on_found = on_found
 
         self.threaded_browser: Optional[ServiceBrowser] = None
         self.aiozc: Optional[AsyncZeroconf] = None
@@ -49,6 +63,9 @@ class Device_Finder:
         self._service_type = service_type
         self._device_name = device_name
         self._waitTime = self.wait * self.loops
+        self._resolving = set()
+        self._tasks = set()  # the resolves in progress, the loop itself only keeps weak references
+        self._on_removed = None
 
     
     @property
@@ -63,9 +80,13 @@ class Device_Finder:
     #looks for the devices as specified in the constructor.  Returns a dictionary giving the 
     #matching device DNS names and the IP address.
     def look_for_devices(self) -> Any:
-        loop = self.get_or_create_eventloop()#asyncio.get_event_loop()
-        loop.run_until_complete(self.async_run())
-        loop.run_until_complete(self.async_close())
+        # a loop of its own, closed again so repeated scans from a thread don't leave loops behind
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.async_run())
+            loop.run_until_complete(self.async_close())
+        finally:
+            loop.close()
         return self._devices
 
     async def async_run(self) -> None:
@@ -80,7 +101,7 @@ class Device_Finder:
         self.threaded_browser = ServiceBrowser(
             self.aiozc.zeroconf, [self._service_type], handlers=[on_service_state_change]
         )
-        self._devices = await async_get_services(self.aiozc,self._service_type, self._device_name, self.loops , self.wait )
+        self._devices = await async_get_services(self.aiozc,self._service_type, self._device_name, self.loops , self.wait, self._on_found )
 
     async def async_close(self) -> None:
         assert self.aiozc is not None
@@ -88,11 +109,74 @@ class Device_Finder:
         self.threaded_browser.cancel()
         await self.aiozc.async_close()
 
-    def get_or_create_eventloop(self):
+    #
+    # Continuous mode.  A service browser stays open on the given (long running) loop and
+    # [on_found] is called with the name and address of each device when it first appears,
+    # and again if its address changes.  Each name is only resolved once, unless the device
+    # announces an update.  [on_removed] is called with the name when a device says goodbye.
+    #
+    async def async_start_browsing(self, on_found, on_removed = None) -> None:
+        if self.threaded_browser is not None:
+            return
+        self._on_found = on_found
+        self._on_removed = on_removed
+        self._resolving = set()
+        self.aiozc = AsyncZeroconf(ip_version=self._ip_version)
+        self.threaded_browser = AsyncServiceBrowser(
+            self.aiozc.zeroconf, [self._service_type], handlers=[self._on_service_state_change]
+        )
+
+    async def async_stop_browsing(self) -> None:
+        if self.threaded_browser is None:
+            return
+        await self.threaded_browser.async_cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        await self.aiozc.async_close()
+        self.threaded_browser = None
+        self.aiozc = None
+
+    @property
+    def browsing(self) -> bool:
+        return self.threaded_browser is not None
+
+    def _on_service_state_change(self, zeroconf: Zeroconf, service_type: str, name: str, state_change: ServiceStateChange) -> None:
+        if not is_wanted_device(name, self._device_name):
+            return
+        found_name = short_device_name(name, service_type)
+        if state_change is ServiceStateChange.Removed:
+            if self._on_removed is not None:
+                self._on_removed(found_name)
+            return
+        if state_change is ServiceStateChange.Added and found_name in self._devices:
+            return  # already resolved
+        if name in self._resolving:
+            return
+        self._resolving.add(name)
+        task = asyncio.ensure_future(self._async_resolve(service_type, name, found_name))
+        self._tasks.add(task)
+        task.add_done_callback(self._resolve_done)
+
+    def _resolve_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            task.get_loop().call_exception_handler({'message': 'Resolving a device failed', 'exception': task.exception(), 'task': task})
+
+    async def _async_resolve(self, service_type: str, name: str, found_name: str) -> None:
         try:
-            return asyncio.get_event_loop()
-        except RuntimeError as ex:
-            if "There is no current event loop in thread" in str(ex):
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                return asyncio.get_event_loop()
\ No newline at end of file
+            aiozc = self.aiozc
+            if aiozc is None:
+                return  # browsing stopped before the resolve started
+            info = AsyncServiceInfo(service_type, name)
+            if not await info.async_request(aiozc.zeroconf, RESOLVE_TIMEOUT):
+                return
+            addresses = ["%s:%d" % (addr, cast(int, info.port)) for addr in info.parsed_addresses()]
+            if not addresses:
+                return
+            if self._devices.get(found_name) == addresses[0]:
+                return
+            self._devices[found_name] = addresses[0]
+            if self._on_found is not None:
+                self._on_found(found_name, addresses[0])
+        finally:
+            self._resolving.discard(name)
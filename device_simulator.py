@@ -0,0 +1,641 @@
+#!/usr/bin/env python3
+
+"""
+Simulates Shelly devices on loopback so the device classes, nodes and the
+controller can be exercised (and measured) without real hardware.
+
+Every virtual device listens on its own port on 127.0.0.1 and answers the endpoints
+the nodeserver uses: /shelly, /settings, /status, /reboot, color/0 and
+settings/color/0 for the RGBW2, relay/0 for the Shelly1 and relay/0..1 for the 2.5, and
+settings/actions.  The Gen1 devices call the action URLs set on them when an output
+changes, and sim/input?channel=0&event=btn_on (btn_off, shortpush, longpush) works the
+input like a wall switch, switching the output on btn_on/btn_off.  The Gen2 Plus 1 answers
+/shelly and JSON-RPC over the /rpc websocket, and sends NotifyStatus to the
+connected clients when its switch changes.  The devices keep their state, so a
+turn=on is seen by the next poll.
+
+With --mqtt host:port the Gen1 devices also connect to that broker (mqtt_standin.py
+is enough) the way the firmware does: they publish shellies/<hostname>/online and
+their relay/N or color/0/status state on every change and every --mqtt-period
+seconds, and take commands on relay/N/command, color/0/command and color/0/set.
+sim/mqtt?enable=false stops a device publishing (its will says it went offline),
+enable=true starts it again.
+
+    python3 device_simulator.py --rgbw2 200 --shelly1 100              # 300 devices on ports 18000..18299
+    python3 device_simulator.py --rgbw2 10 --latency 0.05 --loss 0.02  # slow, lossy wifi
+    python3 device_simulator.py --shelly1 5 --user admin --password pw # devices with auth enabled
+    python3 device_simulator.py --plus1 20                             # Gen2 devices, RPC over websocket
+    python3 device_simulator.py --shelly25 10                          # two relays each, one /status for both
+    python3 device_simulator.py --shelly1 5 --mqtt 127.0.0.1:1883      # publishing to a broker as well
+
+Once the devices are listening a single JSON line is printed on stdout with the list of
+devices (host, type, id), which is what benchmark_runner.py reads.  Each device
+needs a few sockets, so raise `ulimit -n` for more than a couple of hundred.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import signal
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web, WSMsgType, ClientSession, ClientError
+
+from mqtt_standin import MqttStandInClient
+
+DEFAULT_BASE_PORT = 18000
+DEFAULT_HANG_SECONDS = 10.0  # a 'timeout' request is answered after this long, well past the client timeout
+DEFAULT_MQTT_PERIOD = 30.0   # seconds between the state publishes of an unchanged device, the firmware default
+
+TYPE_RGBW2   = 'SHRGBW2'
+TYPE_SHELLY1 = 'SHSW-1'
+TYPE_PLUS1   = 'SNSW-001X16EU'
+TYPE_SHELLY25 = 'SHSW-25'
+FW_VERSION   = '20230913-114150/v1.14.0-gcb84623'
+FW_GEN2      = '20231107-164738/1.0.8-g8c7bb8d'
+
+_HOSTNAME_PREFIX = {
+    TYPE_RGBW2   : 'shellyrgbw2-',
+    TYPE_SHELLY1 : 'shelly1-',
+    TYPE_PLUS1   : 'shellyplus1-',
+    TYPE_SHELLY25 : 'shellyswitch25-',
+    }
+
+_OUTPUTS = {
+    TYPE_SHELLY25 : 2,
+}
+
+# W an output draws when on, for the devices with a meter (the Shelly1 reports 0 and no energy counter)
+_POWER = {
+    TYPE_RGBW2    : 4.2,
+    TYPE_SHELLY25 : 60.0,
+}
+
+_ACTION_EVENTS = ('out_on', 'out_off', 'btn_on', 'btn_off', 'shortpush', 'longpush')
+
+
+class RpcError(Exception):
+    """A Gen2 RPC request the device answers with an error"""
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+class SimulatorFaults:
+    """What goes wrong, and how often, for every request the simulated devices get"""
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, loss: float = 0.0, timeouts: float = 0.0, hang_seconds: float = DEFAULT_HANG_SECONDS):
+        self.latency = latency            # seconds before answering
+        self.jitter = jitter              # +/- seconds added to the latency
+        self.loss = loss                  # fraction of requests whose connection is dropped without an answer
+        self.timeouts = timeouts          # fraction of requests that hang for hang_seconds
+        self.hang_seconds = hang_seconds
+
+
+class SimulatedDevice:
+    """State and answers of one device"""
+
+    def __init__(self, device_type: str, device_id: str, port: int, user: str = None, pwd: str = None):
+        self.device_type = device_type
+        self.device_id = device_id
+        self.port = port
+        self.auth_header = None
+        if user is not None and pwd is not None:
+            self.auth_header = 'Basic ' + base64.b64encode((user + ':' + pwd).encode('utf-8')).decode('ascii')
+        self.start_time = time.monotonic()
+        self.requests = {}
+        self.outputs = [False] * _OUTPUTS.get(device_type, 1)
+        self.energy = [0.0] * len(self.outputs)  # Wmin, the meter counters
+        self._metered = time.monotonic()
+        self.timer = 0
+        self.red, self.green, self.blue, self.white, self.gain = 255, 255, 255, 0, 100
+        self.transition = 500
+        self.effect = 0
+        self.peers = set()  # Gen2 websockets that get the NotifyStatus frames
+        self.mqtt: Optional[MqttStandInClient] = None  # while the device is connected to the broker
+        self.actions = {}   # Gen1 action URLs, name -> one entry per channel
+        if not self.gen2:
+            self.actions = {event + '_url': [{'index': channel, 'enabled': False, 'urls': []} for channel in range(len(self.outputs))]
+                            for event in _ACTION_EVENTS}
+
+    @property
+    def host(self) -> str:
+        return '127.0.0.1:' + str(self.port)
+
+    @property
+    def mac(self) -> str:
+        return ('A4CF12' + self.device_id)[-12:]
+
+    @property
+    def hostname(self) -> str:
+        return _HOSTNAME_PREFIX[self.device_type] + self.device_id
+
+    @property
+    def on(self) -> bool:
+        return self.outputs[0]
+
+    @on.setter
+    def on(self, on: bool) -> None:
+        self.outputs[0] = on
+
+    @property
+    def gen2(self) -> bool:
+        return self.device_type == TYPE_PLUS1
+
+    def count(self, endpoint: str) -> None:
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def authorized(self, request: web.Request) -> bool:
+        return self.auth_header is None or request.headers.get('Authorization') == self.auth_header
+
+    #
+    # Device answers
+    #
+    def shelly_info(self) -> Dict[str, Any]:
+        if self.gen2:
+            return {
+                'name': None, 'id': self.hostname, 'mac': self.mac, 'model': self.device_type, 'gen': 2,
+                'fw_id': FW_GEN2, 'ver': '1.0.8', 'app': 'Plus1', 'auth_en': False, 'auth_domain': None,
+            }
+        return {
+            'type': self.device_type, 'mac': self.mac, 'auth': self.auth_header is not None,
+            'fw': FW_VERSION, 'longid': 1, 'num_outputs': len(self.outputs),
+        }
+
+    def power(self, channel: int = 0) -> float:
+        return _POWER.get(self.device_type, 0.0) if self.outputs[channel] else 0.0
+
+    def meter(self, channel: int = 0) -> Dict[str, Any]:
+        """The meters[N] status entry"""
+        self.run_meters()
+        if self.device_type not in _POWER:
+            return {'power': 0, 'is_valid': True}
+        return {'power': self.power(channel), 'overpower': 0.0, 'is_valid': True, 'timestamp': int(time.time()),
+                'counters': [0.0, 0.0, 0.0], 'total': int(self.energy[channel])}
+
+    def run_meters(self) -> None:
+        """Count the energy used since the last call, before the outputs change"""
+        now = time.monotonic()
+        for channel in range(len(self.outputs)):
+            self.energy[channel] += self.power(channel) * (now - self._metered) / 60
+        self._metered = now
+
+    def channel_state(self, channel: int = 0) -> Dict[str, Any]:
+        state = {
+            'ison': self.outputs[channel], 'source': 'http', 'has_timer': self.timer > 0,
+            'timer_started': 0, 'timer_duration': self.timer, 'timer_remaining': self.timer,
+        }
+        if self.device_type == TYPE_RGBW2:
+            state.update({
+                'mode': 'color', 'red': self.red, 'green': self.green, 'blue': self.blue, 'white': self.white,
+                'gain': self.gain, 'effect': self.effect, 'transition': self.transition,
+                'power': self.power(), 'overpower': False,
+            })
+        return state
+
+    def color_settings(self, channel: int = 0) -> Dict[str, Any]:
+        state = self.channel_state(channel)
+        state.update({
+            'name': None, 'default_state': 'last', 'auto_on': 0.0, 'auto_off': 0.0,
+            'btn_type': 'toggle', 'btn_reverse': 0, 'schedule': False, 'schedule_rules': [],
+        })
+        return state
+
+    def settings(self) -> Dict[str, Any]:
+        settings = {
+            'device': {'type': self.device_type, 'mac': self.mac, 'hostname': self.hostname, 'num_outputs': len(self.outputs)},
+            'wifi_ap': {'enabled': False, 'ssid': self.hostname, 'key': ''},
+            'wifi_sta': {'enabled': True, 'ssid': 'simulated', 'ipv4_method': 'dhcp', 'ip': None, 'gw': None, 'mask': None, 'dns': None},
+            'mqtt': {'enable': self.mqtt is not None, 'server': '192.168.33.3:1883', 'user': '', 'id': self.hostname, 'reconnect_timeout_max': 60.0,
+                     'reconnect_timeout_min': 2.0, 'clean_session': True, 'keep_alive': 60, 'max_qos': 0, 'retain': False, 'update_period': 30},
+            'coiot': {'enabled': True, 'update_period': 15, 'peer': ''},
+            'sntp': {'server': 'time.google.com', 'enabled': True},
+            'login': {'enabled': self.auth_header is not None, 'unprotected': False, 'username': 'admin'},
+            'name': None, 'fw': FW_VERSION, 'discoverable': False, 'build_info': {'build_id': FW_VERSION},
+            'cloud': {'enabled': False, 'connected': False},
+            'timezone': 'America/New_York', 'lat': 40.0, 'lng': -75.0, 'tzautodetect': True, 'time': '12:00', 'unixtime': int(time.time()),
+            'hwinfo': {'hw_revision': 'prod-2019-03', 'batch_id': 1},
+        }
+        if self.device_type == TYPE_RGBW2:
+            settings['mode'] = 'color'
+            settings['dcpower'] = 0
+            settings['lights'] = [self.color_settings()]
+        else:
+            settings['relays'] = [self.color_settings(channel) for channel in range(len(self.outputs))]
+        return settings
+
+    def status(self) -> Dict[str, Any]:
+        status = {
+            'wifi_sta': {'connected': True, 'ssid': 'simulated', 'ip': '127.0.0.1', 'rssi': -58},
+            'cloud': {'enabled': False, 'connected': False},
+            'mqtt': {'connected': self.mqtt is not None},
+            'time': '12:00', 'unixtime': int(time.time()), 'serial': 1, 'has_update': False, 'mac': self.mac,
+            'cfg_changed_cnt': 0, 'actions_stats': {'skipped': 0},
+            'update': {'status': 'idle', 'has_update': False, 'new_version': FW_VERSION, 'old_version': FW_VERSION},
+            'ram_total': 51464, 'ram_free': 38420, 'fs_size': 233681, 'fs_free': 152106,
+            'uptime': int(time.monotonic() - self.start_time),
+        }
+        if self.device_type == TYPE_RGBW2:
+            status['lights'] = [self.channel_state()]
+            status['meters'] = [self.meter()]
+            status['inputs'] = [{'input': 0, 'event': '', 'event_cnt': 0}]
+        else:
+            status['relays'] = [self.channel_state(channel) for channel in range(len(self.outputs))]
+            status['meters'] = [self.meter(channel) for channel in range(len(self.outputs))]
+            status['inputs'] = [{'input': 0, 'event': '', 'event_cnt': 0}]
+        return status
+
+    def apply(self, query: Dict[str, str], channel: int = 0) -> None:
+        """Apply the parameters of a relay/N, color/0 or settings/color/0 request"""
+        self.run_meters()
+        if 'turn' in query:
+            turn = query['turn']
+            self.outputs[channel] = (not self.outputs[channel]) if turn == 'toggle' else (turn == 'on')
+        if 'timer' in query:
+            self.timer = int(float(query['timer']))
+        for name in ('red', 'green', 'blue', 'white'):
+            if name in query:
+                setattr(self, name, max(0, min(255, int(query[name]))))
+        if 'gain' in query:
+            self.gain = max(0, min(100, int(query['gain'])))
+        if 'transition' in query:
+            self.transition = max(0, min(5000, int(query['transition'])))
+        if 'effect' in query:
+            self.effect = int(query['effect'])
+
+    def set_action(self, query: Any) -> Dict[str, Any]:
+        """Apply a settings/actions?index=&name=&enabled=&urls[]= request"""
+        entries = self.actions.get(query.get('name'))
+        channel = int(query.get('index', 0))
+        if entries is None or not 0 <= channel < len(entries):
+            raise web.HTTPBadRequest()
+        entries[channel] = {'index': channel, 'enabled': query.get('enabled') == 'true', 'urls': query.getall('urls[]', [])}
+        return {'actions': {query.get('name'): entries}}
+
+    def action_urls(self, channel: int, event: str) -> List[str]:
+        entry = self.actions[event + '_url'][channel]
+        return entry['urls'] if entry['enabled'] else []
+
+    def mqtt_state(self, channel: int) -> Dict[str, str]:
+        """The topics (under shellies/<hostname>/) and payloads the firmware publishes for a channel"""
+        if self.device_type == TYPE_RGBW2:
+            topics = {'color/0': 'on' if self.on else 'off', 'color/0/status': json.dumps(self.channel_state())}
+        else:
+            topics = {'relay/' + str(channel): 'on' if self.outputs[channel] else 'off'}
+        if self.device_type in _POWER:
+            output = 'color/0' if self.device_type == TYPE_RGBW2 else 'relay/' + str(channel)
+            meter = self.meter(channel)
+            topics[output + '/power'] = str(meter['power'])
+            topics[output + '/energy'] = str(meter['total'])
+        return topics
+
+    def mqtt_query(self, subtopic: str, payload: str) -> Optional[Dict[str, str]]:
+        """A command topic (under shellies/<hostname>/) as the query of the HTTP request it stands for, None if it isn't one"""
+        parts = subtopic.split('/')
+        if parts[-1] == 'command' and payload in ('on', 'off', 'toggle'):
+            return {'turn': payload}
+        if parts[-1] == 'set' and self.device_type == TYPE_RGBW2:
+            try:
+                values = json.loads(payload)
+            except ValueError:
+                return None
+            return {key: str(value) for key, value in values.items()} if isinstance(values, dict) else None
+        return None
+
+    def switch_status(self) -> Dict[str, Any]:
+        status = {'id': 0, 'source': 'WS_in', 'output': self.on, 'apower': 0.0, 'voltage': 231.4,
+                  'current': 0.0, 'aenergy': {'total': 0.0, 'by_minute': [0.0, 0.0, 0.0], 'minute_ts': int(time.time())},
+                  'temperature': {'tC': 41.2, 'tF': 106.2}}
+        if self.timer > 0:
+            status['timer_started_at'] = time.time()
+            status['timer_duration'] = self.timer
+        return status
+
+    def rpc(self, method: str, params: Dict[str, Any]) -> Any:
+        """Answer a Gen2 RPC request, returns the result and whether the switch changed"""
+        if method == 'Shelly.GetDeviceInfo':
+            return self.shelly_info(), False
+        if method == 'Shelly.GetStatus':
+            return {'switch:0': self.switch_status(), 'sys': {'mac': self.mac, 'uptime': int(time.monotonic() - self.start_time)}}, False
+        if method == 'Shelly.GetConfig':
+            return {'switch:0': {'id': 0, 'name': None, 'in_mode': 'follow', 'initial_state': 'match_input'},
+                    'sys': {'device': {'name': None, 'mac': self.mac, 'fw_id': FW_GEN2}}}, False
+        if method == 'Shelly.Reboot':
+            self.start_time = time.monotonic()
+            return None, False
+        if params.get('id', 0) != 0:
+            raise RpcError(-105, 'Argument \'id\', value ' + str(params.get('id')) + ' not found!')
+        if method == 'Switch.GetStatus':
+            return self.switch_status(), False
+        if method == 'Switch.Set':
+            was_on = self.on
+            self.on = bool(params.get('on'))
+            self.timer = int(params.get('toggle_after') or 0)
+            return {'was_on': was_on}, was_on != self.on
+        if method == 'Switch.Toggle':
+            was_on = self.on
+            self.on = not self.on
+            return {'was_on': was_on}, True
+        raise RpcError(404, 'No handler for ' + method)
+
+
+class DeviceSimulator:
+    """A set of simulated devices, one listening port each, all served from one event loop"""
+
+    def __init__(self, rgbw2: int = 0, shelly1: int = 0, base_port: int = DEFAULT_BASE_PORT, faults: SimulatorFaults = None, user: str = None, pwd: str = None, plus1: int = 0, shelly25: int = 0,
+                 mqtt: str = None, mqtt_period: float = DEFAULT_MQTT_PERIOD):
+        self.faults = faults or SimulatorFaults()
+        self.mqtt_broker = mqtt  # host:port the Gen1 devices publish to, None for none
+        self.mqtt_period = mqtt_period
+        self.mqtt_published = 0
+        self._mqtt_task = None
+        self.devices: List[SimulatedDevice] = []
+        self._by_port: Dict[int, SimulatedDevice] = {}
+        self._runner: Optional[web.AppRunner] = None
+        self._session: Optional[ClientSession] = None  # for calling the action URLs
+        self.actions_called = 0
+        port = base_port
+        for index in range(rgbw2):
+            self._add(SimulatedDevice(TYPE_RGBW2, '%06X' % (0x100000 + index), port, user, pwd))
+            port += 1
+        for index in range(shelly1):
+            self._add(SimulatedDevice(TYPE_SHELLY1, '%06X' % (0x200000 + index), port, user, pwd))
+            port += 1
+        for index in range(plus1):
+            self._add(SimulatedDevice(TYPE_PLUS1, 'A8032A%06X' % (0x300000 + index), port))
+            port += 1
+        for index in range(shelly25):
+            self._add(SimulatedDevice(TYPE_SHELLY25, '%06X' % (0x400000 + index), port, user, pwd))
+            port += 1
+
+    @property
+    def request_count(self) -> int:
+        return sum(sum(device.requests.values()) for device in self.devices)
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/{endpoint:.*}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        for device in self.devices:
+            await web.TCPSite(self._runner, '127.0.0.1', device.port, backlog=128).start()
+        if self.mqtt_broker:
+            for device in self.devices:
+                if not device.gen2:
+                    await self._mqtt_connect(device)
+            self._mqtt_task = asyncio.ensure_future(self._mqtt_periodic())
+
+    async def stop(self) -> None:
+        if self._mqtt_task is not None:
+            self._mqtt_task.cancel()
+            self._mqtt_task = None
+        for device in self.devices:
+            await self._mqtt_disconnect(device)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def describe(self) -> List[Dict[str, Any]]:
+        return [{'host': device.host, 'type': device.device_type, 'id': device.device_id} for device in self.devices]
+
+    #
+    # Private functions
+    #
+    def _add(self, device: SimulatedDevice) -> None:
+        self.devices.append(device)
+        self._by_port[device.port] = device
+
+    async def _handle(self, request: web.Request) -> web.StreamResponse:
+        device = self._by_port.get(request.transport.get_extra_info('sockname')[1])
+        if device is None:
+            raise web.HTTPNotFound()
+        endpoint = request.match_info['endpoint'].rstrip('/')
+        device.count(endpoint)
+
+        if device.gen2 and endpoint == 'rpc':
+            return await self._rpc_socket(request, device)
+        if not await self._delay():
+            request.transport.close()
+            return web.Response(status=204)
+
+        if endpoint == 'shelly':
+            return web.json_response(device.shelly_info())
+        if device.gen2:
+            raise web.HTTPNotFound()
+        if not device.authorized(request):
+            return web.Response(status=401, headers={'WWW-Authenticate': 'Basic realm="shelly"'})
+
+        if endpoint == 'settings':
+            return web.json_response(device.settings())
+        if endpoint == 'status':
+            return web.json_response(device.status())
+        if endpoint == 'reboot':
+            device.start_time = time.monotonic()
+            return web.json_response({'ok': True})
+        if endpoint == 'settings/actions':
+            if 'name' in request.query:
+                return web.json_response(device.set_action(request.query))
+            return web.json_response({'actions': device.actions})
+        if endpoint == 'sim/input':
+            channel = int(request.query.get('channel', 0))
+            event = request.query.get('event', 'shortpush')
+            if event not in _ACTION_EVENTS[2:] or not 0 <= channel < len(device.outputs):
+                raise web.HTTPBadRequest()
+            self._call_actions(device, channel, event)
+            if event in ('btn_on', 'btn_off'):
+                self._apply(device, {'turn': 'on' if event == 'btn_on' else 'off'}, channel)
+            return web.json_response(device.channel_state(channel))
+        if endpoint == 'sim/mqtt' and self.mqtt_broker:
+            if request.query.get('enable') == 'false':
+                await self._mqtt_disconnect(device, clean=False)
+            elif request.query.get('enable') == 'true' and device.mqtt is None:
+                await self._mqtt_connect(device)
+            return web.json_response({'connected': device.mqtt is not None})
+        if device.device_type == TYPE_RGBW2 and endpoint == 'color/0':
+            self._apply(device, request.query)
+            return web.json_response(device.channel_state())
+        if device.device_type == TYPE_RGBW2 and endpoint == 'settings/color/0':
+            self._apply(device, request.query)
+            return web.json_response(device.color_settings())
+        if device.device_type in (TYPE_SHELLY1, TYPE_SHELLY25) and endpoint.startswith('relay/'):
+            channel = int(endpoint[len('relay/'):]) if endpoint[len('relay/'):].isdigit() else -1
+            if not 0 <= channel < len(device.outputs):
+                raise web.HTTPNotFound()
+            self._apply(device, request.query, channel)
+            return web.json_response(device.channel_state(channel))
+        raise web.HTTPNotFound()
+
+    def _apply(self, device: SimulatedDevice, query: Dict[str, str], channel: int = 0) -> None:
+        """Apply a request to the device, calling its out_on/out_off action URLs if the output changed"""
+        was_on = device.outputs[channel]
+        device.apply(query, channel)
+        if device.outputs[channel] != was_on:
+            self._call_actions(device, channel, 'out_on' if device.outputs[channel] else 'out_off')
+        if query:
+            self._mqtt_publish(device, channel)
+
+    def _call_actions(self, device: SimulatedDevice, channel: int, event: str) -> None:
+        for url in device.action_urls(channel, event):
+            asyncio.ensure_future(self._call_action(url))
+
+    async def _call_action(self, url: str) -> None:
+        if self._session is None:
+            self._session = ClientSession()
+        try:
+            async with self._session.get(url) as response:
+                await response.read()
+            self.actions_called += 1
+        except (ClientError, OSError):
+            pass
+
+    async def _mqtt_connect(self, device: SimulatedDevice) -> None:
+        host, _, port = self.mqtt_broker.partition(':')
+        prefix = 'shellies/' + device.hostname + '/'
+
+        async def received(topic: str, payload: bytes) -> None:
+            query = device.mqtt_query(topic[len(prefix):], payload.decode('utf-8', errors='replace'))
+            parts = topic[len(prefix):].split('/')
+            if query is not None and len(parts) == 3 and parts[1].isdigit() and int(parts[1]) < len(device.outputs):
+                device.count('mqtt/' + parts[0] + '/' + parts[2])
+                self._apply(device, query, int(parts[1]))
+
+        client = MqttStandInClient(device.hostname, received)
+        await client.connect(host, int(port) if port else 1883, will=(prefix + 'online', 'false'))
+        for subtopic in ('+/+/command', 'color/0/set'):
+            client.subscribe(prefix + subtopic)
+        client.publish(prefix + 'online', 'true', retain=True)
+        device.mqtt = client
+        for channel in range(len(device.outputs)):
+            self._mqtt_publish(device, channel)
+
+    async def _mqtt_disconnect(self, device: SimulatedDevice, clean: bool = True) -> None:
+        """Leave the broker, clean=False drops the connection like a device losing power, so the broker sends its will"""
+        client, device.mqtt = device.mqtt, None
+        if client is None:
+            return
+        if clean:
+            client.publish('shellies/' + device.hostname + '/online', 'false', retain=True)
+            await client.close()
+        else:
+            await client.abort()
+
+    def _mqtt_publish(self, device: SimulatedDevice, channel: int) -> None:
+        if device.mqtt is None:
+            return
+        for subtopic, payload in device.mqtt_state(channel).items():
+            device.mqtt.publish('shellies/' + device.hostname + '/' + subtopic, payload)
+            self.mqtt_published += 1
+
+    async def _mqtt_periodic(self) -> None:
+        """The update period publishes, of every device at its own offset in the period like real devices"""
+        started = time.monotonic()
+        offsets = {device.device_id: random.uniform(0, self.mqtt_period) for device in self.devices}
+        published = {device.device_id: 0 for device in self.devices}
+        while True:
+            await asyncio.sleep(min(1.0, self.mqtt_period / 10))
+            elapsed = time.monotonic() - started
+            for device in self.devices:
+                due = int((elapsed + offsets[device.device_id]) // self.mqtt_period)
+                if due > published[device.device_id]:
+                    published[device.device_id] = due
+                    for channel in range(len(device.outputs)):
+                        self._mqtt_publish(device, channel)
+
+    async def _delay(self) -> bool:
+        """Wait as long as the faults say, False if the request is lost"""
+        faults = self.faults
+        roll = random.random()
+        if roll < faults.loss:
+            return False
+        if roll < faults.loss + faults.timeouts:
+            await asyncio.sleep(faults.hang_seconds)
+        elif faults.latency > 0 or faults.jitter > 0:
+            await asyncio.sleep(max(0.0, faults.latency + random.uniform(-faults.jitter, faults.jitter)))
+        return True
+
+    async def _rpc_socket(self, request: web.Request, device: SimulatedDevice) -> web.WebSocketResponse:
+        """Gen2 RPC over a websocket, the frames of one socket are answered in order"""
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        try:
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                frame = json.loads(message.data)
+                device.count('rpc/' + str(frame.get('method')))
+                if frame.get('src'):
+                    device.peers.add(ws)
+                if not await self._delay():
+                    continue
+                answer = {'id': frame.get('id'), 'src': device.hostname, 'dst': frame.get('src')}
+                changed = False
+                try:
+                    answer['result'], changed = device.rpc(frame.get('method'), frame.get('params') or {})
+                except RpcError as err:
+                    answer['error'] = {'code': err.code, 'message': str(err)}
+                await ws.send_str(json.dumps(answer))
+                if changed:
+                    await self._notify(device)
+        finally:
+            device.peers.discard(ws)
+        return ws
+
+    async def _notify(self, device: SimulatedDevice) -> None:
+        status = device.switch_status()
+        for peer in list(device.peers):
+            notification = {'src': device.hostname, 'dst': 'peer', 'method': 'NotifyStatus',
+                            'params': {'ts': time.time(), 'switch:0': {'id': 0, 'output': status['output'], 'source': status['source']}}}
+            try:
+                await peer.send_str(json.dumps(notification))
+            except ConnectionError:
+                device.peers.discard(peer)
+
+
+async def serve(simulator: DeviceSimulator) -> None:
+    await simulator.start()
+    print(json.dumps({'devices': simulator.describe()}), flush=True)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    await simulator.stop()
+    sys.stderr.write('device_simulator: answered ' + str(simulator.request_count) + ' requests\n')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Simulate Shelly devices on loopback')
+    parser.add_argument('--rgbw2', type=int, default=0, help='number of RGBW2 devices')
+    parser.add_argument('--shelly1', type=int, default=0, help='number of Shelly1 devices')
+    parser.add_argument('--plus1', type=int, default=0, help='number of Gen2 Plus 1 devices')
+    parser.add_argument('--shelly25', type=int, default=0, help='number of Shelly 2.5 devices, two relays each')
+    parser.add_argument('--base-port', type=int, default=DEFAULT_BASE_PORT, help='port of the first device, the others follow')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each answer')
+    parser.add_argument('--jitter', type=float, default=0.0, help='+/- seconds added to the latency')
+    parser.add_argument('--loss', type=float, default=0.0, help='fraction of requests dropped without an answer')
+    parser.add_argument('--timeouts', type=float, default=0.0, help='fraction of requests that hang')
+    parser.add_argument('--hang', type=float, default=DEFAULT_HANG_SECONDS, help='seconds a hanging request takes')
+    parser.add_argument('--user', help='require HTTP basic auth with this user')
+    parser.add_argument('--password', help='password for --user')
+    parser.add_argument('--mqtt', help='host:port of an MQTT broker the Gen1 devices publish to')
+    parser.add_argument('--mqtt-period', type=float, default=DEFAULT_MQTT_PERIOD, help='seconds between the MQTT publishes of an unchanged device')
+    args = parser.parse_args()
+
+    if args.rgbw2 + args.shelly1 + args.plus1 + args.shelly25 == 0:
+        parser.error('no devices, use --rgbw2, --shelly1, --plus1 and/or --shelly25')
+
+    faults = SimulatorFaults(args.latency, args.jitter, args.loss, args.timeouts, args.hang)
+    asyncio.run(serve(DeviceSimulator(args.rgbw2, args.shelly1, args.base_port, faults, args.user, args.password, args.plus1, args.shelly25,
+                                      args.mqtt, args.mqtt_period)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+"""
+Microbenchmarks of the per-request costs in the device layer, for deciding whether a
+change to ShellyDevice_Base / ShellyDevice_RGBW2 is worth it.
+
+Requests go to a simulated device (device_simulator.py) on 127.0.0.1, served from its
+own thread.  Each benchmark is run --repeat times and the median is kept, results can be
+saved as JSON and compared with an earlier run:
+
+    python3 microbench.py --save before.json
+    ... change something ...
+    python3 microbench.py --compare before.json             # exit 1 if anything got >10% slower
+    python3 microbench.py --compare before.json --threshold 0.25 --filter request
+"""
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+from aiohttp import BasicAuth, ClientSession
+
+from ShellyDevice_Loop import get_device_loop
+from ShellyDevice_RGBW2 import ShellyDevice_RGBW2, LED_COLOR, build_color_cmd
+from Color_Conversion import rgbw_to_hsv, rgbw_to_kelvin
+from device_simulator import DeviceSimulator, SimulatedDevice, TYPE_RGBW2
+
+DEFAULT_REPEAT    = 5
+DEFAULT_THRESHOLD = 0.10  # fraction slower than the baseline that counts as a regression
+TARGET_SECONDS    = 0.2   # each repeat runs the benchmark about this long
+STUB_PORT         = 18999
+STUB_USER         = 'admin'
+STUB_PASSWORD     = 'bench'
+
+
+class StubServer:
+    """One simulated RGBW2 with auth, and one without, served from a thread of their own"""
+    def __init__(self, port: int):
+        self.open_device = DeviceSimulator(rgbw2=1, base_port=port)
+        self.auth_device = DeviceSimulator(rgbw2=1, base_port=port + 1, user=STUB_USER, pwd=STUB_PASSWORD)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='StubServer', daemon=True)
+
+    @property
+    def open_host(self) -> str:
+        return self.open_device.devices[0].host
+
+    @property
+    def auth_host(self) -> str:
+        return self.auth_device.devices[0].host
+
+    def start(self) -> None:
+        self._thread.start()
+        for simulator in (self.open_device, self.auth_device):
+            asyncio.run_coroutine_threadsafe(simulator.start(), self._loop).result()
+
+    def stop(self) -> None:
+        for simulator in (self.open_device, self.auth_device):
+            asyncio.run_coroutine_threadsafe(simulator.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+def measure(func: Callable[[], Any], repeat: int) -> Dict[str, Any]:
+    """Time func, calibrating the number of calls per repeat so each takes about TARGET_SECONDS"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= TARGET_SECONDS / 10 or number >= 1000000:
+            break
+        number *= 10
+    number = max(1, int(number * TARGET_SECONDS / max(elapsed, 1e-9)))
+
+    per_call = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        per_call.append((time.perf_counter() - start) / number)
+    median = statistics.median(per_call)
+    return {
+        'median_us': round(median * 1e6, 3),
+        'min_us': round(min(per_call) * 1e6, 3),
+        'max_us': round(max(per_call) * 1e6, 3),
+        'calls_per_repeat': number,
+        'ops_per_second': round(1.0 / median, 1) if median > 0 else 0.0,
+    }
+
+
+def benchmarks(stub: StubServer) -> Dict[str, Callable[[], Any]]:
+    """name -> one call of the operation being measured"""
+    device_loop = get_device_loop()
+    settings_body = json.dumps(SimulatedDevice(TYPE_RGBW2, '000000', 0).settings())
+    color = LED_COLOR(red=255, green=128, blue=0, white=20, brightness=75, on=True, timer=30)
+    open_device = ShellyDevice_RGBW2(stub.open_host)
+    auth_device = ShellyDevice_RGBW2(stub.auth_host, STUB_USER, STUB_PASSWORD)
+    open_url = 'http://' + stub.open_host + '/color/0'
+
+    async def noop():
+        return None
+
+    def new_loop_run():
+        # what every request used to cost: a new event loop per call
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(noop())
+        finally:
+            loop.close()
+
+    async def new_session():
+        async with ClientSession():
+            pass
+
+    async def new_session_request():
+        # one request on a session of its own, no connection reuse
+        async with ClientSession() as session:
+            async with session.get(open_url) as response:
+                await response.read()
+
+    async def shared_session_request():
+        session = device_loop.get_session()
+        async with session.get(open_url) as response:
+            await response.read()
+
+    return {
+        'loop.new_event_loop':        new_loop_run,
+        'loop.shared_run':            lambda: device_loop.run(noop()),
+        'session.construct':          lambda: device_loop.run(new_session()),
+        'auth.basic_auth':            lambda: BasicAuth(STUB_USER, STUB_PASSWORD).encode(),
+        'color.build_color_cmd':      lambda: build_color_cmd(color),
+        'color.from_hsv':             lambda: LED_COLOR.from_hsv(210, 40, 75),
+        'color.from_kelvin':          lambda: LED_COLOR.from_kelvin(2700, 75),
+        'color.to_hsv_kelvin':        lambda: (rgbw_to_hsv(255, 128, 0, 20), rgbw_to_kelvin(255, 128, 0, 20)),
+        'json.loads_settings':        lambda: json.loads(settings_body),
+        'request.new_session':        lambda: device_loop.run(new_session_request()),
+        'request.shared_session':     lambda: device_loop.run(shared_session_request()),
+        'request.get_channel_state':  open_device.get_channel_state,
+        'request.get_channel_auth':   auth_device.get_channel_state,
+        'request.get_settings':       lambda: open_device.get_device_settings(max_age=0),
+        'request.set_color':          lambda: open_device.device_set_color(color),
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Names of the benchmarks that are more than threshold slower than in the baseline"""
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        change = result['median_us'] / before['median_us'] - 1.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-28s %12.3f us -> %12.3f us  %+7.1f%%%s' % (name, before['median_us'], result['median_us'], change * 100.0, flag))
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the Shelly device request path')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='runs of each benchmark, the median is kept')
+    parser.add_argument('--filter', help='only run benchmarks with this in their name')
+    parser.add_argument('--port', type=int, default=STUB_PORT, help='port of the stub device (and the next one)')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='fraction slower than the baseline that fails --compare')
+    args = parser.parse_args()
+
+    stub = StubServer(args.port)
+    stub.start()
+    device_loop = get_device_loop()
+    device_loop.start()
+    results = {}
+    try:
+        for name, func in benchmarks(stub).items():
+            if args.filter and args.filter not in name:
+                continue
+            func()  # warm up, opens the keep-alive connections
+            results[name] = measure(func, args.repeat)
+            print('%-28s %12.3f us  %12.1f ops/s' % (name, results[name]['median_us'], results[name]['ops_per_second']), flush=True)
+    finally:
+        device_loop.stop()
+        stub.stop()
+
+    if args.save:
+        with open(args.save, 'w') as save_file:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': results}, save_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as compare_file:
+            baseline = json.load(compare_file)['results']
+        print()
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('FAIL: ' + str(len(regressions)) + ' benchmarks more than ' + str(int(args.threshold * 100)) + '% slower: ' + ', '.join(regressions))
+            return 1
+        print('OK: no benchmark more than ' + str(int(args.threshold * 100)) + '% slower')
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
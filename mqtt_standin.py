@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+"""
+A small MQTT 3.1.1 broker and client for development, so the MQTT transport can be
+exercised without a real broker (mosquitto etc.) or real devices.
+
+The broker takes QoS 0 and 1 publishes, delivers them at QoS 0 to every matching
+subscription (+ and # wildcards), keeps retained messages and publishes the will
+of a client that goes away without a DISCONNECT.  device_simulator.py --mqtt uses
+the client to publish the simulated devices' state the way Gen1 firmware does.
+
+    python3 mqtt_standin.py --port 1883             # run a broker
+    python3 mqtt_standin.py --port 1883 --verbose   # and print every publish
+"""
+import argparse
+import asyncio
+import itertools
+import signal
+import struct
+import sys
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+DEFAULT_PORT = 1883
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+MessageHandler = Callable[[str, bytes], Awaitable[None]]
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """Whether topic matches a subscription filter with + and # wildcards"""
+    filter_parts = topic_filter.split('/')
+    topic_parts = topic.split('/')
+    for index, part in enumerate(filter_parts):
+        if part == '#':
+            return True
+        if index >= len(topic_parts) or (part != '+' and part != topic_parts[index]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+def _string(value: str) -> bytes:
+    data = value.encode('utf-8')
+    return struct.pack('!H', len(data)) + data
+
+
+def _packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    header = bytearray([(packet_type << 4) | flags])
+    length = len(body)
+    while True:
+        byte = length % 128
+        length //= 128
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            break
+    return bytes(header) + body
+
+
+def publish_packet(topic: str, payload: bytes, retain: bool = False) -> bytes:
+    return _packet(PUBLISH, 1 if retain else 0, _string(topic) + payload)
+
+
+async def read_packet(reader: asyncio.StreamReader) -> Tuple[int, int, bytes]:
+    """(type, flags, body) of the next packet, raises IncompleteReadError when the connection closes"""
+    first = (await reader.readexactly(1))[0]
+    length, shift = 0, 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    return first >> 4, first & 0x0F, await reader.readexactly(length)
+
+
+def _read_string(body: bytes, pos: int) -> Tuple[str, int]:
+    length = struct.unpack_from('!H', body, pos)[0]
+    return body[pos + 2:pos + 2 + length].decode('utf-8', errors='replace'), pos + 2 + length
+
+
+def parse_publish(flags: int, body: bytes) -> Tuple[str, Optional[int], bytes]:
+    """(topic, packet id or None for QoS 0, payload)"""
+    topic, pos = _read_string(body, 0)
+    packet_id = None
+    if (flags >> 1) & 0x03:
+        packet_id = struct.unpack_from('!H', body, pos)[0]
+        pos += 2
+    return topic, packet_id, body[pos:]
+
+
+class _Session:
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.client_id = ''
+        self.filters: Set[str] = set()
+        self.will: Optional[Tuple[str, bytes, bool]] = None
+
+
+class MqttBrokerStandIn:
+    """Enough of an MQTT broker for the nodeserver and the simulated devices"""
+
+    def __init__(self, port: int = DEFAULT_PORT, host: str = '127.0.0.1', verbose: bool = False):
+        self.host = host
+        self.port = port
+        self.verbose = verbose
+        self._server = None
+        self._sessions: List[_Session] = []
+        self._retained: Dict[str, bytes] = {}
+        self.published = 0
+        self.delivered = 0
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            for session in list(self._sessions):
+                session.writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        session = _Session(writer)
+        self._sessions.append(session)
+        clean = False
+        try:
+            while True:
+                packet_type, flags, body = await read_packet(reader)
+                if packet_type == CONNECT:
+                    self._connect(session, body)
+                    writer.write(_packet(CONNACK, 0, b'\x00\x00'))
+                elif packet_type == PUBLISH:
+                    topic, packet_id, payload = parse_publish(flags, body)
+                    if packet_id is not None:
+                        writer.write(_packet(PUBACK, 0, struct.pack('!H', packet_id)))
+                    self._publish(topic, payload, bool(flags & 0x01))
+                elif packet_type == SUBSCRIBE:
+                    packet_id, pos, granted = struct.unpack_from('!H', body, 0)[0], 2, b''
+                    while pos < len(body):
+                        topic_filter, pos = _read_string(body, pos)
+                        pos += 1  # requested QoS, everything is delivered at QoS 0
+                        session.filters.add(topic_filter)
+                        granted += b'\x00'
+                        for topic, payload in self._retained.items():
+                            if topic_matches(topic_filter, topic):
+                                writer.write(publish_packet(topic, payload, True))
+                    writer.write(_packet(SUBACK, 0, struct.pack('!H', packet_id) + granted))
+                elif packet_type == UNSUBSCRIBE:
+                    packet_id, pos = struct.unpack_from('!H', body, 0)[0], 2
+                    while pos < len(body):
+                        topic_filter, pos = _read_string(body, pos)
+                        session.filters.discard(topic_filter)
+                    writer.write(_packet(UNSUBACK, 0, struct.pack('!H', packet_id)))
+                elif packet_type == PINGREQ:
+                    writer.write(_packet(PINGRESP, 0, b''))
+                elif packet_type == DISCONNECT:
+                    clean = True
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._sessions.remove(session)
+            writer.close()
+            if not clean and session.will is not None:
+                self._publish(*session.will)
+
+    def _connect(self, session: _Session, body: bytes) -> None:
+        _, pos = _read_string(body, 0)  # protocol name
+        flags = body[pos + 1]
+        session.client_id, pos = _read_string(body, pos + 4)
+        if flags & 0x04:
+            will_topic, pos = _read_string(body, pos)
+            will_length = struct.unpack_from('!H', body, pos)[0]
+            session.will = (will_topic, body[pos + 2:pos + 2 + will_length], bool(flags & 0x20))
+
+    def _publish(self, topic: str, payload: bytes, retain: bool) -> None:
+        self.published += 1
+        if self.verbose:
+            print(topic + ' ' + payload.decode('utf-8', errors='replace'), flush=True)
+        if retain:
+            self._retained[topic] = payload
+        packet = publish_packet(topic, payload)
+        for session in self._sessions:
+            if any(topic_matches(topic_filter, topic) for topic_filter in session.filters):
+                session.writer.write(packet)
+                self.delivered += 1
+
+
+class MqttStandInClient:
+    """A minimal QoS 0 client: connect with a will, publish, subscribe"""
+
+    def __init__(self, client_id: str, on_message: MessageHandler = None):
+        self.client_id = client_id
+        self._on_message = on_message
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._ids = itertools.count(1)
+        self._task = None
+
+    async def connect(self, host: str, port: int = DEFAULT_PORT, will: Tuple[str, str] = None) -> None:
+        self._reader, self._writer = await asyncio.open_connection(host, port)
+        flags = 0x02  # clean session
+        payload = _string(self.client_id)
+        if will is not None:
+            flags |= 0x04 | 0x20  # will, retained
+            payload += _string(will[0]) + _string(will[1])
+        self._writer.write(_packet(CONNECT, 0, _string('MQTT') + bytes([4, flags]) + struct.pack('!H', 0) + payload))
+        packet_type, _, _ = await read_packet(self._reader)
+        if packet_type != CONNACK:
+            raise ConnectionError('no CONNACK from the broker')
+        self._task = asyncio.ensure_future(self._read())
+
+    def publish(self, topic: str, payload: str, retain: bool = False) -> None:
+        if self._writer is not None:
+            self._writer.write(publish_packet(topic, payload.encode('utf-8'), retain))
+
+    def subscribe(self, topic_filter: str) -> None:
+        self._writer.write(_packet(SUBSCRIBE, 0x02, struct.pack('!H', next(self._ids)) + _string(topic_filter) + b'\x00'))
+
+    async def close(self) -> None:
+        if self._writer is None:
+            return
+        writer, self._writer = self._writer, None
+        try:
+            writer.write(_packet(DISCONNECT, 0, b''))
+            writer.close()
+        except ConnectionError:
+            pass
+        if self._task is not None:
+            self._task.cancel()
+
+    async def abort(self) -> None:
+        """Drop the connection without a DISCONNECT, so the broker publishes the will"""
+        if self._writer is None:
+            return
+        writer, self._writer = self._writer, None
+        writer.transport.abort()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _read(self) -> None:
+        try:
+            while True:
+                packet_type, flags, body = await read_packet(self._reader)
+                if packet_type == PUBLISH and self._on_message is not None:
+                    topic, _, payload = parse_publish(flags, body)
+                    await self._on_message(topic, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+
+async def serve(broker: MqttBrokerStandIn) -> None:
+    await broker.start()
+    print('mqtt_standin: listening on ' + broker.host + ':' + str(broker.port), flush=True)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    await broker.stop()
+    sys.stderr.write('mqtt_standin: %d messages published, %d delivered\n' % (broker.published, broker.delivered))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Run a small MQTT broker for development')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on')
+    parser.add_argument('--verbose', action='store_true', help='print every message published')
+    args = parser.parse_args()
+    asyncio.run(serve(MqttBrokerStandIn(args.port, args.host, args.verbose)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
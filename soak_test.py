@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+"""
+Long run soak test of the nodeserver against device_simulator.py, looking for leaks.
+
+The real RGBW2Controller is started with a stand-in for PG3 and configured with the
+simulated devices, then its shortPoll/longPoll are driven cycle after cycle with a few
+on/off commands in between.  The poll scheduler's clock is run ahead by the shortPoll
+interval every cycle, so a simulated day of polling takes minutes rather than a day.
+
+While it runs the RSS, open file descriptors, threads, asyncio tasks on the device loop
+and open aiohttp sessions are sampled.  After a warm up the second half of the samples is
+compared with the first half, and anything that kept growing fails the run (exit 1).
+The keep-alive pool of the shared session is filled to its limit for every Gen1 device
+before each sample, so the fds don't depend on how many commands happened to overlap or
+how many idle connections timed out (in real seconds, while the test runs on a faster
+clock).  The idle connections it holds are sampled too, and must stay within the
+connector's per device limit.
+
+    python3 soak_test.py                                  # a simulated day, 20 RGBW2 + 20 Shelly1 + 5 Shelly 2.5
+    python3 soak_test.py --hours 168 --loss 0.01          # a week with a lossy network
+    python3 soak_test.py --hours 2 --json soak.json       # quick run, samples saved
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from typing import Any, Dict, List
+
+from aiohttp import ClientSession
+
+import MultiChannel_Node
+import Node_Shared
+import Poll_Scheduler
+import RGBW2_Node
+import Shelly1_Node
+from Node_Shared import LOGGER
+from Command_Queue import COALESCE_WINDOW
+from Shelly_RGBW2_Nodeserver import RGBW2Controller
+from ShellyDevice_Loop import CONNECTIONS_PER_HOST
+from benchmark_runner import StandInPolyglot, start_simulator, rss_kb
+from device_simulator import DEFAULT_BASE_PORT, TYPE_RGBW2, TYPE_SHELLY1, TYPE_PLUS1, TYPE_SHELLY25
+
+DEFAULT_WARMUP   = 0.25   # fraction of the samples left out of the leak check
+DEFAULT_SLACK    = 2      # fds/threads/tasks the second half may be above the first half
+DEFAULT_RSS_SLACK_KB = 4096
+
+# the custom param prefix of each simulated device type
+_DEVICE_PREFIX = {
+    TYPE_RGBW2    : 'RGBW2_',
+    TYPE_SHELLY1  : 'SHELLY1_',
+    TYPE_PLUS1    : 'SHELLYPLUS1_',
+    TYPE_SHELLY25 : 'SHELLY25_',
+}
+
+# sampled values that must not keep growing
+_METRICS = ('rss_kb', 'fds', 'threads', 'tasks', 'sessions')
+
+
+class StandInNotices(dict):
+    def delete(self, key: str) -> None:
+        self.pop(key, None)
+
+
+class SoakPolyglot(StandInPolyglot):
+    """The PG3 interface the controller uses, events are delivered with publish()"""
+    CUSTOMPARAMS = 'CUSTOMPARAMS'
+    CUSTOMDATA   = 'CUSTOMDATA'
+    CONFIGDONE   = 'CONFIGDONE'
+    DISCOVER     = 'DISCOVER'
+    STOP         = 'STOP'
+    POLL         = 'POLL'
+
+    def __init__(self):
+        super().__init__()
+        self.Notices = StandInNotices()
+        self._handlers = {}
+
+    def subscribe(self, topic: str, callback: Any, address: str = None) -> None:
+        if address is None:
+            self._handlers[topic] = callback
+
+    def publish(self, topic: str, *args: Any) -> None:
+        self._handlers[topic](*args)
+
+    def setCustomParamsDoc(self) -> None:
+        pass
+
+    def updateProfile(self) -> None:
+        pass
+
+    def ready(self) -> None:
+        pass
+
+
+class SimulatedClock:
+    """The time module with monotonic() running ahead of the real clock by offset seconds"""
+    def __init__(self):
+        self.offset = 0.0
+
+    def monotonic(self) -> float:
+        return time.monotonic() + self.offset
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(time, name)
+
+
+def open_fds() -> int:
+    for fd_dir in ('/proc/self/fd', '/dev/fd'):
+        if os.path.isdir(fd_dir):
+            return len(os.listdir(fd_dir))
+    return -1
+
+
+async def fill_pool(session: ClientSession, hosts: List[str]) -> None:
+    """Open as many connections to each host as the pool keeps, the requests overlap so none of them can reuse another's"""
+    async def get(host):
+        async with session.get('http://' + host + '/shelly') as response:
+            await response.read()
+    await asyncio.gather(*[get(host) for host in hosts for _ in range(CONNECTIONS_PER_HOST)], return_exceptions=True)
+
+
+def sample(controller: RGBW2Controller, cycle: int, clock: SimulatedClock, hosts: List[str]) -> Dict[str, Any]:
+    async def loop_counts():
+        session = controller.device_loop.get_session()
+        await fill_pool(session, hosts)
+        # the connector has no public count of its idle connections, an AttributeError here means aiohttp renamed _conns
+        pooled = sum(len(connections) for connections in session.connector._conns.values())
+        return len(asyncio.all_tasks()) - 1, pooled  # not counting this task
+
+    time.sleep(COALESCE_WINDOW * 2)  # let the commands of the cycle finish
+    gc.collect()
+    tasks, pooled = controller.device_loop.run(loop_counts())
+    return {
+        'cycle': cycle,
+        'simulated_hours': round(clock.offset / 3600.0, 2),
+        'rss_kb': rss_kb(),
+        'fds': open_fds(),
+        'pooled': pooled,
+        'threads': threading.active_count(),
+        'tasks': tasks,
+        'sessions': sum(1 for obj in gc.get_objects() if isinstance(obj, ClientSession) and not obj.closed),
+    }
+
+
+def find_leaks(samples: List[Dict[str, Any]], warmup: float, slack: int, rss_slack_kb: int, pool_limit: int) -> List[str]:
+    """
+    The metrics whose highest value in the second half of the run is above the first half's by more
+    than the slack, and the idle pooled connections if there were ever more than pool_limit of them.
+    """
+    leaks = []
+    pooled = max((entry['pooled'] for entry in samples), default=0)
+    if pooled > pool_limit:
+        leaks.append('%d idle connections pooled, the limit is %d' % (pooled, pool_limit))
+    steady = samples[int(len(samples) * warmup):]
+    if len(steady) < 4:
+        print('not enough samples for a leak check, use more --samples or --hours')
+        return leaks
+    first, second = steady[:len(steady) // 2], steady[len(steady) // 2:]
+    for metric in _METRICS:
+        before = max(entry[metric] for entry in first)
+        after = max(entry[metric] for entry in second)
+        allowed = rss_slack_kb if metric == 'rss_kb' else slack
+        if after > before + allowed:
+            leaks.append('%s grew from %d to %d' % (metric, before, after))
+    return leaks
+
+
+def device_params(devices: List[Dict[str, Any]]) -> Dict[str, str]:
+    params = {'CoIoT': 'false', 'AutoAddDevices': 'false'}
+    for device in devices:
+        params[_DEVICE_PREFIX[device['type']] + device['id']] = device['host']
+    return params
+
+
+def soak(args: argparse.Namespace, devices: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    clock = SimulatedClock()
+    for module in (Poll_Scheduler, Node_Shared, RGBW2_Node, Shelly1_Node, MultiChannel_Node):
+        module.time = clock
+
+    poly = SoakPolyglot()
+    controller = RGBW2Controller(poly)
+    poly.publish(poly.CUSTOMDATA, {})
+    poly.publish(poly.CUSTOMPARAMS, device_params(devices))
+    poly.publish(poly.CONFIGDONE)
+    nodes = controller.get_device_node_list()
+    command_nodes = [channel for node in nodes for channel in getattr(node, 'channels', [node])]
+    pooled_hosts = [device['host'] for device in devices if device['type'] != TYPE_PLUS1]  # Gen2 devices keep a websocket instead
+
+    cycles = max(1, int(args.hours * 3600 / args.short_poll))
+    long_every = max(1, int(args.long_poll / args.short_poll))
+    sample_every = max(1, cycles // args.samples)
+    print('%d devices, %d nodes, %d cycles (%.1f simulated hours)' % (len(nodes), len(poly.nodes), cycles, args.hours), flush=True)
+    print('%8s %8s %9s %6s %7s %8s %6s %9s' % ('cycle', 'hours', 'rss kB', 'fds', 'pooled', 'threads', 'tasks', 'sessions'))
+
+    def wait_idle():
+        while controller.poll_scheduler.busy:
+            time.sleep(0.001)
+
+    samples = []
+    start = time.monotonic()
+    try:
+        for cycle in range(1, cycles + 1):
+            clock.offset += args.short_poll
+            controller.poll('shortPoll')
+            wait_idle()
+            if cycle % long_every == 0:
+                controller.poll('longPoll')
+                wait_idle()
+            for _ in range(args.commands):
+                node = random.choice(command_nodes)
+                node.on_DON(None) if random.random() < 0.5 else node.on_DOF(None)
+            if cycle % sample_every == 0 or cycle == cycles:
+                entry = sample(controller, cycle, clock, pooled_hosts)
+                samples.append(entry)
+                print('%8d %8.2f %9d %6d %7d %8d %6d %9d' % (entry['cycle'], entry['simulated_hours'], entry['rss_kb'], entry['fds'], entry['pooled'],
+                                                            entry['threads'], entry['tasks'], entry['sessions']), flush=True)
+    finally:
+        controller.stop()
+    print('%.1f seconds, %d requests' % (time.monotonic() - start, sum(node.shelly_device.stats.requests for node in nodes)))
+    return samples
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Soak test the nodeserver against simulated Shelly devices and check for leaks')
+    parser.add_argument('--rgbw2', type=int, default=20, help='number of simulated RGBW2 devices')
+    parser.add_argument('--shelly1', type=int, default=20, help='number of simulated Shelly1 devices')
+    parser.add_argument('--plus1', type=int, default=0, help='number of simulated Gen2 Plus 1 devices')
+    parser.add_argument('--shelly25', type=int, default=5, help='number of simulated Shelly 2.5 devices')
+    parser.add_argument('--base-port', type=int, default=DEFAULT_BASE_PORT, help='port of the first simulated device')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds before each answer')
+    parser.add_argument('--jitter', type=float, default=0.0, help='simulated +/- seconds added to the latency')
+    parser.add_argument('--loss', type=float, default=0.0, help='fraction of requests the simulator drops')
+    parser.add_argument('--timeouts', type=float, default=0.0, help='fraction of requests that hang past the client timeout')
+    parser.add_argument('--hours', type=float, default=24.0, help='simulated hours to run for')
+    parser.add_argument('--short-poll', type=float, default=5.0, help='simulated shortPoll seconds')
+    parser.add_argument('--long-poll', type=float, default=60.0, help='simulated longPoll seconds')
+    parser.add_argument('--commands', type=int, default=1, help='on/off commands sent every cycle')
+    parser.add_argument('--samples', type=int, default=48, help='resource samples over the run')
+    parser.add_argument('--warmup', type=float, default=DEFAULT_WARMUP, help='fraction of the samples left out of the leak check')
+    parser.add_argument('--slack', type=int, default=DEFAULT_SLACK, help='growth of fds/threads/tasks that is not a leak')
+    parser.add_argument('--rss-slack', type=int, default=DEFAULT_RSS_SLACK_KB, help='RSS growth in kB that is not a leak')
+    parser.add_argument('--json', help='also write the samples to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the nodeserver log')
+    args = parser.parse_args()
+
+    # importing udi_interface sends stdout/stderr to the nodeserver log, this is a console tool
+    sys.stdout = sys.__stdout__
+    sys.stderr = sys.__stderr__
+    if not args.verbose:
+        LOGGER.setLevel(logging.CRITICAL)
+
+    simulator, devices = start_simulator(args)
+    try:
+        samples = soak(args, devices)
+    finally:
+        simulator.terminate()
+        simulator.wait()
+
+    leaks = find_leaks(samples, args.warmup, args.slack, args.rss_slack, CONNECTIONS_PER_HOST * len(devices))
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'devices': len(devices), 'args': vars(args), 'samples': samples, 'leaks': leaks}, json_file, indent=2)
+    for leak in leaks:
+        print('LEAK: ' + leak)
+    if not leaks:
+        print('no leaks found')
+    return 1 if leaks else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())